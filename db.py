@@ -1,26 +1,56 @@
-<<<<<<< HEAD
 from __future__ import annotations
 
 import json
 import logging
 import os
+import pathlib
 import re
 import sqlite3
-from collections.abc import Callable, Iterable, Sequence
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import lru_cache
 from math import sqrt
 from typing import Any, TypedDict
 
 from Levenshtein import distance
 
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is optional
+    np = None
+
 DB_PATH = os.getenv("DB_PATH", "/opt/aura-assistant/db.sqlite3")
+DB_SHARDING = os.getenv("DB_SHARDING", "0") == "1"
+DB_SHARD_BUCKETS = int(os.getenv("DB_SHARD_BUCKETS", "0"))
+DB_SHARD_CACHE_SIZE = int(os.getenv("DB_SHARD_CACHE_SIZE", "32"))
 DB_DEBUG_PATH = os.getenv("DB_DEBUG_LOG", "/opt/aura-assistant/db_debug.log")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+FUZZY_CANDIDATE_LIMIT = int(os.getenv("FUZZY_CANDIDATE_LIMIT", "25"))
+DB_ARCHIVE_AFTER_DAYS = int(os.getenv("DB_ARCHIVE_AFTER_DAYS", "30"))
+# Days of entity_changes kept for incremental sync; older clients do a full read.
+DB_CHANGE_LOG_RETENTION_DAYS = int(os.getenv("DB_CHANGE_LOG_RETENTION_DAYS", "30"))
+DB_PROFILE = os.getenv("DB_PROFILE", "0") == "1"
+DB_TRACE_SQL = os.getenv("DB_TRACE_SQL", "0") == "1"
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "50"))
+META_CACHE_SIZE = int(os.getenv("META_CACHE_SIZE", "4096"))
+DB_BACKUP_DIR = os.getenv("DB_BACKUP_DIR", os.path.join(os.path.dirname(DB_PATH), "backups"))
+DB_BACKUP_KEEP = int(os.getenv("DB_BACKUP_KEEP", "7"))
+DB_BACKUP_PAGES_PER_STEP = int(os.getenv("DB_BACKUP_PAGES_PER_STEP", "256"))
+DB_BACKUP_STEP_SLEEP_MS = int(os.getenv("DB_BACKUP_STEP_SLEEP_MS", "20"))
 
 _db_debug_dir = os.path.dirname(DB_DEBUG_PATH)
 if _db_debug_dir:
     os.makedirs(_db_debug_dir, exist_ok=True)
 
 _sql_logger = logging.getLogger("aura.db.sql")
-if not _sql_logger.handlers:
+if DB_TRACE_SQL and not _sql_logger.handlers:
     _sql_logger.setLevel(logging.DEBUG)
     _sql_handler = logging.FileHandler(DB_DEBUG_PATH, encoding="utf-8")
     _sql_handler.setFormatter(logging.Formatter("%(asctime)s | %(message)s"))
@@ -41,12 +71,18 @@ _app_logger = logging.getLogger("aura")
 
 
 def set_embedding_provider(
-    provider: Callable[[str], Sequence[float] | None]
+    provider: Callable[[str], Sequence[float] | None],
+    model: str = "default",
 ) -> None:
-    """Register a callable that returns an embedding vector for the given text."""
+    """Register a callable that returns an embedding vector for the given text.
+
+    ``model`` names the embedding model; stored vectors are only reused for
+    the same model.
+    """
 
-    global _embedding_provider
+    global _embedding_provider, _embedding_model
     _embedding_provider = provider
+    _embedding_model = model
 
 
 def _cosine_similarity(vec_a: Sequence[float], vec_b: Sequence[float]) -> float:
@@ -62,10 +98,12 @@ def _cosine_similarity(vec_a: Sequence[float], vec_b: Sequence[float]) -> float:
     return dot / (norm_a * norm_b)
 
 _embedding_provider: Callable[[str], Sequence[float] | None] | None = None
+_embedding_model = "default"
 
 
 def _trace_sql(statement: str) -> None:
-    _sql_logger.debug(statement)
+    if DB_TRACE_SQL:
+        _sql_logger.debug(statement)
 
 _TOKEN_STOPWORDS = {
     "и",
@@ -150,6 +188,23 @@ class CreationResult(TypedDict, total=False):
     similarity: float | None
     auto_use: bool
     missing_parent: bool
+
+
+class ListSnapshot(TypedDict):
+    id: int
+    title: str
+    meta: dict[str, Any]
+    tasks: list[tuple[int, str, dict[str, Any], int]]
+
+
+class EntityChange(TypedDict):
+    version: int
+    entity_id: int
+    op: str
+    fields: list[str]
+    changed_at: str
+
+
 def _tokenize(text: str) -> list[str]:
     parts = re.split(r"[^0-9a-zA-Zа-яА-ЯёЁ]+", (text or "").lower())
     return [p for p in parts if p and p not in _TOKEN_STOPWORDS]
@@ -268,6 +323,168 @@ def semantic_similarity(text_a: str | None, text_b: str | None) -> float:
     return score
 
 
+def _embed_text(text: str) -> list[float] | None:
+    cleaned = (text or "").strip()
+    if _embedding_provider is None or not cleaned:
+        return None
+    try:
+        vector = _embedding_provider(cleaned)
+    except Exception as exc:  # pragma: no cover - defensive logging
+        logging.exception("Embedding provider failed: %s", exc)
+        return None
+    return list(vector) if vector else None
+
+
+def _pack_vector(vector: Sequence[float]) -> bytes:
+    return array("f", vector).tobytes()
+
+
+def _unpack_vector(blob: bytes) -> array:
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector
+
+
+def _store_embedding(
+    conn: sqlite3.Connection, entity_id: int, user_id: int, vector: Sequence[float]
+) -> bytes:
+    blob = _pack_vector(vector)
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO entity_embeddings (entity_id, user_id, model, dim, vector)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        (entity_id, user_id, _embedding_model, len(vector), blob),
+    )
+    return blob
+
+
+def backfill_embeddings(conn: sqlite3.Connection, limit: int = 200) -> int:
+    """Embed up to ``limit`` live lists and tasks that have no stored vector.
+
+    Meant for the background loop on a standalone connection: provider calls
+    happen outside any transaction and each vector is written on its own.
+    Titles the provider fails on are retried on the next run.  Returns the
+    number of vectors stored.
+    """
+
+    if _embedding_provider is None:
+        return 0
+    try:
+        rows = conn.execute(
+            """
+            SELECT e.id, e.user_id, e.title FROM entities e
+            LEFT JOIN entity_embeddings v ON v.entity_id = e.id AND v.model = ?
+            WHERE v.entity_id IS NULL AND e.is_deleted = 0 AND e.type IN ('list', 'task')
+            ORDER BY e.id
+            LIMIT ?
+            """,
+            (_embedding_model, limit),
+        ).fetchall()
+    except sqlite3.Error as exc:
+        logging.error("SQLite error in backfill_embeddings: %s", exc)
+        return 0
+    stored = 0
+    for row in rows:
+        vector = _embed_text(row["title"])
+        if not vector:
+            continue
+        try:
+            _store_embedding(conn, row["id"], row["user_id"], vector)
+        except sqlite3.Error as exc:
+            logging.error("SQLite error in backfill_embeddings: %s", exc)
+            break
+        stored += 1
+    if stored:
+        logging.info("Backfilled %s embeddings", stored)
+    return stored
+
+
+def _score_embedding_blobs(query: Sequence[float], blobs: Sequence[bytes]) -> list[float]:
+    """Cosine similarity of ``query`` against float32 vectors of equal size."""
+
+    if not blobs:
+        return []
+    if np is None:
+        return [_cosine_similarity(query, _unpack_vector(blob)) for blob in blobs]
+    matrix = np.frombuffer(b"".join(blobs), dtype=np.float32).reshape(len(blobs), len(query))
+    vector = np.asarray(query, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector)
+    dots = matrix @ vector
+    scores = np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+    return scores.tolist()
+
+
+def _index_entity_tokens(
+    conn: sqlite3.Connection, entity_id: int, user_id: int, title: str
+) -> None:
+    conn.execute("DELETE FROM entity_tokens WHERE entity_id = ?", (entity_id,))
+    conn.executemany(
+        "INSERT OR IGNORE INTO entity_tokens (entity_id, user_id, token) VALUES (?, ?, ?)",
+        [(entity_id, user_id, token) for token in set(_semantic_tokenize(title))],
+    )
+
+
+def _token_overlap_candidates(
+    conn: sqlite3.Connection,
+    user_id: int,
+    tokens: set[str],
+    entity_type: str,
+    parent_id: int | None,
+) -> list[tuple[int, str, float]]:
+    """Jaccard-score only the entities that share a token with ``tokens``."""
+
+    if not tokens:
+        return []
+    placeholders = ", ".join("?" for _ in tokens)
+    params: list[Any] = [user_id, *sorted(tokens), entity_type]
+    query = [
+        "SELECT t.entity_id, e.title, t.token FROM entity_tokens t",
+        "JOIN entities e ON e.id = t.entity_id",
+        "WHERE t.entity_id IN (",
+        f"  SELECT q.entity_id FROM entity_tokens q WHERE q.user_id = ? AND q.token IN ({placeholders})",
+        ")",
+        "AND e.type = ? AND e.is_deleted = 0",
+    ]
+    if parent_id is not None:
+        query.append("AND e.parent_id = ?")
+        params.append(parent_id)
+    token_sets: dict[int, set[str]] = {}
+    titles: dict[int, str] = {}
+    for row in conn.execute(" ".join(query), tuple(params)):
+        token_sets.setdefault(row[0], set()).add(row[2])
+        titles[row[0]] = row[1]
+    return [
+        (entity_id, titles[entity_id], len(tokens & other) / len(tokens | other))
+        for entity_id, other in token_sets.items()
+    ]
+
+
+def _load_token_candidates(
+    conn: sqlite3.Connection,
+    user_id: int,
+    entity_type: str,
+    parent_id: int | None,
+) -> list[tuple[int, str, set[str]]]:
+    """Token sets of every live entity in one duplicate-check scope, loaded once per batch."""
+
+    params: list[Any] = [user_id, entity_type]
+    query = [
+        "SELECT e.id, e.title, t.token FROM entities e",
+        "JOIN entity_tokens t ON t.entity_id = e.id",
+        "WHERE e.user_id = ? AND e.type = ? AND e.is_deleted = 0",
+    ]
+    if parent_id is not None:
+        query.append("AND e.parent_id = ?")
+        params.append(parent_id)
+    token_sets: dict[int, set[str]] = {}
+    titles: dict[int, str] = {}
+    for row in conn.execute(" ".join(query), tuple(params)):
+        token_sets.setdefault(row[0], set()).add(row[2])
+        titles[row[0]] = row[1]
+    return [(entity_id, titles[entity_id], tokens) for entity_id, tokens in token_sets.items()]
+
+
 def _find_semantic_duplicate(
     conn: sqlite3.Connection,
     user_id: int,
@@ -276,40 +493,110 @@ def _find_semantic_duplicate(
     *,
     parent_id: int | None = None,
     threshold: float = 0.83,
+    vector: Sequence[float] | None = None,
 ) -> tuple[int, str, float] | None:
+    """Find the closest live entity of the same type above ``threshold``.
+
+    ``vector`` is the embedding of ``title``.  Candidate embeddings are read
+    from ``entity_embeddings`` and scored in a single pass; candidates not
+    embedded yet (see :func:`backfill_embeddings`) fall back to the legacy
+    score.  Without a vector only entities sharing a semantic token are
+    Jaccard-scored through ``entity_tokens``.
+    """
+
     cleaned = (title or "").strip()
     if not cleaned:
         return None
-    params: list[Any] = [user_id, entity_type]
+    if not vector:
+        scored = _token_overlap_candidates(
+            conn, user_id, set(_semantic_tokenize(cleaned)), entity_type, parent_id
+        )
+        return _best_semantic_match(cleaned, scored, threshold)
+    candidates = _load_embedding_candidates(conn, user_id, entity_type, parent_id, len(vector))
+    return _best_semantic_match(cleaned, candidates.score(cleaned, vector), threshold)
+
+
+class _EmbeddingCandidates:
+    """Stored vectors of one duplicate-check scope, loaded once and scored in bulk."""
+
+    def __init__(self) -> None:
+        self.embedded: list[tuple[int, str]] = []
+        self.blobs: list[bytes] = []
+        self.unembedded: list[tuple[int, str]] = []
+
+    def add(self, entity_id: int, title: str, vector: Sequence[float] | None) -> None:
+        if vector:
+            self.embedded.append((entity_id, title))
+            self.blobs.append(_pack_vector(vector))
+        else:
+            self.unembedded.append((entity_id, title))
+
+    def score(self, cleaned: str, vector: Sequence[float]) -> list[tuple[int, str, float]]:
+        scored = [
+            (candidate_id, candidate_title, score)
+            for (candidate_id, candidate_title), score in zip(
+                self.embedded, _score_embedding_blobs(vector, self.blobs)
+            )
+        ]
+        scored.extend(
+            (candidate_id, candidate_title, _legacy_semantic_similarity(cleaned, candidate_title))
+            for candidate_id, candidate_title in self.unembedded
+        )
+        return scored
+
+
+def _load_embedding_candidates(
+    conn: sqlite3.Connection,
+    user_id: int,
+    entity_type: str,
+    parent_id: int | None,
+    dim: int,
+) -> _EmbeddingCandidates:
+    params: list[Any] = [_embedding_model, dim, user_id, entity_type]
     query = [
-        "SELECT id, title FROM entities",
-        "WHERE user_id = ? AND type = ?",
-        "AND (meta IS NULL OR json_extract(meta, '$.deleted') IS NOT TRUE)",
+        "SELECT e.id, e.title, v.vector FROM entities e",
+        "LEFT JOIN entity_embeddings v",
+        "ON v.entity_id = e.id AND v.model = ? AND v.dim = ?",
+        "WHERE e.user_id = ? AND e.type = ?",
+        "AND e.is_deleted = 0",
     ]
     if parent_id is not None:
-        query.append("AND parent_id = ?")
+        query.append("AND e.parent_id = ?")
         params.append(parent_id)
-    cur = conn.execute(" ".join(query), tuple(params))
+    candidates = _EmbeddingCandidates()
+    for row in conn.execute(" ".join(query), tuple(params)).fetchall():
+        blob = row["vector"]
+        if blob is None:
+            candidates.unembedded.append((row["id"], row["title"]))
+        else:
+            candidates.embedded.append((row["id"], row["title"]))
+            candidates.blobs.append(blob)
+    return candidates
+
+
+def _best_semantic_match(
+    cleaned: str, scored: Iterable[tuple[int, str, float]], threshold: float
+) -> tuple[int, str, float] | None:
     best_match: tuple[int, str, float] | None = None
-    for row in cur.fetchall():
-        candidate_id = row["id"] if isinstance(row, sqlite3.Row) else row[0]
-        candidate_title = row["title"] if isinstance(row, sqlite3.Row) else row[1]
-        score = semantic_similarity(cleaned, candidate_title)
-        if score > threshold and (best_match is None or score > best_match[2]):
-            best_match = (candidate_id, candidate_title, score)
+    for candidate in scored:
+        if candidate[2] > threshold and (best_match is None or candidate[2] > best_match[2]):
+            best_match = candidate
     if best_match:
         _log_semantic_match(cleaned, best_match[1], best_match[2])
     return best_match
 
 
-def _score_candidates(
+def _rank_candidates(
     pattern_tokens: Iterable[str],
     cleaned_pattern: str,
     candidates: Iterable[tuple[int, str, str]],
-) -> tuple[int, str, str] | None:
+) -> list[tuple[tuple[int, int, int], tuple[int, str, str]]]:
+    """Return ``(score, candidate)`` pairs for every match, best (lowest score) first."""
+
+    candidates = list(candidates)
     pt_set = set(pattern_tokens)
     cleaned_lower = cleaned_pattern.lower()
-    scored: list[tuple[int, int, int, tuple[int, str, str]]] = []
+    scored: list[tuple[tuple[int, int, int], tuple[int, str, str]]] = []
     for candidate in candidates:
         cand_id, cand_title, cand_meta = candidate
         title_lower = cand_title.lower()
@@ -327,19 +614,25 @@ def _score_candidates(
         if pt_set and overlap == 0 and not substring_match:
             continue
         edit_distance = distance(title_lower, cleaned_lower) if cleaned_lower else 0
-        scored.append((-overlap, edit_distance, len(title_lower), candidate))
+        scored.append(((-overlap, edit_distance, len(title_lower)), candidate))
     if not scored and cleaned_lower:
-        for candidate in candidates:
-            cand_id, cand_title, cand_meta = candidate
-            title_lower = cand_title.lower()
-            if cleaned_lower in title_lower or title_lower in cleaned_lower:
-                return candidate
-        return None
-    if not scored:
-        return None
-    scored.sort()
-    best = scored[0][3]
-    return best
+        # Loose containment fallback ranks after any scored match and keeps list order.
+        return [
+            ((1, position, 0), candidate)
+            for position, candidate in enumerate(candidates)
+            if cleaned_lower in candidate[1].lower() or candidate[1].lower() in cleaned_lower
+        ]
+    scored.sort(key=lambda item: (item[0], item[1]))
+    return scored
+
+
+def _score_candidates(
+    pattern_tokens: Iterable[str],
+    cleaned_pattern: str,
+    candidates: Iterable[tuple[int, str, str]],
+) -> tuple[int, str, str] | None:
+    ranked = _rank_candidates(pattern_tokens, cleaned_pattern, candidates)
+    return ranked[0][1] if ranked else None
 
 
 def _select_candidate(
@@ -358,14 +651,103 @@ def _select_candidate(
     return _score_candidates(_tokenize(pattern), cleaned, candidates)
 
 
-def _load_meta(meta_text: str | None) -> dict[str, Any]:
-    if not meta_text:
-        return {}
+def _utc_timestamp() -> str:
+    """Timestamp in the same format as ``CURRENT_TIMESTAMP`` so the two sort together."""
+
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+_VALID_META_SQL = "CASE WHEN json_valid(meta) THEN meta ELSE '{}' END"
+
+# In-place equivalents of _mark_done_meta/_mark_deleted_meta; the only
+# parameters are the timestamp and the entity id.
+_MARK_DONE_SQL = f"""
+UPDATE entities SET meta = json_remove(
+    json_set({_VALID_META_SQL}, '$.status', 'done', '$.completed_at', ?),
+    '$.deleted', '$.deleted_at'
+)
+WHERE id = ?
+"""
+_MARK_DELETED_SQL = f"""
+UPDATE entities SET meta = json_set({_VALID_META_SQL}, '$.deleted', json('true'), '$.deleted_at', ?)
+WHERE id = ?
+"""
+
+
+def _mark_done_meta(meta: dict[str, Any]) -> dict[str, Any]:
+    meta["status"] = "done"
+    meta["completed_at"] = _utc_timestamp()
+    meta.pop("deleted", None)
+    meta.pop("deleted_at", None)
+    return meta
+
+
+def _mark_deleted_meta(meta: dict[str, Any]) -> dict[str, Any]:
+    meta["deleted"] = True
+    meta["deleted_at"] = _utc_timestamp()
+    return meta
+
+
+def _clear_history_stamps(meta: dict[str, Any]) -> dict[str, Any]:
+    meta.pop("completed_at", None)
+    meta.pop("deleted_at", None)
+    return meta
+
+
+def _assign_patterns(
+    patterns: Sequence[str], candidates: Sequence[tuple[int, str, str]]
+) -> dict[int, tuple[int, str, str]]:
+    """Match each pattern index to a distinct candidate, best scores first."""
+
+    pairs: list[tuple[tuple[int, ...], int, tuple[int, str, str]]] = []
+    for index, pattern in enumerate(patterns):
+        cleaned = re.sub(r"[^0-9a-zA-Zа-яА-ЯёЁ ]+", " ", pattern or "").strip()
+        if not cleaned:
+            continue
+        lowered = cleaned.lower()
+        for candidate in candidates:
+            if candidate[1] and candidate[1].strip().lower() == lowered:
+                pairs.append(((0,), index, candidate))
+        for score, candidate in _rank_candidates(_tokenize(pattern), cleaned, candidates):
+            pairs.append(((1, *score), index, candidate))
+    pairs.sort(key=lambda item: (item[0], item[1], item[2][0]))
+    chosen: dict[int, tuple[int, str, str]] = {}
+    taken: set[int] = set()
+    for _, index, candidate in pairs:
+        if index in chosen or candidate[0] in taken:
+            continue
+        chosen[index] = candidate
+        taken.add(candidate[0])
+    return chosen
+
+
+def _decode_meta(meta_text: str) -> dict[str, Any]:
     try:
-        return json.loads(meta_text)
+        meta = json.loads(meta_text)
     except json.JSONDecodeError:
         logging.warning("Failed to decode meta payload: %s", meta_text)
         return {}
+    return meta if isinstance(meta, dict) else {}
+
+
+@lru_cache(maxsize=META_CACHE_SIZE)
+def _decode_entity_meta(entity_id: int, meta_text: str) -> dict[str, Any]:
+    return _decode_meta(meta_text)
+
+
+def _load_meta(meta_text: str | None, entity_id: int | None = None) -> dict[str, Any]:
+    """Decode an entity's meta JSON.
+
+    With ``entity_id`` the decoded dict is memoized on (entity id, meta
+    text), so re-rendering unchanged rows skips ``json.loads``.  Callers get a
+    shallow copy they may modify; nested values are shared and read-only.
+    """
+
+    if not meta_text:
+        return {}
+    if entity_id is None:
+        return _decode_meta(meta_text)
+    return dict(_decode_entity_meta(entity_id, meta_text))
 
 
 def _dump_meta(meta: dict[str, Any] | None) -> str | None:
@@ -383,7 +765,7 @@ def get_entity_meta(conn: sqlite3.Connection, entity_id: int) -> dict[str, Any]:
         row = cur.fetchone()
         if not row:
             return {}
-        return _load_meta(row["meta"] if isinstance(row, sqlite3.Row) else row[0])
+        return _load_meta(row["meta"] if isinstance(row, sqlite3.Row) else row[0], entity_id)
     except sqlite3.Error as exc:
         logging.error("SQLite error in get_entity_meta: %s", exc)
         return {}
@@ -401,14 +783,88 @@ def set_entity_meta(
         logging.error("SQLite error in set_entity_meta: %s", exc)
 
 
+def set_entities_meta(
+    conn: sqlite3.Connection, updates: Iterable[tuple[int, dict[str, Any] | None]]
+) -> None:
+    try:
+        conn.executemany(
+            "UPDATE entities SET meta = ? WHERE id = ?",
+            [(_dump_meta(meta), entity_id) for entity_id, meta in updates],
+        )
+    except sqlite3.Error as exc:
+        logging.error("SQLite error in set_entities_meta: %s", exc)
+
+
+def _prop_column(value: Any) -> tuple[str, Any]:
+    if isinstance(value, (bool, int, float)):
+        return "value_num", float(value)
+    if isinstance(value, datetime):
+        return "value_time", value.strftime("%Y-%m-%d %H:%M:%S")
+    return "value_text", value
+
+
+def find_entities_by_prop(
+    conn: sqlite3.Connection,
+    user_id: int,
+    key: str,
+    value: Any = None,
+    *,
+    start: Any = None,
+    end: Any = None,
+    entity_type: str | None = None,
+) -> list[dict[str, Any]]:
+    """Return active entities whose meta ``key`` equals ``value`` or lies in [start, end).
+
+    Numbers compare against ``value_num``; strings in a range and datetimes
+    against ``value_time`` (any format SQLite's ``datetime()`` accepts), so
+    ``find_entities_by_prop(conn, uid, "due", start="2025-10-16", end="2025-10-17")``
+    means "due tomorrow".  Array values match on any element.
+    """
+
+    clauses = ["p.user_id = ?", "p.key = ?"]
+    params: list[Any] = [user_id, key]
+    column = "value_text"
+    if value is not None:
+        column, bound = _prop_column(value)
+        clauses.append(f"p.{column} = ?")
+        params.append(bound)
+    else:
+        for op, bound in ((">=", start), ("<", end)):
+            if bound is None:
+                continue
+            column, bound = _prop_column(bound)
+            if column == "value_text":
+                column = "value_time"
+                clauses.append(f"p.value_time {op} datetime(?)")
+            else:
+                clauses.append(f"p.{column} {op} ?")
+            params.append(bound)
+    query = f"""
+        SELECT e.id, e.type, e.title, e.parent_id, MIN(p.{column}) AS value
+        FROM entity_props p
+        JOIN entities e ON e.id = p.entity_id
+        WHERE {" AND ".join(clauses)}
+          AND e.is_deleted = 0 AND e.is_archived = 0
+    """
+    if entity_type is not None:
+        query += " AND e.type = ?"
+        params.append(entity_type)
+    query += " GROUP BY e.id ORDER BY value, e.id"
+    try:
+        return [dict(row) for row in conn.execute(query, params)]
+    except sqlite3.Error as exc:
+        logging.error("SQLite error in find_entities_by_prop: %s", exc)
+        return []
+
+
 def get_list_meta(conn: sqlite3.Connection, user_id: int, list_name: str) -> dict[str, Any]:
     try:
         cur = conn.execute(
             """
-            SELECT meta
+            SELECT id, meta
             FROM entities
             WHERE user_id = ? AND type = 'list' AND LOWER(title) = LOWER(?)
-              AND (json_extract(meta, '$.deleted') IS NULL OR json_extract(meta, '$.deleted') IS NOT TRUE)
+              AND is_deleted = 0
             LIMIT 1
             """,
             (user_id, list_name),
@@ -416,27 +872,59 @@ def get_list_meta(conn: sqlite3.Connection, user_id: int, list_name: str) -> dic
         row = cur.fetchone()
         if not row:
             return {}
-        return _load_meta(row["meta"] if isinstance(row, sqlite3.Row) else row[0])
+        return _load_meta(row["meta"], row["id"])
     except sqlite3.Error as exc:
         logging.error("SQLite error in get_list_meta: %s", exc)
         return {}
 
 
-def _get_list_id(conn: sqlite3.Connection, user_id: int, list_name: str) -> int | None:
-    cur = conn.execute(
-        """
-        SELECT id FROM entities
+def _find_list_row(
+    conn: sqlite3.Connection, user_id: int, list_name: str, *, deleted: bool = False
+) -> tuple[int, str] | None:
+    """``(id, title)`` of the live list named ``list_name``, ignoring case.
+
+    With ``deleted`` the most recently deleted match is returned instead.
+    SQLite's ``LOWER`` only folds ASCII, so when it finds nothing the user's
+    list titles are compared casefolded in Python (lists per user are few).
+    """
+
+    order = "ORDER BY deleted_at DESC, id DESC" if deleted else "ORDER BY id"
+    row = conn.execute(
+        f"""
+        SELECT id, title FROM entities
         WHERE user_id = ? AND type = 'list' AND LOWER(title) = LOWER(?)
-          AND (json_extract(meta, '$.deleted') IS NULL OR json_extract(meta, '$.deleted') IS NOT TRUE)
+          AND is_deleted = ?
+        {order}
         LIMIT 1
         """,
-        (user_id, list_name),
-    )
-    row = cur.fetchone()
-    if not row:
+        (user_id, list_name, int(deleted)),
+    ).fetchone()
+    if row is None:
+        folded = (list_name or "").casefold()
+        row = next(
+            (
+                candidate
+                for candidate in conn.execute(
+                    f"""
+                    SELECT id, title FROM entities
+                    WHERE user_id = ? AND type = 'list' AND is_deleted = ?
+                    {order}
+                    """,
+                    (user_id, int(deleted)),
+                )
+                if (candidate[1] or "").casefold() == folded
+            ),
+            None,
+        )
+    return (row[0], row[1]) if row is not None else None
+
+
+def _get_list_id(conn: sqlite3.Connection, user_id: int, list_name: str) -> int | None:
+    row = _find_list_row(conn, user_id, list_name)
+    if row is None:
         logging.info("No list '%s' found for user %s", list_name, user_id)
         return None
-    return row["id"] if isinstance(row, sqlite3.Row) else row[0]
+    return row[0]
 
 
 def _get_task_row(
@@ -451,7 +939,7 @@ def _get_task_row(
         FROM entities
         WHERE user_id = ? AND type = 'task' AND parent_id = ?
           AND LOWER(title) = LOWER(?)
-          AND (meta IS NULL OR json_extract(meta, '$.deleted') IS NOT TRUE)
+          AND is_deleted = 0
         LIMIT 1
         """,
         (user_id, list_id, title),
@@ -469,15 +957,43 @@ def _list_active_tasks(
         SELECT id, title, meta
         FROM entities
         WHERE user_id = ? AND type = 'task' AND parent_id = ?
-          AND (meta IS NULL OR json_extract(meta, '$.deleted') IS NOT TRUE)
-          AND COALESCE(json_extract(meta, '$.status'), 'open') != 'done'
-        ORDER BY created_at ASC
+          AND is_deleted = 0
+          AND status != 'done'
+        ORDER BY position ASC
         """,
         (user_id, list_id),
     )
     return cur.fetchall()
 
 
+def _task_at_index(
+    conn: sqlite3.Connection,
+    user_id: int,
+    list_id: int,
+    index: int,
+) -> sqlite3.Row | None:
+    """Active task at 1-based ``index``; negative values count from the end (-1 = last)."""
+
+    if index > 0:
+        sql = "AND position = ? LIMIT 1"
+        params: tuple[int, ...] = (index,)
+    elif index < 0:
+        sql = "ORDER BY position DESC LIMIT 1 OFFSET ?"
+        params = (-index - 1,)
+    else:
+        return None
+    return conn.execute(
+        f"""
+        SELECT id, title, meta
+        FROM entities
+        WHERE user_id = ? AND type = 'task' AND parent_id = ?
+          AND is_deleted = 0 AND status != 'done' AND position IS NOT NULL
+        {sql}
+        """,
+        (user_id, list_id, *params),
+    ).fetchone()
+
+
 def _list_restorable_tasks(
     conn: sqlite3.Connection,
     user_id: int,
@@ -488,22 +1004,89 @@ def _list_restorable_tasks(
         SELECT id, title, meta
         FROM entities
         WHERE user_id = ? AND type = 'task' AND parent_id = ?
-          AND (
-                json_extract(meta, '$.deleted') = true
-             OR json_extract(meta, '$.status') = 'done'
-             OR json_extract(meta, '$.archived') = true
-          )
+          AND (is_deleted = 1 OR status = 'done' OR is_archived = 1)
+        UNION ALL
+        SELECT id, title, meta
+        FROM entities_archive
+        WHERE user_id = ? AND type = 'task' AND parent_id = ?
         """,
-        (user_id, list_id),
+        (user_id, list_id, user_id, list_id),
     )
     return cur.fetchall()
-=======
-import sqlite3, json, os, re
-from Levenshtein import distance
-import logging
 
-DB_PATH = "/opt/aura-assistant/db.sqlite3"
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
+
+def _list_cold_tasks(
+    conn: sqlite3.Connection,
+    user_id: int,
+    list_id: int,
+) -> list[tuple[int, str, str]]:
+    cur = conn.execute(
+        """
+        SELECT id, title, meta
+        FROM entities_archive
+        WHERE user_id = ? AND type = 'task' AND parent_id = ?
+        """,
+        (user_id, list_id),
+    )
+    return [(row["id"], row["title"], row["meta"]) for row in cur.fetchall()]
+
+
+def _pattern_trigrams(cleaned: str) -> list[str]:
+    folded = cleaned.lower().replace("ё", "е")
+    grams: dict[str, None] = {}
+    for token in folded.split():
+        for start in range(len(token) - 2):
+            grams[token[start : start + 3]] = None
+    return list(grams)
+
+
+def _fuzzy_candidates(
+    conn: sqlite3.Connection,
+    user_id: int,
+    list_id: int,
+    cleaned: str,
+    *,
+    restorable: bool = False,
+    limit: int = FUZZY_CANDIDATE_LIMIT,
+) -> list[tuple[int, str, str]]:
+    """Return the tasks worth scoring for a fuzzy pattern.
+
+    The trigram index narrows the list to the ``limit`` titles sharing the
+    most trigrams with the pattern.  Patterns too short to produce trigrams
+    (or databases without FTS5) fall back to every candidate in the list.
+    """
+
+    grams = _pattern_trigrams(cleaned)
+    if grams and _table_exists(conn, "entities_trigram"):
+        state = (
+            "(e.is_deleted = 1 OR e.status = 'done' OR e.is_archived = 1)"
+            if restorable
+            else "e.is_deleted = 0 AND e.status != 'done'"
+        )
+        cur = conn.execute(
+            f"""
+            SELECT e.id, e.title, e.meta
+            FROM entities_trigram g
+            JOIN entities e ON e.id = g.rowid
+            WHERE entities_trigram MATCH ?
+              AND e.user_id = ? AND e.type = 'task' AND e.parent_id = ?
+              AND {state}
+            ORDER BY bm25(entities_trigram), e.created_at ASC
+            LIMIT ?
+            """,
+            (" OR ".join(f'"{gram}"' for gram in grams), user_id, list_id, limit),
+        )
+        candidates = [(row["id"], row["title"], row["meta"]) for row in cur.fetchall()]
+        if restorable:
+            # Compacted tasks are not in the trigram index; they are few per list.
+            candidates.extend(_list_cold_tasks(conn, user_id, list_id))
+        return candidates
+    rows = (
+        _list_restorable_tasks(conn, user_id, list_id)
+        if restorable
+        else _list_active_tasks(conn, user_id, list_id)
+    )
+    return [(row["id"], row["title"], row["meta"]) for row in rows]
 
 ENTITIES_DDL = """
 CREATE TABLE IF NOT EXISTS entities (
@@ -519,69 +1102,1572 @@ CREATE TABLE IF NOT EXISTS entities (
 );
 """
 
-<<<<<<< HEAD
-def get_conn() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.isolation_level = None
-    conn.set_trace_callback(_trace_sql)
-    return conn
+# Columns added to ``entities`` after the initial schema.  Meta flags that
+# almost every query filters on are mirrored as generated columns so that
+# they can be indexed instead of re-parsed from JSON for every row.
+ENTITY_COLUMN_MIGRATIONS: tuple[tuple[str, str], ...] = (
+    (
+        "is_deleted",
+        "is_deleted INTEGER GENERATED ALWAYS AS "
+        "(CASE WHEN json_extract(meta, '$.deleted') IS TRUE THEN 1 ELSE 0 END) VIRTUAL",
+    ),
+    (
+        "is_archived",
+        "is_archived INTEGER GENERATED ALWAYS AS "
+        "(CASE WHEN json_extract(meta, '$.archived') IS TRUE THEN 1 ELSE 0 END) VIRTUAL",
+    ),
+    (
+        "status",
+        "status TEXT GENERATED ALWAYS AS ("
+        "CASE WHEN json_extract(meta, '$.done') IS TRUE THEN 'done' "
+        "ELSE COALESCE(json_extract(meta, '$.status'), 'open') END) VIRTUAL",
+    ),
+    ("position", "position INTEGER"),
+    (
+        "completed_at",
+        "completed_at TEXT GENERATED ALWAYS AS ("
+        "CASE WHEN status = 'done' "
+        "THEN COALESCE(json_extract(meta, '$.completed_at'), created_at) END) VIRTUAL",
+    ),
+    (
+        "deleted_at",
+        "deleted_at TEXT GENERATED ALWAYS AS ("
+        "CASE WHEN is_deleted = 1 "
+        "THEN COALESCE(json_extract(meta, '$.deleted_at'), created_at) END) VIRTUAL",
+    ),
+)
 
-def init_db() -> None:
-=======
-def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.isolation_level = None
-    return conn
+ENTITY_INDEXES_DDL: tuple[str, ...] = (
+    "CREATE INDEX IF NOT EXISTS idx_entities_parent_state "
+    "ON entities(user_id, type, parent_id, is_deleted, status)",
+    "CREATE INDEX IF NOT EXISTS idx_entities_user_state "
+    "ON entities(user_id, type, is_deleted, status)",
+    "CREATE INDEX IF NOT EXISTS idx_entities_completed "
+    "ON entities(user_id, type, is_deleted, status, completed_at)",
+    "CREATE INDEX IF NOT EXISTS idx_entities_deleted "
+    "ON entities(user_id, type, is_deleted, deleted_at)",
+)
 
-def init_db():
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
-    conn = get_conn()
-    with conn:
-        conn.execute(ENTITIES_DDL)
-    conn.close()
+# Cold storage for tasks done or deleted more than DB_ARCHIVE_AFTER_DAYS ago.
+# Same columns as ``entities`` (ids are kept, so rows can move back on
+# restore) but outside the live indexes used by active-task queries.
+ENTITY_ARCHIVE_COLUMNS = "id, user_id, type, title, content, parent_id, created_at, meta"
+
+ENTITY_ARCHIVE_DDL: tuple[str, ...] = (
+    """
+    CREATE TABLE IF NOT EXISTS entities_archive (
+      id INTEGER PRIMARY KEY,
+      user_id INTEGER NOT NULL,
+      type TEXT NOT NULL,
+      title TEXT,
+      content TEXT,
+      parent_id INTEGER,
+      created_at TEXT,
+      meta TEXT,
+      %s
+    )
+    """
+    % ",\n      ".join(ddl for column, ddl in ENTITY_COLUMN_MIGRATIONS if column != "position"),
+    "CREATE INDEX IF NOT EXISTS idx_entities_archive_parent "
+    "ON entities_archive(user_id, type, parent_id)",
+    "CREATE INDEX IF NOT EXISTS idx_entities_archive_completed "
+    "ON entities_archive(user_id, type, is_deleted, status, completed_at)",
+    "CREATE INDEX IF NOT EXISTS idx_entities_archive_deleted "
+    "ON entities_archive(user_id, type, is_deleted, deleted_at)",
+)
 
-<<<<<<< HEAD
-def _get_or_create_list(conn: sqlite3.Connection, user_id: int, list_name: str) -> int | None:
-    existing_id = _get_list_id(conn, user_id, list_name)
-    if existing_id is not None:
-        logging.info("List '%s' already exists for user %s, ID: %s", list_name, user_id, existing_id)
-        return existing_id
-    try:
-        cur = conn.execute(
-            """
-            INSERT INTO entities (user_id, type, title)
-            VALUES (?, 'list', ?)
-            """,
-            (user_id, list_name),
-        )
-        list_id = cur.lastrowid
-        logging.info("Created list '%s' for user %s, ID: %s", list_name, user_id, list_id)
-        return list_id
-    except sqlite3.Error as exc:
-        logging.error("SQLite error in _get_or_create_list: %s", exc)
-        raise
+# Dense 1-based ``position`` of each active task inside its list, kept in
+# sync by triggers whenever a task is inserted, completed, deleted, restored
+# or moved.  Inactive tasks have a NULL position.  A task (re)entering a list
+# takes its created_at rank, so the order matches the old created_at sort.
+ENTITY_POSITION_DDL: tuple[str, ...] = (
+    "CREATE INDEX IF NOT EXISTS idx_entities_parent_position ON entities(parent_id, position)",
+    """
+    CREATE TRIGGER IF NOT EXISTS entities_position_ai AFTER INSERT ON entities
+    WHEN new.type = 'task' AND new.is_deleted = 0 AND new.status != 'done' BEGIN
+      UPDATE entities SET position = position + 1
+      WHERE type = 'task' AND parent_id = new.parent_id AND id != new.id
+        AND position >= (
+        SELECT COUNT(*) + 1 FROM entities
+        WHERE type = 'task' AND parent_id = new.parent_id AND position IS NOT NULL
+          AND id != new.id
+          AND (created_at < new.created_at OR (created_at = new.created_at AND id < new.id))
+      );
+      UPDATE entities SET position = (
+        SELECT COUNT(*) + 1 FROM entities
+        WHERE type = 'task' AND parent_id = new.parent_id AND position IS NOT NULL
+          AND id != new.id
+          AND (created_at < new.created_at OR (created_at = new.created_at AND id < new.id))
+      )
+      WHERE id = new.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS entities_position_enter AFTER UPDATE OF meta, parent_id ON entities
+    WHEN new.type = 'task' AND new.is_deleted = 0 AND new.status != 'done'
+      AND (old.position IS NULL OR new.parent_id IS NOT old.parent_id) BEGIN
+      UPDATE entities SET position = position + 1
+      WHERE type = 'task' AND parent_id = new.parent_id AND id != new.id
+        AND position >= (
+        SELECT COUNT(*) + 1 FROM entities
+        WHERE type = 'task' AND parent_id = new.parent_id AND position IS NOT NULL
+          AND id != new.id
+          AND (created_at < new.created_at OR (created_at = new.created_at AND id < new.id))
+      );
+      UPDATE entities SET position = (
+        SELECT COUNT(*) + 1 FROM entities
+        WHERE type = 'task' AND parent_id = new.parent_id AND position IS NOT NULL
+          AND id != new.id
+          AND (created_at < new.created_at OR (created_at = new.created_at AND id < new.id))
+      )
+      WHERE id = new.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS entities_position_leave AFTER UPDATE OF meta, parent_id ON entities
+    WHEN old.type = 'task' AND old.position IS NOT NULL
+      AND (new.is_deleted = 1 OR new.status = 'done' OR new.parent_id IS NOT old.parent_id) BEGIN
+      UPDATE entities SET position = position - 1
+      WHERE type = 'task' AND parent_id = old.parent_id AND position > old.position;
+      UPDATE entities SET position = NULL
+      WHERE id = new.id AND (new.is_deleted = 1 OR new.status = 'done');
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS entities_position_ad AFTER DELETE ON entities
+    WHEN old.position IS NOT NULL BEGIN
+      UPDATE entities SET position = position - 1
+      WHERE type = 'task' AND parent_id = old.parent_id AND position > old.position;
+    END
+    """,
+)
 
+# Transitive closure of the ``parent_id`` hierarchy: one row per
+# (ancestor, descendant) pair, including the (id, id, 0) self row, kept in
+# sync by triggers on insert, re-parenting and delete.  Whole-subtree reads
+# and writes become one indexed join instead of a walk per level.
+ENTITY_CLOSURE_DDL: tuple[str, ...] = (
+    """
+    CREATE TABLE IF NOT EXISTS entity_closure (
+      ancestor INTEGER NOT NULL,
+      descendant INTEGER NOT NULL,
+      depth INTEGER NOT NULL,
+      PRIMARY KEY (ancestor, descendant)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_entity_closure_descendant ON entity_closure(descendant, depth)",
+    """
+    CREATE TRIGGER IF NOT EXISTS entity_closure_ai AFTER INSERT ON entities BEGIN
+      INSERT OR IGNORE INTO entity_closure (ancestor, descendant, depth) VALUES (new.id, new.id, 0);
+      INSERT OR IGNORE INTO entity_closure (ancestor, descendant, depth)
+      SELECT ancestor, new.id, depth + 1 FROM entity_closure WHERE descendant = new.parent_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS entity_closure_au AFTER UPDATE OF parent_id ON entities
+    WHEN old.parent_id IS NOT new.parent_id BEGIN
+      DELETE FROM entity_closure
+      WHERE descendant IN (SELECT descendant FROM entity_closure WHERE ancestor = new.id)
+        AND ancestor IN (SELECT ancestor FROM entity_closure WHERE descendant = new.id AND depth > 0);
+      INSERT OR IGNORE INTO entity_closure (ancestor, descendant, depth)
+      SELECT up.ancestor, down.descendant, up.depth + down.depth + 1
+      FROM entity_closure up, entity_closure down
+      WHERE up.descendant = new.parent_id AND down.ancestor = new.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS entity_closure_ad AFTER DELETE ON entities BEGIN
+      DELETE FROM entity_closure WHERE descendant = old.id;
+      DELETE FROM entity_closure WHERE ancestor = old.id;
+    END
+    """,
+)
 
-def create_list(
-    conn: sqlite3.Connection,
-    user_id: int,
-    list_name: str,
-    *,
-    force: bool = False,
-) -> CreationResult:
-    cleaned_name = (list_name or "").strip()
-    if not cleaned_name:
-        logging.info("Empty list name received for user %s", user_id)
-        return _creation_result(title=list_name)
-    try:
-        if not force:
-            duplicate = _find_semantic_duplicate(
+# Typed, indexed copy of the scalar meta attributes: one row per top-level
+# key (and per element of an array value such as ``tags``).  Text values that
+# start with an ISO date are also normalized into ``value_time``, so "tagged
+# X" and "due between A and B" are index range scans instead of JSON scans.
+# Bookkeeping keys written by this module (state flags, history stamps and
+# the emoji decision) are left out, so marking a task done or deleting it
+# does not touch its property rows.  ``{id}``/``{user_id}``/``{meta}`` are the
+# source expressions and ``{source}`` the extra FROM item, if any.
+_INTERNAL_META_KEYS = (
+    "archived",
+    "archived_from",
+    "completed_at",
+    "deleted",
+    "deleted_at",
+    "done",
+    "emoji",
+    "status",
+)
+_INTERNAL_META_KEYS_SQL = ", ".join(f"'{key}'" for key in _INTERNAL_META_KEYS)
+_INTERNAL_META_PATHS_SQL = ", ".join(f"'$.{key}'" for key in _INTERNAL_META_KEYS)
+_ENTITY_PROPS_INSERT_SQL = """
+INSERT OR REPLACE INTO entity_props (entity_id, key, idx, user_id, value_text, value_num, value_time)
+SELECT prop.entity_id, prop.key, prop.idx, prop.user_id,
+       CASE WHEN prop.type = 'text' THEN prop.atom END,
+       CASE WHEN prop.type IN ('integer', 'real', 'true', 'false') THEN prop.atom END,
+       CASE WHEN prop.type = 'text'
+             AND prop.atom GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*'
+            THEN datetime(prop.atom) END
+FROM (
+  SELECT {id} AS entity_id, {user_id} AS user_id, top.key AS key, 0 AS idx,
+         top.type AS type, top.atom AS atom
+  FROM {source} json_each({object}) AS top
+  WHERE top.type NOT IN ('array', 'object', 'null') AND top.key NOT IN ({internal})
+  UNION ALL
+  SELECT {id}, {user_id}, top.key, item.key, item.type, item.atom
+  FROM {source} json_each({object}) AS top, json_each(top.value) AS item
+  WHERE top.type = 'array' AND item.type NOT IN ('array', 'object', 'null')
+    AND top.key NOT IN ({internal})
+) AS prop
+"""
+_META_OBJECT_SQL = (
+    "CASE WHEN NOT json_valid({meta}) THEN '{{}}' "
+    "WHEN json_type({meta}) = 'object' THEN {meta} ELSE '{{}}' END"
+)
+
+
+def _entity_props_insert_sql(entity_id: str, user_id: str, meta: str, source: str = "") -> str:
+    return _ENTITY_PROPS_INSERT_SQL.format(
+        id=entity_id,
+        user_id=user_id,
+        object=_META_OBJECT_SQL.format(meta=meta),
+        source=source,
+        internal=_INTERNAL_META_KEYS_SQL,
+    )
+
+
+def _public_meta_sql(meta: str) -> str:
+    return f"json_remove({_META_OBJECT_SQL.format(meta=meta)}, {_INTERNAL_META_PATHS_SQL})"
+
+
+ENTITY_PROPS_DDL: tuple[str, ...] = (
+    """
+    CREATE TABLE IF NOT EXISTS entity_props (
+      entity_id INTEGER NOT NULL,
+      key TEXT NOT NULL,
+      idx INTEGER NOT NULL,
+      user_id INTEGER NOT NULL,
+      value_text TEXT,
+      value_num REAL,
+      value_time TEXT,
+      PRIMARY KEY (entity_id, key, idx)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_entity_props_text ON entity_props(user_id, key, value_text)",
+    "CREATE INDEX IF NOT EXISTS idx_entity_props_num ON entity_props(user_id, key, value_num)",
+    "CREATE INDEX IF NOT EXISTS idx_entity_props_time ON entity_props(user_id, key, value_time)",
+    f"""
+    CREATE TRIGGER IF NOT EXISTS entity_props_ai AFTER INSERT ON entities BEGIN
+      {_entity_props_insert_sql("new.id", "new.user_id", "new.meta")};
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS entity_props_au AFTER UPDATE OF meta ON entities
+    WHEN old.meta IS NOT new.meta
+      AND {_public_meta_sql("old.meta")} IS NOT {_public_meta_sql("new.meta")} BEGIN
+      DELETE FROM entity_props WHERE entity_id = new.id;
+      {_entity_props_insert_sql("new.id", "new.user_id", "new.meta")};
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS entity_props_ad AFTER DELETE ON entities BEGIN
+      DELETE FROM entity_props WHERE entity_id = old.id;
+    END
+    """,
+)
+
+ENTITY_EMBEDDINGS_DDL: tuple[str, ...] = (
+    """
+    CREATE TABLE IF NOT EXISTS entity_embeddings (
+      entity_id INTEGER PRIMARY KEY,
+      user_id INTEGER NOT NULL,
+      model TEXT NOT NULL,
+      dim INTEGER NOT NULL,
+      vector BLOB NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_entity_embeddings_user ON entity_embeddings(user_id, model)",
+    """
+    CREATE TRIGGER IF NOT EXISTS entity_embeddings_ad AFTER DELETE ON entities BEGIN
+      DELETE FROM entity_embeddings WHERE entity_id = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS entity_embeddings_au AFTER UPDATE OF title ON entities BEGIN
+      DELETE FROM entity_embeddings WHERE entity_id = old.id;
+    END
+    """,
+)
+
+# Append-only log of entity mutations with a per-user monotonic version, so
+# callers can ask what changed since a version instead of rescanning.
+# Position shifts are derived state and are not logged on their own.
+ENTITY_CHANGES_DDL: tuple[str, ...] = (
+    """
+    CREATE TABLE IF NOT EXISTS entity_versions (
+      user_id INTEGER PRIMARY KEY,
+      version INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS entity_changes (
+      user_id INTEGER NOT NULL,
+      version INTEGER NOT NULL,
+      entity_id INTEGER NOT NULL,
+      op TEXT NOT NULL,
+      fields TEXT,
+      changed_at TEXT DEFAULT CURRENT_TIMESTAMP,
+      PRIMARY KEY (user_id, version)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS entity_changes_ai AFTER INSERT ON entities BEGIN
+      INSERT INTO entity_versions (user_id, version) VALUES (new.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+      INSERT INTO entity_changes (user_id, version, entity_id, op, fields)
+      VALUES (
+        new.user_id,
+        (SELECT version FROM entity_versions WHERE user_id = new.user_id),
+        new.id,
+        'insert',
+        'title,content,parent_id,meta'
+      );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS entity_changes_au AFTER UPDATE OF title, content, parent_id, meta ON entities
+    WHEN old.title IS NOT new.title OR old.content IS NOT new.content
+      OR old.parent_id IS NOT new.parent_id OR old.meta IS NOT new.meta BEGIN
+      INSERT INTO entity_versions (user_id, version) VALUES (new.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+      INSERT INTO entity_changes (user_id, version, entity_id, op, fields)
+      VALUES (
+        new.user_id,
+        (SELECT version FROM entity_versions WHERE user_id = new.user_id),
+        new.id,
+        'update',
+        rtrim(
+          CASE WHEN old.title IS NOT new.title THEN 'title,' ELSE '' END
+          || CASE WHEN old.content IS NOT new.content THEN 'content,' ELSE '' END
+          || CASE WHEN old.parent_id IS NOT new.parent_id THEN 'parent_id,' ELSE '' END
+          || CASE WHEN old.meta IS NOT new.meta THEN 'meta,' ELSE '' END,
+          ','
+        )
+      );
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS entity_changes_ad AFTER DELETE ON entities BEGIN
+      INSERT INTO entity_versions (user_id, version) VALUES (old.user_id, 1)
+        ON CONFLICT(user_id) DO UPDATE SET version = version + 1;
+      INSERT INTO entity_changes (user_id, version, entity_id, op, fields)
+      VALUES (
+        old.user_id,
+        (SELECT version FROM entity_versions WHERE user_id = old.user_id),
+        old.id,
+        CASE WHEN EXISTS (SELECT 1 FROM entities_archive WHERE id = old.id)
+          THEN 'archive' ELSE 'delete' END,
+        NULL
+      );
+    END
+    """,
+)
+
+# Normalized semantic tokens per entity.  The (user_id, token) index doubles
+# as an inverted index so duplicate checks only visit entities sharing a
+# token with the new title.
+ENTITY_TOKENS_DDL: tuple[str, ...] = (
+    """
+    CREATE TABLE IF NOT EXISTS entity_tokens (
+      entity_id INTEGER NOT NULL,
+      user_id INTEGER NOT NULL,
+      token TEXT NOT NULL,
+      PRIMARY KEY (entity_id, token)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_entity_tokens_lookup ON entity_tokens(user_id, token, entity_id)",
+    """
+    CREATE TRIGGER IF NOT EXISTS entity_tokens_ad AFTER DELETE ON entities BEGIN
+      DELETE FROM entity_tokens WHERE entity_id = old.id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS entity_tokens_au AFTER UPDATE OF title ON entities BEGIN
+      DELETE FROM entity_tokens WHERE entity_id = old.id;
+    END
+    """,
+)
+
+# External-content FTS5 index over entity titles/content.  unicode61 folds
+# case for Cyrillic as well (unlike SQLite's LOWER); "ё" is not covered by
+# remove_diacritics, so indexed text is folded to "е" by the triggers.
+# Prefix indexes keep "молок*" style queries cheap.
+ENTITIES_FTS_DDL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS entities_fts USING fts5(
+  title,
+  content,
+  content='entities',
+  content_rowid='id',
+  tokenize='unicode61 remove_diacritics 2',
+  prefix='2 3'
+);
+"""
+
+
+def _fts_fold(column: str) -> str:
+    return f"replace(replace({column}, 'ё', 'е'), 'Ё', 'Е')"
+
+
+ENTITIES_FTS_TRIGGERS_DDL: tuple[str, ...] = (
+    f"""
+    CREATE TRIGGER IF NOT EXISTS entities_fts_ai AFTER INSERT ON entities BEGIN
+      INSERT INTO entities_fts(rowid, title, content)
+      VALUES (new.id, {_fts_fold("new.title")}, {_fts_fold("new.content")});
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS entities_fts_ad AFTER DELETE ON entities BEGIN
+      INSERT INTO entities_fts(entities_fts, rowid, title, content)
+      VALUES ('delete', old.id, {_fts_fold("old.title")}, {_fts_fold("old.content")});
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS entities_fts_au AFTER UPDATE OF title, content ON entities BEGIN
+      INSERT INTO entities_fts(entities_fts, rowid, title, content)
+      VALUES ('delete', old.id, {_fts_fold("old.title")}, {_fts_fold("old.content")});
+      INSERT INTO entities_fts(rowid, title, content)
+      VALUES (new.id, {_fts_fold("new.title")}, {_fts_fold("new.content")});
+    END
+    """,
+)
+
+ENTITIES_FTS_BACKFILL_SQL = f"""
+INSERT INTO entities_fts(rowid, title, content)
+SELECT id, {_fts_fold("title")}, {_fts_fold("content")} FROM entities
+"""
+
+# Trigram index over titles used to shortlist fuzzy-match candidates before
+# the Python scoring in _score_candidates/Levenshtein runs.
+ENTITIES_TRIGRAM_DDL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS entities_trigram USING fts5(
+  title,
+  content='entities',
+  content_rowid='id',
+  tokenize='trigram'
+);
+"""
+
+ENTITIES_TRIGRAM_TRIGGERS_DDL: tuple[str, ...] = (
+    f"""
+    CREATE TRIGGER IF NOT EXISTS entities_trigram_ai AFTER INSERT ON entities BEGIN
+      INSERT INTO entities_trigram(rowid, title) VALUES (new.id, {_fts_fold("new.title")});
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS entities_trigram_ad AFTER DELETE ON entities BEGIN
+      INSERT INTO entities_trigram(entities_trigram, rowid, title)
+      VALUES ('delete', old.id, {_fts_fold("old.title")});
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS entities_trigram_au AFTER UPDATE OF title ON entities BEGIN
+      INSERT INTO entities_trigram(entities_trigram, rowid, title)
+      VALUES ('delete', old.id, {_fts_fold("old.title")});
+      INSERT INTO entities_trigram(rowid, title) VALUES (new.id, {_fts_fold("new.title")});
+    END
+    """,
+)
+
+ENTITIES_TRIGRAM_BACKFILL_SQL = f"""
+INSERT INTO entities_trigram(rowid, title)
+SELECT id, {_fts_fold("title")} FROM entities
+"""
+
+
+class QueryShapeStats(TypedDict):
+    shape: str
+    calls: int
+    rows: int
+    total_ms: float
+    max_ms: float
+    fetch_ms: float
+    histogram: dict[str, int]
+    call_sites: list[tuple[str, int]]
+    plan: str | None
+
+
+_LATENCY_BUCKETS_MS = (1.0, 5.0, 20.0, 100.0, 500.0)
+_SHAPE_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SHAPE_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_PLANNABLE_RE = re.compile(r"^\s*(SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE)\b", re.IGNORECASE)
+
+
+def _histogram_labels() -> list[str]:
+    labels = [f"<{bound:g}ms" for bound in _LATENCY_BUCKETS_MS]
+    labels.append(f">={_LATENCY_BUCKETS_MS[-1]:g}ms")
+    return labels
+
+
+class QueryProfiler:
+    """Per statement-shape latency histograms, row counts and call sites.
+
+    A shape is the SQL text with literals replaced by ``?`` and whitespace
+    collapsed, so the same query issued from a loop aggregates into one entry.
+    Statements slower than ``slow_ms`` get their ``EXPLAIN QUERY PLAN``
+    captured once per shape (refreshed when a slower run is seen).
+    """
+
+    def __init__(self, slow_ms: float = DB_SLOW_QUERY_MS) -> None:
+        self.slow_ms = slow_ms
+        self._lock = threading.Lock()
+        self._shapes: dict[str, dict[str, Any]] = {}
+        self._shape_cache: dict[str, str] = {}
+
+    def shape_of(self, sql: str) -> str:
+        shape = self._shape_cache.get(sql)
+        if shape is None:
+            shape = _SHAPE_LITERAL_RE.sub("?", " ".join(sql.split()))
+            shape = _SHAPE_LIST_RE.sub("(?+)", shape)
+            if len(self._shape_cache) < 4096:
+                self._shape_cache[sql] = shape
+        return shape
+
+    def _entry(self, shape: str) -> dict[str, Any]:
+        entry = self._shapes.get(shape)
+        if entry is None:
+            entry = {
+                "calls": 0,
+                "rows": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "fetch_ms": 0.0,
+                "histogram": [0] * (len(_LATENCY_BUCKETS_MS) + 1),
+                "call_sites": {},
+                "plan": None,
+            }
+            self._shapes[shape] = entry
+        return entry
+
+    def record(self, shape: str, elapsed_ms: float, rows: int, call_site: str) -> bool:
+        """Add one execution; returns True when its query plan should be captured."""
+
+        bucket = len(_LATENCY_BUCKETS_MS)
+        for index, bound in enumerate(_LATENCY_BUCKETS_MS):
+            if elapsed_ms < bound:
+                bucket = index
+                break
+        with self._lock:
+            entry = self._entry(shape)
+            slowest = entry["max_ms"]
+            entry["calls"] += 1
+            entry["rows"] += max(rows, 0)
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(slowest, elapsed_ms)
+            entry["histogram"][bucket] += 1
+            sites = entry["call_sites"]
+            sites[call_site] = sites.get(call_site, 0) + 1
+            return elapsed_ms >= self.slow_ms and (entry["plan"] is None or elapsed_ms > slowest)
+
+    def record_fetch(self, shape: str, elapsed_ms: float, rows: int) -> None:
+        with self._lock:
+            entry = self._entry(shape)
+            entry["rows"] += rows
+            entry["fetch_ms"] += elapsed_ms
+
+    def record_plan(self, shape: str, plan: str) -> None:
+        with self._lock:
+            self._entry(shape)["plan"] = plan
+
+    def summary(self, limit: int | None = 20) -> list[QueryShapeStats]:
+        """Shapes ordered by total execution time, slowest first."""
+
+        labels = _histogram_labels()
+        with self._lock:
+            items = [
+                {
+                    "shape": shape,
+                    "calls": entry["calls"],
+                    "rows": entry["rows"],
+                    "total_ms": round(entry["total_ms"] + entry["fetch_ms"], 3),
+                    "max_ms": round(entry["max_ms"], 3),
+                    "fetch_ms": round(entry["fetch_ms"], 3),
+                    "histogram": dict(zip(labels, entry["histogram"])),
+                    "call_sites": sorted(
+                        entry["call_sites"].items(), key=lambda item: item[1], reverse=True
+                    )[:5],
+                    "plan": entry["plan"],
+                }
+                for shape, entry in self._shapes.items()
+            ]
+        items.sort(key=lambda item: item["total_ms"], reverse=True)
+        return items[:limit] if limit is not None else items
+
+    def reset(self) -> None:
+        with self._lock:
+            self._shapes.clear()
+
+
+_profiler = QueryProfiler()
+
+
+def _call_site(depth: int) -> str:
+    try:
+        frame = sys._getframe(depth + 1)
+    except ValueError:
+        return "?"
+    return f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+
+
+def _explain(conn: sqlite3.Connection, sql: str, params: Any) -> str | None:
+    if not _PLANNABLE_RE.match(sql):
+        return None
+    try:
+        rows = sqlite3.Cursor(conn).execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    except (sqlite3.Error, ValueError) as exc:
+        logging.debug("Could not explain slow query: %s", exc)
+        return None
+    return "\n".join(str(row[3]) for row in rows)
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor that reports each execution and its fetch totals to the query profiler.
+
+    Fetch time and rows are accumulated on the cursor and reported once, when
+    it is re-executed, closed or collected.  Rows consumed by iterating the
+    cursor directly are not timed, so plain ``for row in cursor`` loops run
+    at native speed.
+    """
+
+    _shape: str | None = None
+    _fetch_ms = 0.0
+    _fetch_rows = 0
+
+    def _profiled(
+        self, method: Callable[..., Any], sql: str, params: Any, depth: int, many: bool
+    ) -> ProfiledCursor:
+        self._flush_fetches()
+        shape = _profiler.shape_of(sql)
+        started = time.perf_counter()
+        try:
+            method(sql, params)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self._shape = shape
+            slow = _profiler.record(shape, elapsed_ms, self.rowcount, _call_site(depth + 1))
+        if slow:
+            plan = _explain(self.connection, sql, next(iter(params), ()) if many else params)
+            if plan is not None:
+                _profiler.record_plan(shape, plan)
+            logging.warning("Slow query (%.1f ms) %s\n%s", elapsed_ms, shape, plan or "")
+        return self
+
+    def _flush_fetches(self) -> None:
+        if self._shape is not None and (self._fetch_rows or self._fetch_ms):
+            _profiler.record_fetch(self._shape, self._fetch_ms, self._fetch_rows)
+        self._fetch_ms = 0.0
+        self._fetch_rows = 0
+
+    def execute(self, sql: str, parameters: Any = (), /) -> ProfiledCursor:
+        return self._profiled(super().execute, sql, parameters, 1, False)
+
+    def executemany(self, sql: str, seq_of_parameters: Any, /) -> ProfiledCursor:
+        if not isinstance(seq_of_parameters, (list, tuple)):
+            seq_of_parameters = list(seq_of_parameters)
+        return self._profiled(super().executemany, sql, seq_of_parameters, 1, True)
+
+    def _fetched(self, started: float, rows: int) -> None:
+        self._fetch_ms += (time.perf_counter() - started) * 1000
+        self._fetch_rows += rows
+
+    def fetchone(self) -> Any:
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(started, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size: int | None = None) -> list[Any]:
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(started, len(rows))
+        return rows
+
+    def fetchall(self) -> list[Any]:
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(started, len(rows))
+        return rows
+
+    def close(self) -> None:
+        self._flush_fetches()
+        super().close()
+
+    def __del__(self) -> None:
+        self._flush_fetches()
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """Connection whose shortcut ``execute`` methods go through :class:`ProfiledCursor`."""
+
+    def cursor(self, factory: Any = ProfiledCursor) -> sqlite3.Cursor:
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters: Any = (), /) -> ProfiledCursor:
+        cursor = self.cursor()
+        return cursor._profiled(super(ProfiledCursor, cursor).execute, sql, parameters, 1, False)
+
+    def executemany(self, sql: str, seq_of_parameters: Any, /) -> ProfiledCursor:
+        cursor = self.cursor()
+        if not isinstance(seq_of_parameters, (list, tuple)):
+            seq_of_parameters = list(seq_of_parameters)
+        return cursor._profiled(
+            super(ProfiledCursor, cursor).executemany, sql, seq_of_parameters, 1, True
+        )
+
+
+def _connection_factory() -> type[sqlite3.Connection]:
+    return ProfiledConnection if DB_PROFILE else sqlite3.Connection
+
+
+def query_profile(limit: int | None = 20) -> list[QueryShapeStats]:
+    """Summary of the statements seen since start-up (or the last reset)."""
+
+    return _profiler.summary(limit)
+
+
+def reset_query_profile() -> None:
+    _profiler.reset()
+
+
+def log_query_profile(limit: int = 10) -> None:
+    for item in query_profile(limit):
+        logging.info(
+            "SQL %.1f ms total, %d calls, %d rows, max %.1f ms | %s | %s",
+            item["total_ms"],
+            item["calls"],
+            item["rows"],
+            item["max_ms"],
+            item["shape"][:200],
+            ", ".join(f"{site} x{count}" for site, count in item["call_sites"]),
+        )
+
+
+class PoolStats(TypedDict):
+    path: str
+    opened: int
+    closed: int
+    checkouts: int
+    in_use: int
+    idle: int
+
+
+def _configure_connection(
+    conn: sqlite3.Connection, busy_timeout_ms: int, *, read_only: bool = False
+) -> sqlite3.Connection:
+    conn.row_factory = sqlite3.Row
+    conn.isolation_level = None
+    conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout_ms)}")
+    if read_only:
+        conn.execute("PRAGMA query_only = ON")
+    else:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+    if DB_TRACE_SQL:
+        conn.set_trace_callback(_trace_sql)
+    return conn
+
+
+class ConnectionPool:
+    """Reusable SQLite connections for one database file.
+
+    Connections are opened lazily, configured once (WAL, synchronous=NORMAL,
+    busy_timeout) and returned to an idle stack on release.  At most
+    ``max_idle`` connections are kept around; extra ones are closed.
+    A ``read_only`` pool opens ``mode=ro`` URI connections with
+    ``query_only=ON``; under WAL its readers never wait for a writer.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        max_idle: int = DB_POOL_SIZE,
+        busy_timeout_ms: int = DB_BUSY_TIMEOUT_MS,
+        read_only: bool = False,
+    ) -> None:
+        self.path = path
+        self.read_only = read_only
+        self.max_idle = max(0, max_idle)
+        self.busy_timeout_ms = busy_timeout_ms
+        self._idle: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._closed = 0
+        self._checkouts = 0
+        self._in_use = 0
+
+    def _open(self) -> sqlite3.Connection:
+        if self.read_only:
+            target = f"{pathlib.Path(self.path).absolute().as_uri()}?mode=ro"
+            conn = sqlite3.connect(
+                target, uri=True, check_same_thread=False, factory=_connection_factory()
+            )
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False, factory=_connection_factory())
+        _configure_connection(conn, self.busy_timeout_ms, read_only=self.read_only)
+        with self._lock:
+            self._opened += 1
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+            self._checkouts += 1
+            self._in_use += 1
+        if conn is None:
+            try:
+                conn = self._open()
+            except sqlite3.Error:
+                with self._lock:
+                    self._in_use -= 1
+                raise
+        return conn
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            logging.warning("Rolling back unfinished transaction on pooled connection")
+            conn.rollback()
+        with self._lock:
+            self._in_use -= 1
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+            self._closed += 1
+        conn.close()
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._closed += len(idle)
+        for conn in idle:
+            conn.close()
+
+    def stats(self) -> PoolStats:
+        with self._lock:
+            return {
+                "path": self.path,
+                "opened": self._opened,
+                "closed": self._closed,
+                "checkouts": self._checkouts,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+            }
+
+
+_pool: ConnectionPool | None = None
+_read_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+
+
+def sharding_enabled() -> bool:
+    """True when ``DB_PATH`` is a directory of per-tenant database files."""
+
+    return DB_SHARDING or os.path.isdir(DB_PATH)
+
+
+def shard_path(user_id: int) -> str:
+    """Database file for ``user_id``: one per user, or per bucket with ``DB_SHARD_BUCKETS``."""
+
+    if DB_SHARD_BUCKETS > 0:
+        name = f"bucket_{int(user_id) % DB_SHARD_BUCKETS:04d}.sqlite3"
+    else:
+        name = f"user_{int(user_id)}.sqlite3"
+    return os.path.join(DB_PATH, name)
+
+
+def database_path(user_id: int | None = None) -> str:
+    if not sharding_enabled():
+        return DB_PATH
+    if user_id is None:
+        raise ValueError("user_id is required when the database is sharded")
+    return shard_path(user_id)
+
+
+def database_paths() -> list[str]:
+    """Every database file currently in use (all shards, or just ``DB_PATH``)."""
+
+    if not sharding_enabled():
+        return [DB_PATH]
+    if not os.path.isdir(DB_PATH):
+        return []
+    pattern = re.compile(r"^(user_-?\d+|bucket_\d{4})\.sqlite3$")
+    return [os.path.join(DB_PATH, name) for name in sorted(os.listdir(DB_PATH)) if pattern.match(name)]
+
+
+class ShardRouter:
+    """LRU-bounded set of connection pools, keyed by shard file.
+
+    Each entry holds the shard's read-write pool and, once used, its
+    read-only pool, so ``capacity`` counts shards.  A shard's schema is
+    created or migrated the first time it is opened in this process, under a
+    per-path lock so other shards stay reachable meanwhile.  Evicted pools
+    close their idle connections at once and any checked-out ones when they
+    are released.
+    """
+
+    def __init__(self, capacity: int = DB_SHARD_CACHE_SIZE) -> None:
+        self.capacity = max(1, capacity)
+        self._pools: OrderedDict[str, dict[bool, ConnectionPool]] = OrderedDict()
+        self._initialized: set[str] = set()
+        self._init_locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._evictions = 0
+
+    def _ensure_schema(self, path: str) -> None:
+        with self._lock:
+            if path in self._initialized:
+                return
+            init_lock = self._init_locks.setdefault(path, threading.Lock())
+        with init_lock:
+            if path in self._initialized:
+                return
+            conn = sqlite3.connect(path)
+            try:
+                _init_schema(_configure_connection(conn, DB_BUSY_TIMEOUT_MS))
+            finally:
+                conn.close()
+            with self._lock:
+                self._initialized.add(path)
+                self._init_locks.pop(path, None)
+
+    def pool(self, path: str, *, read_only: bool = False) -> ConnectionPool:
+        with self._lock:
+            pools = self._pools.get(path)
+            if pools is not None and read_only in pools:
+                self._pools.move_to_end(path)
+                return pools[read_only]
+        self._ensure_schema(path)
+        evicted: list[ConnectionPool] = []
+        with self._lock:
+            pools = self._pools.setdefault(path, {})
+            self._pools.move_to_end(path)
+            pool = pools.get(read_only)
+            if pool is None:
+                pool = pools[read_only] = ConnectionPool(path, read_only=read_only)
+            while len(self._pools) > self.capacity:
+                _, stale = self._pools.popitem(last=False)
+                evicted.extend(stale.values())
+                self._evictions += 1
+        for stale_pool in evicted:
+            stale_pool.max_idle = 0
+            stale_pool.close_all()
+        return pool
+
+    def open_paths(self) -> list[str]:
+        with self._lock:
+            return list(self._pools)
+
+    def close_all(self) -> None:
+        with self._lock:
+            entries, self._pools = list(self._pools.values()), OrderedDict()
+        for pools in entries:
+            for pool in pools.values():
+                pool.close_all()
+
+
+_router: ShardRouter | None = None
+
+
+def _shard_router() -> ShardRouter:
+    global _router
+    with _pool_lock:
+        if _router is None:
+            _router = ShardRouter()
+        return _router
+
+
+def get_pool(user_id: int | None = None, *, path: str | None = None) -> ConnectionPool:
+    global _pool
+    if sharding_enabled():
+        return _shard_router().pool(path or database_path(user_id))
+    with _pool_lock:
+        if _pool is None or _pool.path != DB_PATH:
+            if _pool is not None:
+                _pool.close_all()
+            _pool = ConnectionPool(DB_PATH)
+        return _pool
+
+
+def get_read_pool(user_id: int | None = None, *, path: str | None = None) -> ConnectionPool:
+    global _read_pool
+    if sharding_enabled():
+        return _shard_router().pool(path or database_path(user_id), read_only=True)
+    with _pool_lock:
+        if _read_pool is None or _read_pool.path != DB_PATH:
+            if _read_pool is not None:
+                _read_pool.close_all()
+            _read_pool = ConnectionPool(DB_PATH, read_only=True)
+        return _read_pool
+
+
+@contextmanager
+def pooled_connection(
+    user_id: int | None = None, *, path: str | None = None
+) -> Iterator[sqlite3.Connection]:
+    """Check out a shared connection for the duration of the block.
+
+    In sharding mode ``user_id`` (or an explicit shard ``path``) selects the
+    database file.
+    """
+
+    with get_pool(user_id, path=path).connection() as conn:
+        yield conn
+
+
+@contextmanager
+def read_connection(
+    user_id: int | None = None, *, path: str | None = None
+) -> Iterator[sqlite3.Connection]:
+    """Like :func:`pooled_connection`, but read-only (``mode=ro``, ``query_only``)."""
+
+    with get_read_pool(user_id, path=path).connection() as conn:
+        yield conn
+
+
+def pool_stats(user_id: int | None = None) -> PoolStats:
+    return get_pool(user_id).stats()
+
+
+def close_pool() -> None:
+    global _pool, _read_pool, _router
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close_all()
+            _pool = None
+        if _read_pool is not None:
+            _read_pool.close_all()
+            _read_pool = None
+        if _router is not None:
+            _router.close_all()
+            _router = None
+
+
+class BackupResult(TypedDict):
+    path: str
+    pages: int
+    elapsed_ms: float
+    ok: bool
+    removed: list[str]
+
+
+def _backup_generations(dest_dir: str, stem: str) -> list[str]:
+    pattern = re.compile(rf"^{re.escape(stem)}\.\d{{8}}-\d{{6}}\.sqlite3$")
+    names = sorted((name for name in os.listdir(dest_dir) if pattern.match(name)), reverse=True)
+    return [os.path.join(dest_dir, name) for name in names]
+
+
+_QUICK_CHECK_NULL_RE = re.compile(r"^NULL value in (\w+)\.(\w+)$")
+
+
+def _quick_check(conn: sqlite3.Connection) -> list[str]:
+    """``PRAGMA quick_check`` problems, minus NOT NULL reports a direct query refutes.
+
+    SQLite 3.40 reports bogus "NULL value in" errors for WITHOUT ROWID tables
+    whose primary key is not declared first (``entity_tokens``).
+    """
+
+    problems = []
+    for (message,) in conn.execute("PRAGMA quick_check").fetchall():
+        if message == "ok":
+            continue
+        match = _QUICK_CHECK_NULL_RE.match(message)
+        if match and not conn.execute(
+            f'SELECT 1 FROM "{match[1]}" WHERE "{match[2]}" IS NULL LIMIT 1'
+        ).fetchone():
+            continue
+        problems.append(message)
+    return problems
+
+
+def backup_database(
+    conn: sqlite3.Connection,
+    dest_dir: str | None = None,
+    *,
+    keep: int = DB_BACKUP_KEEP,
+    pages_per_step: int = DB_BACKUP_PAGES_PER_STEP,
+    step_sleep_ms: int = DB_BACKUP_STEP_SLEEP_MS,
+) -> BackupResult | None:
+    """Snapshot the live database into ``dest_dir`` with the online backup API.
+
+    Pages are copied ``pages_per_step`` at a time with a pause between steps,
+    so writers keep going while the copy runs.  The copy is written to a
+    ``.part`` file, checked with ``PRAGMA quick_check`` and only then renamed
+    into place; the newest ``keep`` generations are retained.
+    """
+
+    dest_dir = dest_dir or DB_BACKUP_DIR
+    source = next((row[2] for row in conn.execute("PRAGMA database_list") if row[1] == "main"), "")
+    stem = os.path.splitext(os.path.basename(source or DB_PATH))[0] or "db"
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(dest_dir, f"{stem}.{stamp}.sqlite3")
+    partial = f"{path}.part"
+    pages = 0
+
+    def progress(status: int, remaining: int, total: int) -> None:
+        nonlocal pages
+        pages = total
+        if remaining and step_sleep_ms > 0:
+            time.sleep(step_sleep_ms / 1000)
+
+    started = time.perf_counter()
+    try:
+        os.makedirs(dest_dir, exist_ok=True)
+        target = sqlite3.connect(partial)
+        try:
+            conn.backup(target, pages=max(1, pages_per_step), progress=progress)
+            target.execute("PRAGMA journal_mode = DELETE")
+            problems = _quick_check(target)
+        finally:
+            target.close()
+        ok = not problems
+        if not ok:
+            os.remove(partial)
+            logging.error("Backup %s failed quick_check (%s); discarded", path, "; ".join(problems[:5]))
+        else:
+            os.replace(partial, path)
+        removed: list[str] = []
+        for old in _backup_generations(dest_dir, stem)[max(1, keep):]:
+            os.remove(old)
+            removed.append(old)
+    except (sqlite3.Error, OSError) as exc:
+        logging.error("SQLite error in backup_database: %s", exc)
+        if os.path.exists(partial):
+            os.remove(partial)
+        return None
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    logging.info(
+        "Backed up %s pages to %s in %.1f ms (removed %s old generations)",
+        pages,
+        path,
+        elapsed_ms,
+        len(removed),
+    )
+    return {"path": path, "pages": pages, "elapsed_ms": elapsed_ms, "ok": ok, "removed": removed}
+
+
+@contextmanager
+def _savepoint(conn: sqlite3.Connection, name: str) -> Iterator[sqlite3.Connection]:
+    """Group statements atomically, nesting inside an open transaction if any."""
+
+    conn.execute(f"SAVEPOINT {name}")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute(f"ROLLBACK TO {name}")
+        conn.execute(f"RELEASE {name}")
+        raise
+    conn.execute(f"RELEASE {name}")
+
+
+class UnitOfWorkStats(TypedDict):
+    label: str
+    statements: int
+    commits: int
+    rolled_back: bool
+    elapsed_ms: float
+
+
+@contextmanager
+def unit_of_work(conn: sqlite3.Connection, label: str = "unit") -> Iterator[UnitOfWorkStats]:
+    """Run every statement issued in the block inside one ``BEGIN IMMEDIATE`` transaction.
+
+    Commits on success and rolls back if the block raises.  The yielded stats
+    are filled in on exit and logged, so the statements/commits per Telegram
+    update can be compared before and after.  Entering a unit on a connection
+    that already has an open transaction only counts statements.
+    """
+
+    stats: UnitOfWorkStats = {
+        "label": label,
+        "statements": 0,
+        "commits": 0,
+        "rolled_back": False,
+        "elapsed_ms": 0.0,
+    }
+
+    def count(statement: str) -> None:
+        if not statement.startswith("--"):
+            stats["statements"] += 1
+            if statement.startswith("COMMIT"):
+                stats["commits"] += 1
+        _trace_sql(statement)
+
+    outer = not conn.in_transaction
+    started = time.perf_counter()
+    conn.set_trace_callback(count)
+    try:
+        if outer:
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield stats
+        except BaseException:
+            if outer and conn.in_transaction:
+                conn.execute("ROLLBACK")
+                stats["rolled_back"] = True
+            raise
+        if outer and conn.in_transaction:
+            conn.execute("COMMIT")
+    finally:
+        conn.set_trace_callback(_trace_sql if DB_TRACE_SQL else None)
+        stats["elapsed_ms"] = (time.perf_counter() - started) * 1000
+        logging.info(
+            "Unit of work '%s': %d statements, %d commits%s in %.1f ms",
+            label,
+            stats["statements"],
+            stats["commits"],
+            " (rolled back)" if stats["rolled_back"] else "",
+            stats["elapsed_ms"],
+        )
+
+
+def get_conn(path: str | None = None) -> sqlite3.Connection:
+    """Open a standalone connection (to ``DB_PATH`` or a shard ``path``); the caller closes it."""
+
+    conn = sqlite3.connect(path or DB_PATH, factory=_connection_factory())
+    return _configure_connection(conn, DB_BUSY_TIMEOUT_MS)
+
+
+def _migrate_entities(conn: sqlite3.Connection) -> None:
+    existing = {row[1] for row in conn.execute("PRAGMA table_xinfo(entities)")}
+    for column, ddl in ENTITY_COLUMN_MIGRATIONS:
+        if column not in existing:
+            conn.execute(f"ALTER TABLE entities ADD COLUMN {ddl}")
+            logging.info("Added column '%s' to entities", column)
+    closure_missing = not _table_exists(conn, "entity_closure")
+    props_missing = not _table_exists(conn, "entity_props")
+    if not props_missing:
+        _upgrade_entity_props(conn)
+    _upgrade_entity_changes(conn)
+    for ddl in (
+        ENTITY_INDEXES_DDL
+        + ENTITY_POSITION_DDL
+        + ENTITY_CLOSURE_DDL
+        + ENTITY_PROPS_DDL
+        + ENTITY_ARCHIVE_DDL
+        + ENTITY_CHANGES_DDL
+        + ENTITY_EMBEDDINGS_DDL
+        + ENTITY_TOKENS_DDL
+    ):
+        conn.execute(ddl)
+    if "position" not in existing:
+        _backfill_task_positions(conn)
+    if closure_missing:
+        _backfill_entity_closure(conn)
+    if props_missing:
+        _backfill_entity_props(conn)
+    _backfill_entity_tokens(conn)
+    _migrate_search_index(conn)
+
+
+def _backfill_task_positions(conn: sqlite3.Connection) -> None:
+    cur = conn.execute(
+        """
+        UPDATE entities SET position = ranked.rn
+        FROM (
+            SELECT id, ROW_NUMBER() OVER (
+                PARTITION BY parent_id ORDER BY created_at ASC, id ASC
+            ) AS rn
+            FROM entities
+            WHERE type = 'task' AND is_deleted = 0 AND status != 'done'
+        ) AS ranked
+        WHERE entities.id = ranked.id
+        """
+    )
+    logging.info("Backfilled positions for %s active tasks", cur.rowcount)
+
+
+def _backfill_entity_closure(conn: sqlite3.Connection) -> None:
+    # The depth guard stops the walk on a parent_id cycle.
+    cur = conn.execute(
+        """
+        WITH RECURSIVE tree (ancestor, descendant, depth) AS (
+            SELECT id, id, 0 FROM entities
+            UNION ALL
+            SELECT tree.ancestor, e.id, tree.depth + 1
+            FROM tree JOIN entities e ON e.parent_id = tree.descendant
+            WHERE tree.depth < 64
+        )
+        INSERT OR IGNORE INTO entity_closure (ancestor, descendant, depth)
+        SELECT ancestor, descendant, depth FROM tree
+        """
+    )
+    logging.info("Backfilled %s entity closure rows", cur.rowcount)
+
+
+def _upgrade_entity_props(conn: sqlite3.Connection) -> None:
+    # Triggers from before internal keys were excluded are recreated by the
+    # DDL that follows; their bookkeeping rows are dropped once.
+    row = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'entity_props_au'"
+    ).fetchone()
+    if row is None or _INTERNAL_META_PATHS_SQL in row[0]:
+        return
+    conn.execute("DROP TRIGGER IF EXISTS entity_props_ai")
+    conn.execute("DROP TRIGGER IF EXISTS entity_props_au")
+    cur = conn.execute(f"DELETE FROM entity_props WHERE key IN ({_INTERNAL_META_KEYS_SQL})")
+    logging.info("Dropped %s internal meta properties from entity_props", cur.rowcount)
+
+
+def _upgrade_entity_changes(conn: sqlite3.Connection) -> None:
+    # The delete trigger from before archive moves were told apart is
+    # recreated by the DDL that follows.
+    row = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'entity_changes_ad'"
+    ).fetchone()
+    if row is not None and "'archive'" not in row[0]:
+        conn.execute("DROP TRIGGER entity_changes_ad")
+
+
+def _backfill_entity_props(conn: sqlite3.Connection) -> None:
+    cur = conn.execute(
+        _entity_props_insert_sql("e.id", "e.user_id", "e.meta", source="entities AS e,")
+    )
+    logging.info("Indexed %s meta properties", cur.rowcount)
+
+
+def _backfill_entity_tokens(conn: sqlite3.Connection) -> None:
+    rows = conn.execute(
+        """
+        SELECT id, user_id, title FROM entities
+        WHERE id NOT IN (SELECT entity_id FROM entity_tokens)
+        """
+    ).fetchall()
+    payload = [
+        (row[0], row[1], token)
+        for row in rows
+        for token in set(_semantic_tokenize(row[2] or ""))
+    ]
+    if payload:
+        conn.executemany(
+            "INSERT OR IGNORE INTO entity_tokens (entity_id, user_id, token) VALUES (?, ?, ?)",
+            payload,
+        )
+        logging.info("Indexed semantic tokens for %s entities", len(rows))
+
+
+def _table_exists(conn: sqlite3.Connection, name: str) -> bool:
+    row = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ? LIMIT 1",
+        (name,),
+    ).fetchone()
+    return row is not None
+
+
+def _create_fts_index(
+    conn: sqlite3.Connection,
+    name: str,
+    ddl: str,
+    triggers: Sequence[str],
+    backfill_sql: str,
+) -> bool:
+    created = not _table_exists(conn, name)
+    try:
+        conn.execute(ddl)
+    except sqlite3.OperationalError as exc:
+        logging.warning("Cannot create %s, falling back to table scans: %s", name, exc)
+        return False
+    for trigger in triggers:
+        conn.execute(trigger)
+    if created:
+        conn.execute(backfill_sql)
+        logging.info("Built %s index for entities", name)
+    return True
+
+
+def _migrate_search_index(conn: sqlite3.Connection) -> None:
+    _create_fts_index(
+        conn,
+        "entities_fts",
+        ENTITIES_FTS_DDL,
+        ENTITIES_FTS_TRIGGERS_DDL,
+        ENTITIES_FTS_BACKFILL_SQL,
+    )
+    _create_fts_index(
+        conn,
+        "entities_trigram",
+        ENTITIES_TRIGRAM_DDL,
+        ENTITIES_TRIGRAM_TRIGGERS_DDL,
+        ENTITIES_TRIGRAM_BACKFILL_SQL,
+    )
+
+
+def _init_schema(conn: sqlite3.Connection) -> None:
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(ENTITIES_DDL)
+        _migrate_entities(conn)
+        conn.execute("COMMIT")
+    except sqlite3.Error:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+def init_db() -> None:
+    """Create or migrate the schema; in sharding mode, of every existing shard."""
+
+    if sharding_enabled():
+        os.makedirs(DB_PATH, exist_ok=True)
+        for path in database_paths():
+            get_pool(path=path)
+        return
+    conn = get_conn()
+    try:
+        _init_schema(conn)
+    finally:
+        conn.close()
+
+# Tables copied verbatim by split_database; the FTS indexes are rebuilt by
+# the insert triggers on ``entities``.
+_SHARD_COPY_TABLES = (
+    ("entities_archive", ENTITY_ARCHIVE_COLUMNS),
+    ("entity_tokens", "entity_id, user_id, token"),
+    ("entity_embeddings", "entity_id, user_id, model, dim, vector"),
+    ("entity_versions", "user_id, version"),
+    ("entity_changes", "user_id, version, entity_id, op, fields, changed_at"),
+)
+
+
+def split_database(source_path: str, dest_dir: str | None = None) -> dict[str, int]:
+    """Copy a monolithic database into per-tenant shard files under ``dest_dir``.
+
+    Entity ids, positions, the archive, token/embedding indexes and the change
+    log are carried over unchanged.  Each shard is filled in one transaction;
+    shards that already hold rows for a user are skipped for that user, so
+    the split can be rerun after an interruption.  Returns users per shard.
+    """
+
+    dest_dir = dest_dir or DB_PATH
+    os.makedirs(dest_dir, exist_ok=True)
+    source = sqlite3.connect(f"file:{source_path}?mode=ro", uri=True)
+    try:
+        user_ids = [
+            row[0]
+            for row in source.execute(
+                "SELECT user_id FROM entities UNION SELECT user_id FROM entities_archive ORDER BY 1"
+            )
+        ]
+    finally:
+        source.close()
+    by_shard: dict[str, list[int]] = {}
+    for user_id in user_ids:
+        path = os.path.join(dest_dir, os.path.basename(shard_path(user_id)))
+        by_shard.setdefault(path, []).append(user_id)
+
+    for path, users in by_shard.items():
+        conn = sqlite3.connect(path)
+        try:
+            _configure_connection(conn, DB_BUSY_TIMEOUT_MS)
+            _init_schema(conn)
+            conn.execute("ATTACH DATABASE ? AS src", (f"file:{source_path}?mode=ro",))
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("CREATE TEMP TABLE split_users (user_id INTEGER PRIMARY KEY)")
+                conn.executemany(
+                    "INSERT INTO split_users (user_id) SELECT ? WHERE NOT EXISTS "
+                    "(SELECT 1 FROM main.entities WHERE user_id = ?)",
+                    [(user_id, user_id) for user_id in users],
+                )
+                scope = "user_id IN (SELECT user_id FROM temp.split_users)"
+                conn.execute(
+                    f"""
+                    INSERT INTO main.entities ({ENTITY_ARCHIVE_COLUMNS})
+                    SELECT {ENTITY_ARCHIVE_COLUMNS} FROM src.entities WHERE {scope} ORDER BY id
+                    """
+                )
+                conn.execute(
+                    f"""
+                    UPDATE main.entities
+                    SET position = (SELECT s.position FROM src.entities s WHERE s.id = entities.id)
+                    WHERE {scope}
+                    """
+                )
+                # Children re-parented under a newer entity were copied before
+                # their ancestors existed; fill in their closure rows.
+                _backfill_entity_closure(conn)
+                conn.execute(f"DELETE FROM main.entity_changes WHERE {scope}")
+                conn.execute(f"DELETE FROM main.entity_versions WHERE {scope}")
+                conn.execute(f"DELETE FROM main.entity_tokens WHERE {scope}")
+                for table, columns in _SHARD_COPY_TABLES:
+                    conn.execute(
+                        f"INSERT OR REPLACE INTO main.{table} ({columns}) "
+                        f"SELECT {columns} FROM src.{table} WHERE {scope}"
+                    )
+                conn.execute("DROP TABLE temp.split_users")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("DETACH DATABASE src")
+        finally:
+            conn.close()
+        logging.info("Split %s users into shard %s", len(users), path)
+    return {path: len(users) for path, users in by_shard.items()}
+
+
+def _get_or_create_list(conn: sqlite3.Connection, user_id: int, list_name: str) -> int | None:
+    existing_id = _get_list_id(conn, user_id, list_name)
+    if existing_id is not None:
+        logging.info("List '%s' already exists for user %s, ID: %s", list_name, user_id, existing_id)
+        return existing_id
+    try:
+        cur = conn.execute(
+            """
+            INSERT INTO entities (user_id, type, title)
+            VALUES (?, 'list', ?)
+            """,
+            (user_id, list_name),
+        )
+        list_id = cur.lastrowid
+        _index_entity_tokens(conn, list_id, user_id, list_name)
+        logging.info("Created list '%s' for user %s, ID: %s", list_name, user_id, list_id)
+        return list_id
+    except sqlite3.Error as exc:
+        logging.error("SQLite error in _get_or_create_list: %s", exc)
+        raise
+
+
+def create_list(
+    conn: sqlite3.Connection,
+    user_id: int,
+    list_name: str,
+    *,
+    force: bool = False,
+) -> CreationResult:
+    cleaned_name = (list_name or "").strip()
+    if not cleaned_name:
+        logging.info("Empty list name received for user %s", user_id)
+        return _creation_result(title=list_name)
+    try:
+        vector: list[float] | None = None
+        if not force:
+            vector = _embed_text(cleaned_name)
+            duplicate = _find_semantic_duplicate(
                 conn,
                 user_id,
                 cleaned_name,
                 "list",
+                vector=vector,
             )
             if duplicate:
                 duplicate_id, duplicate_title, score = duplicate
@@ -609,6 +2695,9 @@ def create_list(
             (user_id, cleaned_name),
         )
         list_id = cur.lastrowid
+        _index_entity_tokens(conn, list_id, user_id, cleaned_name)
+        if vector:
+            _store_embedding(conn, list_id, user_id, vector)
         logging.info(
             "Created list '%s' for user %s, ID: %s", cleaned_name, user_id, list_id
         )
@@ -650,6 +2739,7 @@ def rename_list(conn: sqlite3.Connection, user_id: int, old_name: str, new_name:
             "UPDATE entities SET title = ? WHERE id = ?",
             (new_name, list_id),
         )
+        _index_entity_tokens(conn, list_id, user_id, new_name)
         logging.info("Renamed list '%s' to '%s' for user %s", old_name, new_name, user_id)
         return 1
     except sqlite3.Error as exc:
@@ -681,7 +2771,7 @@ def get_all_lists(conn: sqlite3.Connection, user_id: int) -> list[str]:
             SELECT title
             FROM entities
             WHERE user_id = ? AND type = 'list'
-              AND (meta IS NULL OR json_extract(meta, '$.deleted') IS NOT TRUE)
+              AND is_deleted = 0
             ORDER BY title ASC
             """,
             (user_id,),
@@ -691,6 +2781,60 @@ def get_all_lists(conn: sqlite3.Connection, user_id: int) -> list[str]:
         logging.error("SQLite error in get_all_lists: %s", exc)
         return []
 
+
+def get_user_snapshot(conn: sqlite3.Connection, user_id: int) -> list[ListSnapshot]:
+    """Return every live list of the user with its active tasks in one query.
+
+    Tasks use the same ``(index, title, meta, id)`` shape as
+    :func:`get_list_tasks`; lists are ordered like :func:`get_all_lists`.
+    """
+
+    try:
+        cur = conn.execute(
+            """
+            SELECT l.id AS list_id, l.title AS list_title, l.meta AS list_meta,
+                   t.id AS task_id, t.title AS task_title, t.meta AS task_meta
+            FROM entities l
+            LEFT JOIN entities t
+              ON t.user_id = l.user_id AND t.type = 'task' AND t.parent_id = l.id
+             AND t.is_deleted = 0 AND t.status != 'done'
+            WHERE l.user_id = ? AND l.type = 'list'
+              AND l.is_deleted = 0
+            ORDER BY l.title ASC, l.id ASC, t.position ASC, t.id ASC
+            """,
+            (user_id,),
+        )
+        snapshot: list[ListSnapshot] = []
+        current: ListSnapshot | None = None
+        for row in cur.fetchall():
+            if current is None or current["id"] != row["list_id"]:
+                current = {
+                    "id": row["list_id"],
+                    "title": row["list_title"],
+                    "meta": _load_meta(row["list_meta"], row["list_id"]),
+                    "tasks": [],
+                }
+                snapshot.append(current)
+            if row["task_id"] is not None:
+                current["tasks"].append(
+                    (
+                        len(current["tasks"]) + 1,
+                        row["task_title"],
+                        _load_meta(row["task_meta"], row["task_id"]),
+                        row["task_id"],
+                    )
+                )
+        logging.info(
+            "Loaded snapshot of %s lists / %s tasks for user %s",
+            len(snapshot),
+            sum(len(item["tasks"]) for item in snapshot),
+            user_id,
+        )
+        return snapshot
+    except sqlite3.Error as exc:
+        logging.error("SQLite error in get_user_snapshot: %s", exc)
+        return []
+
 def add_task(
     conn: sqlite3.Connection,
     user_id: int,
@@ -699,112 +2843,213 @@ def add_task(
     *,
     force: bool = False,
 ) -> CreationResult:
+    return add_tasks(conn, user_id, list_name, [title], force=force)[0]
+
+
+def add_tasks(
+    conn: sqlite3.Connection,
+    user_id: int,
+    list_name: str,
+    titles: Sequence[str],
+    *,
+    force: bool = False,
+    stop_on_duplicate: bool = False,
+    vectors: Sequence[list[float] | None] | None = None,
+) -> list[CreationResult]:
+    """Add several tasks to one list in a single write transaction.
+
+    The list, its existing titles and their embeddings (or token sets) are
+    loaded once.
+    Each title is checked against the list and against the titles before
+    it in the batch.  With ``stop_on_duplicate`` processing ends at the
+    first unforced duplicate, so later titles are left untouched and get
+    no result.  ``vectors`` holds the title embeddings, computed by the
+    caller before the transaction; without it each title is embedded here.
+    """
+
     list_row = find_list(conn, user_id, list_name)
     if not list_row:
         logging.info(
-            "Cannot add task '%s': list '%s' not found for user %s",
-            title,
+            "Cannot add tasks %s: list '%s' not found for user %s",
+            list(titles),
             list_name,
             user_id,
         )
-        return _creation_result(title=title, missing_parent=True)
+        return [_creation_result(title=title, missing_parent=True) for title in titles]
     list_id = list_row["id"] if isinstance(list_row, sqlite3.Row) else list_row[0]
-    existing_task = _get_task_row(conn, user_id, list_id, title)
-    if existing_task:
-        stored_title = existing_task["title"]
-        meta = _load_meta(existing_task["meta"])
-        logging.info(
-            "Found existing task '%s' in list '%s' for user %s with meta: %s",
-            stored_title,
-            list_name,
-            user_id,
-            meta,
-        )
-        changed = False
-        if meta.pop("deleted", None):
-            changed = True
-        if meta.get("status") == "done":
-            meta.pop("status", None)
-            changed = True
-        if changed:
-            conn.execute(
-                "UPDATE entities SET meta = ? WHERE id = ?",
-                (_dump_meta(meta), existing_task["id"]),
-            )
-            logging.info(
-                "Restored task '%s' in list '%s' for user %s",
-                stored_title,
-                list_name,
-                user_id,
-            )
-            return _creation_result(
-                entity_id=existing_task["id"],
-                title=stored_title,
-                restored=True,
-            )
-        score = semantic_similarity(title, stored_title)
-        if score < 1.0:
-            score = 1.0
-        _log_semantic_match(title, stored_title, score)
-        logging.info(
-            "Task '%s' already exists and is not done in list '%s' for user %s",
-            stored_title,
-            list_name,
-            user_id,
-        )
-        return _creation_result(
-            entity_id=existing_task["id"],
-            title=stored_title,
-            duplicate_detected=True,
-            duplicate_id=existing_task["id"],
-            duplicate_title=stored_title,
-            similarity=1.0,
-            auto_use=True,
-        )
-    if not force:
-        duplicate = _find_semantic_duplicate(
-            conn,
-            user_id,
-            title,
-            "task",
-            parent_id=list_id,
-        )
-        if duplicate:
-            duplicate_id, duplicate_title, score = duplicate
+    existing: dict[str, sqlite3.Row] = {}
+    for row in conn.execute(
+        "SELECT id, title, meta FROM entities WHERE user_id = ? AND type = 'task' AND parent_id = ?",
+        (user_id, list_id),
+    ):
+        existing.setdefault((row["title"] or "").strip().lower(), row)
+
+    results: list[CreationResult] = []
+    restores: list[tuple[str | None, int]] = []
+    # New titles are inserted after the loop; until then duplicates of them
+    # refer to their position in ``pending`` through a negative id.
+    pending: list[tuple[str, list[float] | None, set[str]]] = []
+    pending_keys: dict[str, int] = {}
+    embedding_candidates: _EmbeddingCandidates | None = None
+    token_candidates: list[tuple[int, str, set[str]]] | None = None
+
+    for index, title in enumerate(titles):
+        cleaned = (title or "").strip()
+        key = cleaned.lower()
+        if not cleaned:
+            results.append(_creation_result(title=title))
+            continue
+        existing_task = existing.get(key)
+        if existing_task is not None:
+            stored_title = existing_task["title"]
+            meta = _load_meta(existing_task["meta"])
+            changed = bool(meta.pop("deleted", None))
+            if meta.get("status") == "done":
+                meta.pop("status", None)
+                changed = True
+            if changed:
+                restores.append((_dump_meta(_clear_history_stamps(meta)), existing_task["id"]))
+                logging.info(
+                    "Restored task '%s' in list '%s' for user %s",
+                    stored_title,
+                    list_name,
+                    user_id,
+                )
+                results.append(
+                    _creation_result(entity_id=existing_task["id"], title=stored_title, restored=True)
+                )
+                continue
+            _log_semantic_match(cleaned, stored_title, 1.0)
+            match: tuple[int, str, float] | None = (existing_task["id"], stored_title, 1.0)
+        elif key in pending_keys:
+            match = (-pending_keys[key] - 1, pending[pending_keys[key]][0], 1.0)
+        else:
+            match = None
+        vector: list[float] | None = None
+        tokens = set(_semantic_tokenize(cleaned))
+        if match is None and not force:
+            vector = _embed_text(cleaned) if vectors is None else vectors[index]
+            if vector:
+                if embedding_candidates is None:
+                    embedding_candidates = _load_embedding_candidates(
+                        conn, user_id, "task", list_id, len(vector)
+                    )
+                    for idx, (pending_title, pending_vector, _) in enumerate(pending):
+                        embedding_candidates.add(-idx - 1, pending_title, pending_vector)
+                scored = embedding_candidates.score(cleaned, vector)
+            else:
+                if token_candidates is None:
+                    token_candidates = _load_token_candidates(conn, user_id, "task", list_id)
+                    token_candidates.extend(
+                        (-idx - 1, pending_title, pending_tokens)
+                        for idx, (pending_title, _, pending_tokens) in enumerate(pending)
+                    )
+                scored = [
+                    (other_id, other_title, len(tokens & other) / len(tokens | other))
+                    for other_id, other_title, other in token_candidates
+                    if tokens & other
+                ]
+            match = _best_semantic_match(cleaned, scored, 0.83)
+        if match is not None:
+            duplicate_id, duplicate_title, score = match
             logging.info(
-                "Semantic duplicate detected for task '%s' -> '%s' (%.2f) in list '%s' for user %s",
-                title,
+                "Duplicate detected for task '%s' -> '%s' (%.2f) in list '%s' for user %s",
+                cleaned,
                 duplicate_title,
                 score,
                 list_name,
                 user_id,
             )
-            return _creation_result(
-                entity_id=duplicate_id,
-                title=duplicate_title,
-                duplicate_detected=True,
-                duplicate_id=duplicate_id,
-                duplicate_title=duplicate_title,
-                similarity=score,
-                auto_use=score >= 0.85,
+            results.append(
+                _creation_result(
+                    entity_id=duplicate_id,
+                    title=duplicate_title,
+                    duplicate_detected=True,
+                    duplicate_id=duplicate_id,
+                    duplicate_title=duplicate_title,
+                    similarity=score,
+                    auto_use=score >= 0.85,
+                )
             )
+            if stop_on_duplicate and not force:
+                break
+            continue
+        pending_keys[key] = len(pending)
+        pending.append((cleaned, vector, tokens))
+        if vector and embedding_candidates is not None:
+            embedding_candidates.add(-len(pending), cleaned, vector)
+        if token_candidates is not None:
+            token_candidates.append((-len(pending), cleaned, tokens))
+        results.append(_creation_result(entity_id=-len(pending), title=cleaned, created=True))
+
     try:
-        cur = conn.execute(
-            "INSERT INTO entities (user_id, type, title, parent_id) VALUES (?, 'task', ?, ?)",
-            (user_id, title, list_id),
-        )
-        task_id = cur.lastrowid
-        logging.info("Added new task '%s' to list '%s' for user %s", title, list_name, user_id)
-        return _creation_result(entity_id=task_id, title=title, created=True)
+        with _savepoint(conn, "add_tasks"):
+            if restores:
+                conn.executemany("UPDATE entities SET meta = ? WHERE id = ?", restores)
+            new_ids: dict[str, int] = {}
+            if pending:
+                conn.executemany(
+                    "INSERT INTO entities (user_id, type, title, parent_id) VALUES (?, 'task', ?, ?)",
+                    [(user_id, pending_title, list_id) for pending_title, _, _ in pending],
+                )
+                placeholders = ", ".join("?" for _ in pending)
+                new_ids = {
+                    row["title"]: row["id"]
+                    for row in conn.execute(
+                        f"""
+                        SELECT id, title FROM entities
+                        WHERE user_id = ? AND type = 'task' AND parent_id = ?
+                          AND title IN ({placeholders})
+                        """,
+                        (user_id, list_id, *(pending_title for pending_title, _, _ in pending)),
+                    )
+                }
+                conn.executemany(
+                    "INSERT OR IGNORE INTO entity_tokens (entity_id, user_id, token) VALUES (?, ?, ?)",
+                    [
+                        (new_ids[pending_title], user_id, token)
+                        for pending_title, _, tokens in pending
+                        for token in tokens
+                    ],
+                )
+                conn.executemany(
+                    """
+                    INSERT OR REPLACE INTO entity_embeddings (entity_id, user_id, model, dim, vector)
+                    VALUES (?, ?, ?, ?, ?)
+                    """,
+                    [
+                        (new_ids[pending_title], user_id, _embedding_model, len(vector), _pack_vector(vector))
+                        for pending_title, vector, _ in pending
+                        if vector
+                    ],
+                )
     except sqlite3.IntegrityError as exc:
         logging.error(
-            "IntegrityError: Failed to add task '%s' to list '%s' for user %s: %s",
-            title,
+            "IntegrityError: Failed to add tasks %s to list '%s' for user %s: %s",
+            [pending_title for pending_title, _, _ in pending],
             list_name,
             user_id,
             exc,
         )
-        return _creation_result(title=title)
+        failed: list[CreationResult] = []
+        for result in results:
+            written = result.get("created") or result.get("restored")
+            if written or (result.get("id") or 0) < 0:
+                result = _creation_result(title=result["title"])
+            failed.append(result)
+        return failed
+
+    for result in results:
+        if result.get("id") is not None and result["id"] < 0:
+            result["id"] = new_ids[pending[-result["id"] - 1][0]]
+        if result.get("duplicate_id") is not None and result["duplicate_id"] < 0:
+            result["duplicate_id"] = result["id"]
+        if result.get("created"):
+            logging.info(
+                "Added new task '%s' to list '%s' for user %s", result["title"], list_name, user_id
+            )
+    return results
+
 
 def update_task(conn: sqlite3.Connection, user_id: int, list_name: str, old_title: str, new_title: str) -> int:
     try:
@@ -819,6 +3064,7 @@ def update_task(conn: sqlite3.Connection, user_id: int, list_name: str, old_titl
             logging.info("Task '%s' already exists in list '%s' for user %s", new_title, list_name, user_id)
             return 0
         conn.execute("UPDATE entities SET title = ? WHERE id = ?", (new_title, task_row["id"]))
+        _index_entity_tokens(conn, task_row["id"], user_id, new_title)
         logging.info(
             "Updated task '%s' to '%s' in list '%s' for user %s",
             old_title,
@@ -843,16 +3089,16 @@ def update_task_by_index(
         list_id = _get_list_id(conn, user_id, list_name)
         if list_id is None:
             return 0, None
-        tasks = _list_active_tasks(conn, user_id, list_id)
-        if not tasks or index < 1 or index > len(tasks):
+        chosen = _task_at_index(conn, user_id, list_id, int(index))
+        if chosen is None:
             logging.info("Invalid index %s for list '%s' for user %s", index, list_name, user_id)
             return 0, None
-        chosen = tasks[index - 1]
         task_id, old_title = chosen["id"], chosen["title"]
         if _get_task_row(conn, user_id, list_id, new_title):
             logging.info("Task '%s' already exists in list '%s' for user %s", new_title, list_name, user_id)
             return 0, None
         conn.execute("UPDATE entities SET title = ? WHERE id = ?", (new_title, task_id))
+        _index_entity_tokens(conn, task_id, user_id, new_title)
         logging.info(
             "Updated task '%s' to '%s' by index %s in list '%s' for user %s",
             old_title,
@@ -875,7 +3121,7 @@ def get_list_tasks(
             return []
         tasks = _list_active_tasks(conn, user_id, list_id)
         results = [
-            (idx + 1, row["title"], _load_meta(row["meta"]), row["id"])
+            (idx + 1, row["title"], _load_meta(row["meta"], row["id"]), row["id"])
             for idx, row in enumerate(tasks)
         ]
         logging.info("Retrieved %s tasks for list '%s' for user %s", len(results), list_name, user_id)
@@ -903,14 +3149,8 @@ def mark_task_done(conn: sqlite3.Connection, user_id: int, list_name: str, task_
                 user_id,
             )
             return 0
-        chosen_id, chosen_title, meta_text = chosen
-        meta = _load_meta(meta_text)
-        meta["status"] = "done"
-        meta.pop("deleted", None)
-        conn.execute(
-            "UPDATE entities SET meta = ? WHERE id = ?",
-            (_dump_meta(meta), chosen_id),
-        )
+        chosen_id, chosen_title, _ = chosen
+        conn.execute(_MARK_DONE_SQL, (_utc_timestamp(), chosen_id))
         logging.info("Marked task '%s' as done in list '%s' for user %s", chosen_title, list_name, user_id)
         return 1
     except sqlite3.Error as exc:
@@ -935,10 +3175,7 @@ def mark_task_done_fuzzy(
         list_id = _get_list_id(conn, user_id, list_name)
         if list_id is None:
             return 0, None
-        candidates = [
-            (row["id"], row["title"], row["meta"])
-            for row in _list_active_tasks(conn, user_id, list_id)
-        ]
+        candidates = _fuzzy_candidates(conn, user_id, list_id, cleaned)
         if not candidates:
             logging.info("No tasks found in list '%s' for user %s", list_name, user_id)
             return 0, None
@@ -946,65 +3183,130 @@ def mark_task_done_fuzzy(
         if not chosen:
             logging.info("No close match for pattern '%s' in list '%s' for user %s", cleaned, list_name, user_id)
             return 0, None
-        chosen_id, chosen_title, meta_text = chosen
-        meta = _load_meta(meta_text)
-        meta["status"] = "done"
-        meta.pop("deleted", None)
-        conn.execute(
-            "UPDATE entities SET meta = ? WHERE id = ?",
-            (_dump_meta(meta), chosen_id),
-        )
+        chosen_id, chosen_title, _ = chosen
+        conn.execute(_MARK_DONE_SQL, (_utc_timestamp(), chosen_id))
         logging.info("Fuzzy marked task '%s' as done in list '%s' for user %s", chosen_title, list_name, user_id)
         return 1, chosen_title
     except sqlite3.Error as exc:
         logging.error("SQLite error in mark_task_done_fuzzy: %s", exc)
         return 0, None
 
-def delete_list(conn: sqlite3.Connection, user_id: int, list_name: str) -> int:
+
+def mark_tasks_done_bulk(
+    conn: sqlite3.Connection,
+    user_id: int,
+    list_name: str,
+    patterns: Sequence[str],
+) -> list[str | None]:
+    """Mark the tasks matching ``patterns`` as done in one transaction.
+
+    Returns the matched title for each pattern (``None`` when nothing matched).
+    Candidates are loaded once and assigned greedily by score, so two phrases
+    never complete the same task.
+    """
+
+    matched: list[str | None] = [None] * len(patterns)
     try:
-        cur = conn.execute(
-            """
-            SELECT id, meta FROM entities
-            WHERE user_id = ? AND type = 'list' AND title = ?
-            LIMIT 1
-            """,
-            (user_id, list_name),
+        list_id = _get_list_id(conn, user_id, list_name)
+        if list_id is None:
+            return matched
+        candidates = [
+            (row["id"], row["title"], row["meta"])
+            for row in _list_active_tasks(conn, user_id, list_id)
+        ]
+        if not candidates:
+            logging.info("No active tasks found in list '%s' for user %s", list_name, user_id)
+            return matched
+        chosen = _assign_patterns(patterns, candidates)
+        if not chosen:
+            logging.info("No close match for %d patterns in list '%s' for user %s", len(patterns), list_name, user_id)
+            return matched
+        completed_at = _utc_timestamp()
+        updates = []
+        for index, (cand_id, cand_title, _) in chosen.items():
+            updates.append((completed_at, cand_id))
+            matched[index] = cand_title
+        with _savepoint(conn, "mark_tasks_done"):
+            conn.executemany(_MARK_DONE_SQL, updates)
+        logging.info(
+            "Marked %d tasks as done in list '%s' for user %s", len(updates), list_name, user_id
         )
-        row = cur.fetchone()
-        if not row:
+        return matched
+    except sqlite3.Error as exc:
+        logging.error("SQLite error in mark_tasks_done_bulk: %s", exc)
+        return [None] * len(patterns)
+
+
+def delete_list(conn: sqlite3.Connection, user_id: int, list_name: str) -> int:
+    try:
+        row = _find_list_row(conn, user_id, list_name)
+        if row is None:
             logging.info("No list '%s' found for user %s", list_name, user_id)
             return 0
-        list_id = row["id"]
-        list_meta = _load_meta(row["meta"])
-        list_meta["deleted"] = True
-        conn.execute(
-            "UPDATE entities SET meta = ? WHERE id = ?",
-            (_dump_meta(list_meta), list_id),
-        )
-        task_rows = conn.execute(
-            """
-            SELECT id, meta
-            FROM entities
-            WHERE user_id = ? AND type = 'task' AND parent_id = ?
-            """,
-            (user_id, list_id),
-        ).fetchall()
-        for task_row in task_rows:
-            task_meta = _load_meta(task_row["meta"])
-            task_meta.pop("deleted", None)
-            task_meta["archived"] = True
-            if list_name:
-                task_meta["archived_from"] = list_name
+        list_id, title = row
+        with _savepoint(conn, "delete_list"):
+            conn.execute(_MARK_DELETED_SQL, (_utc_timestamp(), list_id))
+            archived = conn.execute(
+                f"""
+                UPDATE entities
+                SET meta = json_set(
+                    json_remove({_VALID_META_SQL}, '$.deleted', '$.deleted_at'),
+                    '$.archived', json('true'),
+                    '$.archived_from', ?
+                )
+                WHERE user_id = ? AND id IN (
+                    SELECT descendant FROM entity_closure WHERE ancestor = ? AND depth > 0
+                )
+                """,
+                (title, user_id, list_id),
+            ).rowcount
+        logging.info("Deleted list '%s' with %d archived entities for user %s", title, archived, user_id)
+        return 1
+    except sqlite3.Error as exc:
+        logging.error("SQLite error in delete_list: %s", exc)
+        return 0
+
+
+def restore_list(conn: sqlite3.Connection, user_id: int, list_name: str) -> int:
+    """Undo ``delete_list``: revive the list and un-archive the subtree it archived."""
+
+    try:
+        if _get_list_id(conn, user_id, list_name) is not None:
+            logging.info("List '%s' is already active for user %s", list_name, user_id)
+            return 0
+        row = _find_list_row(conn, user_id, list_name, deleted=True)
+        if row is None:
+            logging.info("No deleted list '%s' found for user %s", list_name, user_id)
+            return 0
+        list_id, title = row
+        with _savepoint(conn, "restore_list"):
             conn.execute(
-                "UPDATE entities SET meta = ? WHERE id = ?",
-                (_dump_meta(task_meta), task_row["id"]),
+                f"UPDATE entities SET meta = json_remove({_VALID_META_SQL}, '$.deleted', '$.deleted_at') "
+                "WHERE id = ?",
+                (list_id,),
             )
-        logging.info("Deleted list '%s' for user %s", list_name, user_id)
+            restored = conn.execute(
+                f"""
+                UPDATE entities
+                SET meta = json_remove({_VALID_META_SQL}, '$.archived', '$.archived_from')
+                WHERE user_id = ? AND id IN (
+                    SELECT descendant FROM entity_closure WHERE ancestor = ? AND depth > 0
+                )
+                  AND is_archived = 1
+                  AND (
+                        json_extract(meta, '$.archived_from') IS NULL
+                     OR LOWER(json_extract(meta, '$.archived_from')) = LOWER(?)
+                  )
+                """,
+                (user_id, list_id, title),
+            ).rowcount
+        logging.info("Restored list '%s' with %d entities for user %s", title, restored, user_id)
         return 1
     except sqlite3.Error as exc:
-        logging.error("SQLite error in delete_list: %s", exc)
+        logging.error("SQLite error in restore_list: %s", exc)
         return 0
 
+
 def delete_task(conn: sqlite3.Connection, user_id: int, list_name: str, task_title: str) -> int:
     try:
         list_id = _get_list_id(conn, user_id, list_name)
@@ -1014,21 +3316,22 @@ def delete_task(conn: sqlite3.Connection, user_id: int, list_name: str, task_tit
         if not task_row:
             logging.info("No task '%s' found in list '%s' for user %s", task_title, list_name, user_id)
             return 0
-        meta = _load_meta(task_row["meta"])
+        meta = _load_meta(task_row["meta"], task_row["id"])
         if meta.get("status") == "done":
             logging.info("Task '%s' is already done in list '%s' for user %s", task_title, list_name, user_id)
             return 0
-        meta["deleted"] = True
-        conn.execute(
-            "UPDATE entities SET meta = ? WHERE id = ?",
-            (_dump_meta(meta), task_row["id"]),
-        )
+        conn.execute(_MARK_DELETED_SQL, (_utc_timestamp(), task_row["id"]))
         logging.info("Deleted task '%s' from list '%s' for user %s", task_title, list_name, user_id)
         return 1
     except sqlite3.Error as exc:
         logging.error("SQLite error in delete_task: %s", exc)
         return 0
 
+
+def _restore_suggestion(list_name: str, task_title: str) -> str:
+    return f"Список «{list_name}» удалён. Создай новый список и скажи, куда вернуть задачу «{task_title}»."
+
+
 def _suggest_new_list_for_restore(
     conn: sqlite3.Connection, user_id: int, list_name: str, task_title: str
 ) -> str | None:
@@ -1039,7 +3342,7 @@ def _suggest_new_list_for_restore(
             FROM entities
             WHERE user_id = ? AND type = 'task'
               AND LOWER(title) = LOWER(?)
-              AND json_extract(meta, '$.archived') = true
+              AND is_archived = 1
               AND (
                     json_extract(meta, '$.archived_from') IS NULL
                  OR LOWER(json_extract(meta, '$.archived_from')) = LOWER(?)
@@ -1049,9 +3352,7 @@ def _suggest_new_list_for_restore(
             (user_id, task_title, list_name),
         )
         if cur.fetchone():
-            return (
-                f"Список «{list_name}» удалён. Создай новый список и скажи, куда вернуть задачу «{task_title}»."
-            )
+            return _restore_suggestion(list_name, task_title)
         return None
     except sqlite3.Error as exc:
         logging.error("SQLite error in _suggest_new_list_for_restore: %s", exc)
@@ -1108,10 +3409,13 @@ def restore_task(
                 user_id,
             )
             return 0, None, None
-        conn.execute(
-            "UPDATE entities SET meta = ? WHERE id = ?",
-            (_dump_meta(meta), chosen_id),
-        )
+        _clear_history_stamps(meta)
+        with _savepoint(conn, "restore_task"):
+            _unarchive_entity(conn, chosen_id)
+            conn.execute(
+                "UPDATE entities SET meta = ? WHERE id = ?",
+                (_dump_meta(meta), chosen_id),
+            )
         logging.info("Restored task '%s' in list '%s' for user %s", chosen_title, list_name, user_id)
         return 1, chosen_title, None
     except sqlite3.Error as exc:
@@ -1142,10 +3446,7 @@ def restore_task_fuzzy(
             else:
                 logging.info("No list '%s' found for fuzzy restore for user %s", list_name, user_id)
             return 0, None, suggestion
-        candidates = [
-            (row["id"], row["title"], row["meta"])
-            for row in _list_restorable_tasks(conn, user_id, list_id)
-        ]
+        candidates = _fuzzy_candidates(conn, user_id, list_id, cleaned, restorable=True)
         if not candidates:
             logging.info("No deleted tasks found in list '%s' for user %s", list_name, user_id)
             return 0, None, None
@@ -1177,15 +3478,148 @@ def restore_task_fuzzy(
                 user_id,
             )
             return 0, None, None
-        conn.execute(
-            "UPDATE entities SET meta = ? WHERE id = ?",
-            (_dump_meta(meta), chosen_id),
-        )
+        _clear_history_stamps(meta)
+        with _savepoint(conn, "restore_task"):
+            _unarchive_entity(conn, chosen_id)
+            conn.execute(
+                "UPDATE entities SET meta = ? WHERE id = ?",
+                (_dump_meta(meta), chosen_id),
+            )
         logging.info("Fuzzy restored task '%s' in list '%s' for user %s", chosen_title, list_name, user_id)
         return 1, chosen_title, None
     except sqlite3.Error as exc:
-        logging.error("SQLite error in restore_task_fuzzy: %s", exc)
-        return 0, None, None
+        logging.error("SQLite error in restore_task_fuzzy: %s", exc)
+        return 0, None, None
+
+
+def _unarchive_entity(conn: sqlite3.Connection, entity_id: int) -> bool:
+    """Move an entity back from ``entities_archive``; no-op for live rows."""
+
+    cur = conn.execute(
+        f"""
+        INSERT INTO entities ({ENTITY_ARCHIVE_COLUMNS})
+        SELECT {ENTITY_ARCHIVE_COLUMNS} FROM entities_archive WHERE id = ?
+        """,
+        (entity_id,),
+    )
+    if cur.rowcount <= 0:
+        return False
+    conn.execute("DELETE FROM entities_archive WHERE id = ?", (entity_id,))
+    row = conn.execute("SELECT user_id, title FROM entities WHERE id = ?", (entity_id,)).fetchone()
+    _index_entity_tokens(conn, entity_id, row["user_id"], row["title"] or "")
+    logging.info("Moved entity %s back from archive", entity_id)
+    return True
+
+
+def compact_entities(
+    conn: sqlite3.Connection,
+    older_than_days: int = DB_ARCHIVE_AFTER_DAYS,
+    *,
+    change_log_days: int = DB_CHANGE_LOG_RETENTION_DAYS,
+) -> int:
+    """Move tasks done or deleted more than ``older_than_days`` ago into ``entities_archive``.
+
+    Tasks with descendants move only together with their whole subtree.
+    Runs as one transaction; delete triggers drop the moved rows from the
+    search, token and embedding indexes and log them with op ``archive``.
+    Change-log entries older than ``change_log_days``
+    (``DB_CHANGE_LOG_RETENTION_DAYS``) are pruned; clients that synced
+    before that fall back to a full read.  Returns the number of moved tasks.
+    """
+
+    eligible = """
+        {e}.type = 'task'
+        AND (
+              ({e}.status = 'done' AND {e}.completed_at < datetime('now', :cutoff))
+           OR ({e}.is_deleted = 1 AND {e}.deleted_at < datetime('now', :cutoff))
+        )
+    """
+    # A task only moves together with its whole subtree: any descendant that
+    # is not itself due for archiving keeps it (and its ancestors) in place.
+    predicate = eligible.format(e="entities") + f"""
+        AND NOT EXISTS (
+            SELECT 1 FROM entity_closure c
+            JOIN entities d ON d.id = c.descendant
+            WHERE c.ancestor = entities.id AND c.depth > 0
+              AND NOT IFNULL(({eligible.format(e="d")}), 0)
+        )
+    """
+    params = {"cutoff": f"-{int(older_than_days)} days"}
+    try:
+        with _savepoint(conn, "compact_entities"):
+            moved = conn.execute(
+                f"""
+                INSERT OR REPLACE INTO entities_archive ({ENTITY_ARCHIVE_COLUMNS})
+                SELECT {ENTITY_ARCHIVE_COLUMNS} FROM entities WHERE {predicate}
+                """,
+                params,
+            ).rowcount
+            if moved:
+                conn.execute(f"DELETE FROM entities WHERE {predicate}", params)
+            conn.execute(
+                "DELETE FROM entity_changes WHERE changed_at < datetime('now', ?)",
+                (f"-{int(change_log_days)} days",),
+            )
+        logging.info("Compacted %s tasks older than %s days into archive", moved, older_than_days)
+        return moved
+    except sqlite3.Error as exc:
+        logging.error("SQLite error in compact_entities: %s", exc)
+        return 0
+
+
+def get_user_version(conn: sqlite3.Connection, user_id: int) -> int:
+    """Current change-log version for ``user_id`` (0 before the first mutation)."""
+
+    try:
+        row = conn.execute(
+            "SELECT version FROM entity_versions WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return row["version"] if row else 0
+    except sqlite3.Error as exc:
+        logging.error("SQLite error in get_user_version: %s", exc)
+        return 0
+
+
+def get_changes_since(
+    conn: sqlite3.Connection, user_id: int, version: int
+) -> list[EntityChange] | None:
+    """Changes made after ``version``, oldest first.
+
+    Returns ``None`` when the log no longer covers ``version`` (pruned
+    entries or an unknown version); the caller should then do a full read.
+    """
+
+    try:
+        current = get_user_version(conn, user_id)
+        if version > current:
+            return None
+        if version == current:
+            return []
+        rows = conn.execute(
+            """
+            SELECT version, entity_id, op, fields, changed_at
+            FROM entity_changes
+            WHERE user_id = ? AND version > ?
+            ORDER BY version ASC
+            """,
+            (user_id, version),
+        ).fetchall()
+        if not rows or rows[0]["version"] != version + 1:
+            return None
+        return [
+            {
+                "version": row["version"],
+                "entity_id": row["entity_id"],
+                "op": row["op"],
+                "fields": row["fields"].split(",") if row["fields"] else [],
+                "changed_at": row["changed_at"],
+            }
+            for row in rows
+        ]
+    except sqlite3.Error as exc:
+        logging.error("SQLite error in get_changes_since: %s", exc)
+        return None
+
 
 def get_completed_tasks(conn: sqlite3.Connection, user_id: int, limit: int = 15) -> list[tuple[str, str]]:
     try:
@@ -1193,36 +3627,47 @@ def get_completed_tasks(conn: sqlite3.Connection, user_id: int, limit: int = 15)
             SELECT
                 e.title AS task_title,
                 CASE
-                    WHEN json_extract(e.meta, '$.archived') = true
+                    WHEN e.is_archived = 1
                          OR l.id IS NULL
-                         OR json_extract(l.meta, '$.deleted') = true
+                         OR l.is_deleted = 1
                     THEN 1
                     ELSE 0
                 END AS archived_flag,
                 CASE
-                    WHEN json_extract(e.meta, '$.archived') = true
+                    WHEN e.is_archived = 1
                          OR l.id IS NULL
-                         OR json_extract(l.meta, '$.deleted') = true
+                         OR l.is_deleted = 1
                     THEN COALESCE(json_extract(e.meta, '$.archived_from'), l.title)
                     ELSE l.title
                 END AS source_title
-            FROM entities e
-            LEFT JOIN entities l ON l.id = e.parent_id AND l.type = 'list'
-            WHERE e.user_id = ?
-              AND e.type = 'task'
-              AND (
-                    json_extract(e.meta, '$.status') = 'done'
-                 OR json_extract(e.meta, '$.done') = true
+            FROM (
+                SELECT * FROM (
+                    SELECT id, title, meta, parent_id, is_archived, completed_at
+                    FROM entities
+                    WHERE user_id = ? AND type = 'task' AND is_deleted = 0 AND status = 'done'
+                    ORDER BY completed_at DESC, id DESC
+                    LIMIT ?
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT id, title, meta, parent_id, is_archived, completed_at
+                    FROM entities_archive
+                    WHERE user_id = ? AND type = 'task' AND is_deleted = 0 AND status = 'done'
+                    ORDER BY completed_at DESC, id DESC
+                    LIMIT ?
                 )
-              AND (json_extract(e.meta, '$.deleted') IS NULL OR json_extract(e.meta, '$.deleted') IS NOT TRUE)
-            ORDER BY COALESCE(json_extract(e.meta, '$.completed_at'), e.created_at) DESC
+            ) e
+            LEFT JOIN entities l ON l.id = e.parent_id AND l.type = 'list'
+            ORDER BY e.completed_at DESC, e.id DESC
             LIMIT ?
         """
-        _trace_sql(
-            "get_completed_tasks query | params=%s | %s"
-            % (str((user_id, limit)), " ".join(line.strip() for line in query.strip().splitlines()))
-        )
-        cur = conn.execute(query, (user_id, limit))
+        params = (user_id, limit, user_id, limit, limit)
+        if DB_TRACE_SQL:
+            _trace_sql(
+                "get_completed_tasks query | params=%s | %s"
+                % (str(params), " ".join(line.strip() for line in query.strip().splitlines()))
+            )
+        cur = conn.execute(query, params)
         tasks: list[tuple[str, str]] = []
         for row in cur.fetchall():
             archived_flag = row["archived_flag"] if isinstance(row, sqlite3.Row) else row[1]
@@ -1247,15 +3692,28 @@ def get_deleted_tasks(conn: sqlite3.Connection, user_id: int, limit: int = 15) -
         cur = conn.execute(
             """
             SELECT l.title AS list_title, e.title AS task_title
-            FROM entities e
+            FROM (
+                SELECT * FROM (
+                    SELECT id, title, parent_id, deleted_at
+                    FROM entities
+                    WHERE user_id = ? AND type = 'task' AND is_deleted = 1
+                    ORDER BY deleted_at DESC, id DESC
+                    LIMIT ?
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT id, title, parent_id, deleted_at
+                    FROM entities_archive
+                    WHERE user_id = ? AND type = 'task' AND is_deleted = 1
+                    ORDER BY deleted_at DESC, id DESC
+                    LIMIT ?
+                )
+            ) e
             LEFT JOIN entities l ON l.id = e.parent_id
-            WHERE e.user_id = ?
-              AND e.type = 'task'
-              AND json_extract(e.meta, '$.deleted') = true
-            ORDER BY e.created_at DESC
+            ORDER BY e.deleted_at DESC, e.id DESC
             LIMIT ?
             """,
-            (user_id, limit),
+            (user_id, limit, user_id, limit, limit),
         )
         tasks = [(row["list_title"], row["task_title"]) for row in cur.fetchall()]
         logging.info("Retrieved %s deleted tasks for user %s", len(tasks), user_id)
@@ -1264,25 +3722,53 @@ def get_deleted_tasks(conn: sqlite3.Connection, user_id: int, limit: int = 15) -
         logging.error("SQLite error in get_deleted_tasks: %s", exc)
         return []
 
-def search_tasks(conn: sqlite3.Connection, user_id: int, pattern: str) -> list[tuple[str, str]]:
+
+def _fts_query(cleaned: str) -> str:
+    """Build an FTS5 MATCH expression: every word is a quoted prefix term."""
+
+    folded = cleaned.replace("ё", "е").replace("Ё", "Е")
+    return " ".join(f'"{token}"*' for token in folded.split())
+
+
+def search_tasks(
+    conn: sqlite3.Connection, user_id: int, pattern: str, limit: int = 50
+) -> list[tuple[str, str]]:
     try:
         cleaned = re.sub(r"[^0-9a-zA-Zа-яА-ЯёЁ ]+", " ", pattern).strip()
         if not cleaned:
             logging.info("Invalid pattern for search tasks for user %s", user_id)
             return []
-        cur = conn.execute(
-            """
-            SELECT l.title AS list_title, e.title AS task_title
-            FROM entities e
-            JOIN entities l ON l.id = e.parent_id
-            WHERE e.user_id = ? AND e.type = 'task'
-              AND LOWER(e.title) LIKE LOWER(?)
-              AND (e.meta IS NULL OR json_extract(e.meta, '$.deleted') IS NOT TRUE)
-              AND json_extract(e.meta, '$.status') != 'done'
-            ORDER BY e.created_at ASC
-            """,
-            (user_id, f"%{cleaned}%"),
-        )
+        if _table_exists(conn, "entities_fts"):
+            cur = conn.execute(
+                """
+                SELECT l.title AS list_title, e.title AS task_title
+                FROM entities_fts f
+                JOIN entities e ON e.id = f.rowid
+                JOIN entities l ON l.id = e.parent_id
+                WHERE entities_fts MATCH ?
+                  AND e.user_id = ? AND e.type = 'task'
+                  AND e.is_deleted = 0
+                  AND e.status != 'done'
+                ORDER BY bm25(entities_fts, 10.0, 1.0), e.created_at ASC
+                LIMIT ?
+                """,
+                (_fts_query(cleaned), user_id, limit),
+            )
+        else:
+            cur = conn.execute(
+                """
+                SELECT l.title AS list_title, e.title AS task_title
+                FROM entities e
+                JOIN entities l ON l.id = e.parent_id
+                WHERE e.user_id = ? AND e.type = 'task'
+                  AND LOWER(e.title) LIKE LOWER(?)
+                  AND e.is_deleted = 0
+                  AND e.status != 'done'
+                ORDER BY e.created_at ASC
+                LIMIT ?
+                """,
+                (user_id, f"%{cleaned}%", limit),
+            )
         tasks = [(row["list_title"], row["task_title"]) for row in cur.fetchall()]
         logging.info(
             "Found %s tasks matching '%s' for user %s: %s",
@@ -1306,7 +3792,7 @@ def fetch_task(conn: sqlite3.Connection, user_id: int, list_name: str, task_titl
             WHERE e.user_id = ? AND e.type = 'task' AND l.type = 'list'
               AND LOWER(l.title) = LOWER(?)
               AND LOWER(e.title) = LOWER(?)
-              AND (e.meta IS NULL OR json_extract(e.meta, '$.deleted') IS NOT TRUE)
+              AND e.is_deleted = 0
             LIMIT 1
             """,
             (user_id, list_name, task_title),
@@ -1400,6 +3886,50 @@ def move_entity(
         logging.error("SQLite error in move_entity: %s", exc)
         return 0
 
+
+def count_descendants(conn: sqlite3.Connection, user_id: int, entity_id: int, *, active_only: bool = True) -> int:
+    """Count every entity below ``entity_id`` at any depth (deleted/archived skipped by default)."""
+
+    query = """
+        SELECT COUNT(*) FROM entity_closure c
+        JOIN entities e ON e.id = c.descendant
+        WHERE c.ancestor = ? AND c.depth > 0 AND e.user_id = ?
+    """
+    if active_only:
+        query += " AND e.is_deleted = 0 AND e.is_archived = 0"
+    try:
+        return conn.execute(query, (entity_id, user_id)).fetchone()[0]
+    except sqlite3.Error as exc:
+        logging.error("SQLite error in count_descendants: %s", exc)
+        return 0
+
+
+def get_descendants(
+    conn: sqlite3.Connection,
+    user_id: int,
+    entity_id: int,
+    max_depth: int | None = None,
+) -> list[dict[str, Any]]:
+    """Return the subtree under ``entity_id`` ordered by depth, then position."""
+
+    query = """
+        SELECT e.id, e.type, e.title, e.parent_id, c.depth
+        FROM entity_closure c
+        JOIN entities e ON e.id = c.descendant
+        WHERE c.ancestor = ? AND c.depth > 0 AND e.user_id = ?
+          AND e.is_deleted = 0 AND e.is_archived = 0
+    """
+    params: list[Any] = [entity_id, user_id]
+    if max_depth is not None:
+        query += " AND c.depth <= ?"
+        params.append(max_depth)
+    query += " ORDER BY c.depth, e.parent_id, e.position, e.id"
+    try:
+        return [dict(row) for row in conn.execute(query, params)]
+    except sqlite3.Error as exc:
+        logging.error("SQLite error in get_descendants: %s", exc)
+        return []
+
 def get_all_tasks(conn: sqlite3.Connection, user_id: int) -> list[tuple[str, str]]:
     try:
         cur = conn.execute(
@@ -1409,9 +3939,9 @@ def get_all_tasks(conn: sqlite3.Connection, user_id: int) -> list[tuple[str, str
             JOIN entities l ON l.id = e.parent_id
             WHERE e.user_id = ?
               AND e.type = 'task'
-              AND (e.meta IS NULL OR json_extract(e.meta, '$.deleted') IS NOT TRUE)
-              AND json_extract(e.meta, '$.status') != 'done'
-            ORDER BY l.title, e.created_at
+              AND e.is_deleted = 0
+              AND e.status != 'done'
+            ORDER BY l.title, e.position
             """,
             (user_id,),
         )
@@ -1447,490 +3977,17 @@ def get_user_profile(conn: sqlite3.Connection, user_id: int) -> dict[str, Any]:
             "SELECT meta FROM entities WHERE user_id = ? AND type = 'user_profile' AND title = ? LIMIT 1",
             (user_id, f"user_{user_id}"),
         )
-=======
-def _get_or_create_list(conn, user_id, list_name):
-    try:
-        cur = conn.cursor()
-        cur.execute("""SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1""", (user_id, list_name))
-        row = cur.fetchone()
-        if row:
-            logging.info(f"List '{list_name}' already exists for user {user_id}, ID: {row[0]}")
-            return row[0]
-        cur.execute("""INSERT INTO entities (user_id, type, title) VALUES (?, 'list', ?)""", (user_id, list_name))
-        list_id = cur.lastrowid
-        logging.info(f"Created list '{list_name}' for user {user_id}, ID: {list_id}")
-        return list_id
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in _get_or_create_list: {e}")
-        raise
-
-def create_list(conn, user_id, list_name):
-    return _get_or_create_list(conn, user_id, list_name)
-
-def rename_list(conn, user_id, old_name, new_name):
-    try:
-        cur = conn.cursor()
-        cur.execute("""SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1""", (user_id, old_name))
-        row = cur.fetchone()
-        if not row:
-            logging.info(f"No list '{old_name}' found for user {user_id}")
-            return 0
-        cur.execute("""SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1""", (user_id, new_name))
-        if cur.fetchone():
-            logging.info(f"List '{new_name}' already exists for user {user_id}")
-            return 0
-        cur.execute("""UPDATE entities SET title=? WHERE id=?""", (new_name, row["id"]))
-        logging.info(f"Renamed list '{old_name}' to '{new_name}' for user {user_id}")
-        return 1
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in rename_list: {e}")
-        return 0
-
-def find_list(conn, user_id, list_name):
-    try:
-        cur = conn.cursor()
-        cur.execute("""SELECT id, title FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1""", (user_id, list_name))
-        return cur.fetchone()
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in find_list: {e}")
-        return None
-
-def get_all_lists(conn, user_id):
-    try:
-        cur = conn.cursor()
-        cur.execute("""SELECT title FROM entities WHERE user_id=? AND type='list' AND (meta IS NULL OR json_extract(meta, '$.deleted') IS NOT TRUE) ORDER BY title ASC""", (user_id,))
-        return [row["title"] for row in cur.fetchall()]
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in get_all_lists: {e}")
-        return []
-
-def add_task(conn, user_id, list_name, title):
-    cur = conn.cursor()
-    # Check if list exists
-    cur.execute("SELECT id FROM entities WHERE user_id = ? AND type = 'list' AND title = ?", (user_id, list_name))
-    list_id = cur.fetchone()
-    if not list_id:
-        logging.info(f"No list '{list_name}' found for user {user_id}")
-        return None
-    list_id = list_id[0]
-    # Check if task already exists
-    cur.execute("""
-        SELECT id, meta FROM entities 
-        WHERE user_id = ? AND type = 'task' AND title = ? AND parent_id = ?
-    """, (user_id, title, list_id))
-    existing_task = cur.fetchone()
-    if existing_task:
-        meta = json.loads(existing_task['meta']) if existing_task['meta'] else {}
-        logging.info(f"Found existing task '{title}' in list '{list_name}' for user {user_id} with meta: {meta}")
-        if meta.get('status') == 'done':
-            cur.execute("""
-                UPDATE entities 
-                SET meta = NULL 
-                WHERE id = ?
-            """, (existing_task['id'],))
-            conn.commit()
-            logging.info(f"Restored task '{title}' in list '{list_name}' for user {user_id}")
-            return existing_task['id']
-        else:
-            logging.info(f"Task '{title}' already exists and is not done in list '{list_name}' for user {user_id}")
-            return None
-    # Insert new task
-    try:
-        cur.execute("INSERT INTO entities (user_id, type, title, parent_id) VALUES (?, ?, ?, ?)", 
-                    (user_id, 'task', title, list_id))
-        task_id = cur.lastrowid
-        conn.commit()
-        logging.info(f"Added new task '{title}' to list '{list_name}' for user {user_id}")
-        return task_id
-    except sqlite3.IntegrityError as e:
-        logging.error(f"IntegrityError: Failed to add task '{title}' to list '{list_name}' for user {user_id}: {e}")
-        return None
-
-def update_task(conn, user_id, list_name, old_title, new_title):
-    try:
-        cur = conn.cursor()
-        cur.execute("""SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1""", (user_id, list_name))
-        row = cur.fetchone()
-        if not row:
-            logging.info(f"No list '{list_name}' found for user {user_id}")
-            return 0
-        list_id = row["id"]
-        cur.execute("""SELECT id FROM entities WHERE user_id=? AND type='task' AND parent_id=? AND title=? LIMIT 1""", (user_id, list_id, old_title))
-        task = cur.fetchone()
-        if not task:
-            logging.info(f"No task '{old_title}' found in list '{list_name}' for user {user_id}")
-            return 0
-        cur.execute("""SELECT id FROM entities WHERE user_id=? AND type='task' AND parent_id=? AND title=? LIMIT 1""", (user_id, list_id, new_title))
-        if cur.fetchone():
-            logging.info(f"Task '{new_title}' already exists in list '{list_name}' for user {user_id}")
-            return 0
-        cur.execute("""UPDATE entities SET title=? WHERE id=?""", (new_title, task["id"]))
-        logging.info(f"Updated task '{old_title}' to '{new_title}' in list '{list_name}' for user {user_id}")
-        return 1
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in update_task: {e}")
-        return 0
-
-def update_task_by_index(conn, user_id, list_name, index, new_title):
-    try:
-        cur = conn.cursor()
-        cur.execute("""SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1""", (user_id, list_name))
-        row = cur.fetchone()
-        if not row:
-            logging.info(f"No list '{list_name}' found for user {user_id}")
-            return 0, None
-        list_id = row["id"]
-        cur.execute("""SELECT id, title FROM entities WHERE user_id=? AND type='task' AND parent_id=? AND (meta IS NULL OR json_extract(meta, '$.deleted') IS NOT TRUE AND json_extract(meta, '$.status') != 'done') ORDER BY created_at ASC""", 
-                    (user_id, list_id))
-        tasks = cur.fetchall()
-        if not tasks or index < 1 or index > len(tasks):
-            logging.info(f"Invalid index {index} for list '{list_name}' for user {user_id}")
-            return 0, None
-        chosen = tasks[index - 1]
-        task_id, old_title = chosen["id"], chosen["title"]
-        cur.execute("""SELECT id FROM entities WHERE user_id=? AND type='task' AND parent_id=? AND title=? LIMIT 1""", (user_id, list_id, new_title))
-        if cur.fetchone():
-            logging.info(f"Task '{new_title}' already exists in list '{list_name}' for user {user_id}")
-            return 0, None
-        cur.execute("""UPDATE entities SET title=? WHERE id=?""", (new_title, task_id))
-        logging.info(f"Updated task '{old_title}' to '{new_title}' by index {index} in list '{list_name}' for user {user_id}")
-        return 1, old_title
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in update_task_by_index: {e}")
-        return 0, None
-
-def get_list_tasks(conn, user_id, list_name):
-    try:
-        cur = conn.cursor()
-        cur.execute("""SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1""", (user_id, list_name))
-        row = cur.fetchone()
-        if not row:
-            logging.info(f"No list '{list_name}' found for user {user_id}")
-            return []
-        list_id = row["id"]
-        cur.execute("""SELECT title FROM entities WHERE user_id=? AND type='task' AND parent_id=? AND (meta IS NULL OR json_extract(meta, '$.deleted') IS NOT TRUE AND json_extract(meta, '$.status') != 'done') ORDER BY created_at ASC""", 
-                    (user_id, list_id))
-        tasks = [(i+1, r["title"]) for i, r in enumerate(cur.fetchall())]
-        logging.info(f"Retrieved {len(tasks)} tasks for list '{list_name}' for user {user_id}")
-        return tasks
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in get_list_tasks: {e}")
-        return []
-
-def mark_task_done(conn, user_id, list_name, task_title):
-    try:
-        cur = conn.cursor()
-        cur.execute("""SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1""", (user_id, list_name))
-        row = cur.fetchone()
-        if not row:
-            logging.info(f"No list '{list_name}' found for user {user_id}")
-            return 0
-        list_id = row["id"]
-        cur.execute("""SELECT id, meta FROM entities WHERE user_id=? AND type='task' AND parent_id=? AND title=? LIMIT 1""", (user_id, list_id, task_title))
-        task = cur.fetchone()
-        if not task:
-            logging.info(f"No task '{task_title}' found in list '{list_name}' for user {user_id}")
-            return 0
-        meta = {}
-        if task["meta"]:
-            try: meta = json.loads(task["meta"])
-            except: meta = {}
-        meta["status"] = "done"
-        cur.execute("""UPDATE entities SET meta=? WHERE id=?""", (json.dumps(meta, ensure_ascii=False), task["id"]))
-        logging.info(f"Marked task '{task_title}' as done in list '{list_name}' for user {user_id}")
-        return cur.rowcount
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in mark_task_done: {e}")
-        return 0
-
-def mark_task_done_fuzzy(conn, user_id, list_name, pattern):
-    try:
-        if not pattern:
-            logging.info(f"No pattern provided for fuzzy mark done in list '{list_name}' for user {user_id}")
-            return 0, None
-        q = re.sub(r'[^0-9a-zA-Zа-яА-ЯёЁ ]+', ' ', pattern).strip()
-        if not q:
-            logging.info(f"Invalid pattern after cleaning for fuzzy mark done in list '{list_name}' for user {user_id}")
-            return 0, None
-        cur = conn.cursor()
-        cur.execute("""SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1""", (user_id, list_name))
-        row = cur.fetchone()
-        if not row:
-            logging.info(f"No list '{list_name}' found for user {user_id}")
-            return 0, None
-        list_id = row["id"]
-        cur.execute("""SELECT id, title, meta FROM entities WHERE user_id=? AND type='task' AND parent_id=? AND (meta IS NULL OR json_extract(meta, '$.deleted') IS NOT TRUE AND json_extract(meta, '$.status') != 'done')""", 
-                    (user_id, list_id))
-        candidates = [(r["id"], r["title"], r["meta"]) for r in cur.fetchall()]
-        if not candidates:
-            logging.info(f"No tasks found in list '{list_name}' for user {user_id}")
-            return 0, None
-        candidates.sort(key=lambda x: distance(x[1].lower(), q.lower()))
-        if distance(candidates[0][1].lower(), q.lower()) > len(q) // 2:
-            logging.info(f"No close match for pattern '{q}' in list '{list_name}' for user {user_id}")
-            return 0, None
-        chosen_id, chosen_title, meta = candidates[0]
-        try:
-            meta = json.loads(meta) if meta else {}
-        except:
-            meta = {}
-        meta["status"] = "done"
-        cur.execute("UPDATE entities SET meta=? WHERE id=?", (json.dumps(meta, ensure_ascii=False), chosen_id))
-        logging.info(f"Fuzzy marked task '{chosen_title}' as done in list '{list_name}' for user {user_id}")
-        return 1, chosen_title
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in mark_task_done_fuzzy: {e}")
-        return 0, None
-
-def delete_list(conn, user_id, list_name):
-    try:
-        cur = conn.cursor()
-        cur.execute("""SELECT id, meta FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1""", (user_id, list_name))
-        row = cur.fetchone()
-        if not row:
-            logging.info(f"No list '{list_name}' found for user {user_id}")
-            return 0
-        list_id, meta = row["id"], row["meta"]
-        try: meta = json.loads(meta) if meta else {}
-        except: meta = {}
-        meta["deleted"] = True
-        cur.execute("UPDATE entities SET meta=? WHERE id=?", (json.dumps(meta, ensure_ascii=False), list_id))
-        cur.execute("""SELECT id, meta FROM entities WHERE user_id=? AND type='task' AND parent_id=?""", (user_id, list_id))
-        for r in cur.fetchall():
-            m = {}
-            try: m = json.loads(r["meta"]) if r["meta"] else {}
-            except: m = {}
-            m["deleted"] = True
-            cur.execute("UPDATE entities SET meta=? WHERE id=?", (json.dumps(m, ensure_ascii=False), r["id"]))
-        logging.info(f"Deleted list '{list_name}' for user {user_id}")
-        return 1
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in delete_list: {e}")
-        return 0
-
-def delete_task(conn, user_id, list_name, task_title):
-    try:
-        cur = conn.cursor()
-        cur.execute("""SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1""", (user_id, list_name))
-        row = cur.fetchone()
-        if not row:
-            logging.info(f"No list '{list_name}' found for user {user_id}")
-            return 0
-        list_id = row["id"]
-        cur.execute("""SELECT id, meta FROM entities WHERE user_id=? AND type='task' AND parent_id=? AND title=? LIMIT 1""", (user_id, list_id, task_title))
-        t = cur.fetchone()
-        if not t:
-            logging.info(f"No task '{task_title}' found in list '{list_name}' for user {user_id}")
-            return 0
-        meta = json.loads(t["meta"]) if t["meta"] else {}
-        if meta.get("status") == "done":
-            logging.info(f"Task '{task_title}' is already done in list '{list_name}' for user {user_id}")
-            return 0
-        meta["deleted"] = True
-        cur.execute("UPDATE entities SET meta=? WHERE id=?", (json.dumps(meta, ensure_ascii=False), t["id"]))
-        logging.info(f"Deleted task '{task_title}' from list '{list_name}' for user {user_id}")
-        return 1
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in delete_task: {e}")
-        return 0
-
-def restore_task(conn, user_id, list_name, task_title):
-    try:
-        cur = conn.cursor()
-        cur.execute("""SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1""", (user_id, list_name))
-        row = cur.fetchone()
-        if not row:
-            logging.info(f"No list '{list_name}' found for user {user_id}")
-            return 0
-        list_id = row["id"]
-        cur.execute("""SELECT id, meta FROM entities WHERE user_id=? AND type='task' AND parent_id=? AND title=? LIMIT 1""", (user_id, list_id, task_title))
-        t = cur.fetchone()
-        if not t:
-            logging.info(f"No task '{task_title}' found in list '{list_name}' for user {user_id}")
-            return 0
-        meta = json.loads(t["meta"]) if t["meta"] else {}
-        meta["deleted"] = False
-        if "status" in meta:
-            meta["status"] = "open"
-        cur.execute("UPDATE entities SET meta=? WHERE id=?", (json.dumps(meta, ensure_ascii=False), t["id"]))
-        logging.info(f"Restored task '{task_title}' in list '{list_name}' for user {user_id}")
-        return 1
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in restore_task: {e}")
-        return 0
-
-def restore_task_fuzzy(conn, user_id, list_name, pattern):
-    try:
-        if not pattern:
-            logging.info(f"No pattern provided for fuzzy restore in list '{list_name}' for user {user_id}")
-            return 0, None
-        q = re.sub(r'[^0-9a-zA-Zа-яА-ЯёЁ ]+', ' ', pattern).strip()
-        if not q:
-            logging.info(f"Invalid pattern after cleaning for fuzzy restore in list '{list_name}' for user {user_id}")
-            return 0, None
-        cur = conn.cursor()
-        cur.execute("""SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1""", (user_id, list_name))
-        row = cur.fetchone()
-        if not row:
-            logging.info(f"No list '{list_name}' found for user {user_id}")
-            return 0, None
-        list_id = row["id"]
-        cur.execute("""SELECT id, title, meta FROM entities WHERE user_id=? AND type='task' AND parent_id=? AND json_extract(meta, '$.deleted') = true""", 
-                    (user_id, list_id))
-        candidates = [(r["id"], r["title"], r["meta"]) for r in cur.fetchall()]
-        if not candidates:
-            logging.info(f"No deleted tasks found in list '{list_name}' for user {user_id}")
-            return 0, None
-        candidates.sort(key=lambda x: distance(x[1].lower(), q.lower()))
-        if distance(candidates[0][1].lower(), q.lower()) > len(q) // 2:
-            logging.info(f"No close match for pattern '{q}' in list '{list_name}' for user {user_id}")
-            return 0, None
-        chosen_id, chosen_title, meta = candidates[0]
-        try:
-            meta = json.loads(meta) if meta else {}
-        except:
-            meta = {}
-        meta["deleted"] = False
-        if "status" in meta:
-            meta["status"] = "open"
-        cur.execute("UPDATE entities SET meta=? WHERE id=?", (json.dumps(meta, ensure_ascii=False), chosen_id))
-        logging.info(f"Fuzzy restored task '{chosen_title}' in list '{list_name}' for user {user_id}")
-        return 1, chosen_title
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in restore_task_fuzzy: {e}")
-        return 0, None
-
-def get_completed_tasks(conn, user_id):
-    try:
-        cur = conn.cursor()
-        cur.execute("""SELECT l.title AS list_title, e.title AS task_title, e.meta FROM entities e
-                       LEFT JOIN entities l ON l.id = e.parent_id
-                       WHERE e.user_id=? AND e.type='task' AND (json_extract(e.meta, '$.status') = 'done' OR json_extract(e.meta, '$.deleted') = true)
-                       ORDER BY e.created_at DESC LIMIT 100""", (user_id,))
-        tasks = [(row["list_title"], row["task_title"], json.loads(row["meta"]) if row["meta"] else {}) for row in cur.fetchall()]
-        logging.info(f"Retrieved {len(tasks)} completed/deleted tasks for user {user_id}")
-        return tasks
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in get_completed_tasks: {e}")
-        return []
-
-def search_tasks(conn, user_id, pattern):
-    try:
-        q = re.sub(r'[^0-9a-zA-Zа-яА-ЯёЁ ]+', ' ', pattern).strip()
-        if not q:
-            logging.info(f"Invalid pattern for search tasks for user {user_id}")
-            return []
-        cur = conn.cursor()
-        cur.execute("""SELECT l.title AS list_title, e.title AS task_title
-                       FROM entities e
-                       JOIN entities l ON l.id = e.parent_id
-                       WHERE e.user_id=? AND e.type='task' AND LOWER(e.title) LIKE LOWER(?) AND (e.meta IS NULL OR json_extract(e.meta, '$.deleted') IS NOT TRUE AND json_extract(e.meta, '$.status') != 'done')
-                       ORDER BY e.created_at ASC""", (user_id, f"%{q}%"))
-        tasks = [(row["list_title"], row["task_title"]) for row in cur.fetchall()]
-        logging.info(f"Found {len(tasks)} tasks matching '{q}' for user {user_id}: {tasks}")
-        return tasks
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in search_tasks: {e}")
-        return []
-
-def fetch_task(conn, user_id, list_name, task_title):
-    try:
-        cur = conn.cursor()
-        cur.execute("""SELECT e.id, e.title, e.meta FROM entities e
-                       JOIN entities l ON l.id = e.parent_id
-                       WHERE e.user_id=? AND e.type='task' AND l.type='list' AND l.title=? AND e.title=?
-                       LIMIT 1""", (user_id, list_name, task_title))
-        task = cur.fetchone()
-        logging.info(f"Fetched task '{task_title}' from list '{list_name}' for user {user_id}: {'Found' if task else 'Not found'}")
-        return task
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in fetch_task: {e}")
-        return None
-
-def fetch_list_by_task(conn, user_id, task_title):
-    try:
-        cur = conn.cursor()
-        cur.execute("""SELECT l.title AS list_title, e.title AS task_title
-                       FROM entities e
-                       JOIN entities l ON l.id = e.parent_id
-                       WHERE e.user_id=? AND e.type='task' AND e.title=?
-                       LIMIT 1""", (user_id, task_title))
-        result = cur.fetchone()
-        logging.info(f"Fetched list by task '{task_title}' for user {user_id}: {'Found' if result else 'Not found'}")
-        return result
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in fetch_list_by_task: {e}")
-        return None
-
-def move_entity(conn, user_id, entity_type, title, from_list, to_list):
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1", (user_id, from_list))
-        from_row = cur.fetchone()
-        if not from_row:
-            logging.info(f"No list '{from_list}' found for user {user_id}")
-            return 0
-        from_list_id = from_row["id"]
-        to_list_id = _get_or_create_list(conn, user_id, to_list)
-        cur.execute("SELECT id FROM entities WHERE user_id=? AND type=? AND title=? AND parent_id=? LIMIT 1", 
-                    (user_id, entity_type, title, from_list_id))
-        entity = cur.fetchone()
-        if not entity:
-            logging.info(f"No {entity_type} '{title}' found in list '{from_list}' for user {user_id}")
-            return 0
-        cur.execute("UPDATE entities SET parent_id=? WHERE id=?", (to_list_id, entity["id"]))
-        logging.info(f"Moved {entity_type} '{title}' from '{from_list}' to '{to_list}' for user {user_id}")
-        return 1
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in move_entity: {e}")
-        return 0
-
-def get_all_tasks(conn, user_id):
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT l.title AS list_title, e.title AS task_title FROM entities e JOIN entities l ON l.id = e.parent_id WHERE e.user_id=? AND e.type='task' AND (e.meta IS NULL OR json_extract(e.meta, '$.deleted') IS NOT TRUE AND json_extract(e.meta, '$.status') != 'done') ORDER BY l.title, e.created_at", (user_id,))
-        tasks = [(row["list_title"], row["task_title"]) for row in cur.fetchall()]
-        logging.info(f"Retrieved {len(tasks)} tasks for user {user_id}")
-        return tasks
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in get_all_tasks: {e}")
-        return []
-
-def update_user_profile(conn, user_id, city=None, profession=None):
-    try:
-        meta = {"city": city, "profession": profession}
-        cur = conn.cursor()
-        cur.execute("INSERT OR REPLACE INTO entities (user_id, type, title, meta) VALUES (?, 'user_profile', ?, ?)", 
-                    (user_id, f"user_{user_id}", json.dumps(meta, ensure_ascii=False)))
-        logging.info(f"Updated user profile for user {user_id}: {meta}")
-        return 1
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in update_user_profile: {e}")
-        return 0
-
-def get_user_profile(conn, user_id):
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT meta FROM entities WHERE user_id=? AND type='user_profile' AND title=? LIMIT 1", 
-                    (user_id, f"user_{user_id}"))
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
         row = cur.fetchone()
         if row and row["meta"]:
             return json.loads(row["meta"])
         return {}
-<<<<<<< HEAD
     except sqlite3.Error as exc:
         logging.error("SQLite error in get_user_profile: %s", exc)
-=======
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in get_user_profile: {e}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
         return {}
 
 def delete_task_fuzzy(conn, user_id, list_name, pattern: str):
     try:
         if not pattern:
-<<<<<<< HEAD
             logging.info("No pattern provided for fuzzy delete in list '%s' for user %s", list_name, user_id)
             return 0, None
         cleaned = re.sub(r"[^0-9a-zA-Zа-яА-ЯёЁ ]+", " ", pattern).strip()
@@ -1940,10 +3997,7 @@ def delete_task_fuzzy(conn, user_id, list_name, pattern: str):
         list_id = _get_list_id(conn, user_id, list_name)
         if list_id is None:
             return 0, None
-        candidates = [
-            (row["id"], row["title"], row["meta"])
-            for row in _list_active_tasks(conn, user_id, list_id)
-        ]
+        candidates = _fuzzy_candidates(conn, user_id, list_id, cleaned)
         if not candidates:
             logging.info("No tasks found in list '%s' for user %s", list_name, user_id)
             return 0, None
@@ -1954,13 +4008,8 @@ def delete_task_fuzzy(conn, user_id, list_name, pattern: str):
         if distance(target[1].lower(), cleaned.lower()) > len(cleaned) // 2:
             logging.info("No close match for pattern '%s' in list '%s' for user %s", cleaned, list_name, user_id)
             return 0, None
-        chosen_id, chosen_title, meta_text = target
-        meta = _load_meta(meta_text)
-        meta["deleted"] = True
-        conn.execute(
-            "UPDATE entities SET meta = ? WHERE id = ?",
-            (_dump_meta(meta), chosen_id),
-        )
+        chosen_id, chosen_title, _ = target
+        conn.execute(_MARK_DELETED_SQL, (_utc_timestamp(), chosen_id))
         logging.info("Fuzzy deleted task '%s' from list '%s' for user %s", chosen_title, list_name, user_id)
         return 1, chosen_title
     except sqlite3.Error as exc:
@@ -1973,87 +4022,16 @@ def delete_task_by_index(conn, user_id, list_name: str, index: int):
         list_id = _get_list_id(conn, user_id, list_name)
         if list_id is None:
             return 0, None
-        tasks = _list_active_tasks(conn, user_id, list_id)
-        if not tasks or index < 1 or index > len(tasks):
+        chosen = _task_at_index(conn, user_id, list_id, int(index))
+        if chosen is None:
             logging.info("Invalid index %s for list '%s' for user %s", index, list_name, user_id)
             return 0, None
-        chosen = tasks[index - 1]
         task_id, task_title = chosen["id"], chosen["title"]
-        meta = _load_meta(chosen["meta"])
-        meta["deleted"] = True
-        conn.execute(
-            "UPDATE entities SET meta = ? WHERE id = ?",
-            (_dump_meta(meta), task_id),
-        )
+        conn.execute(_MARK_DELETED_SQL, (_utc_timestamp(), task_id))
         logging.info("Deleted task '%s' by index %s from list '%s' for user %s", task_title, index, list_name, user_id)
         return 1, task_title
     except sqlite3.Error as exc:
         logging.error("SQLite error in delete_task_by_index: %s", exc)
-=======
-            logging.info(f"No pattern provided for fuzzy delete in list '{list_name}' for user {user_id}")
-            return 0, None
-        q = re.sub(r'[^0-9a-zA-Zа-яА-ЯёЁ ]+', ' ', pattern).strip()
-        if not q:
-            logging.info(f"Invalid pattern after cleaning for fuzzy delete in list '{list_name}' for user {user_id}")
-            return 0, None
-        cur = conn.cursor()
-        cur.execute("""SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1""", (user_id, list_name))
-        row = cur.fetchone()
-        if not row:
-            logging.info(f"No list '{list_name}' found for user {user_id}")
-            return 0, None
-        list_id = row["id"]
-        cur.execute("""SELECT id, title, meta FROM entities WHERE user_id=? AND type='task' AND parent_id=? AND (meta IS NULL OR json_extract(meta, '$.deleted') IS NOT TRUE AND json_extract(meta, '$.status') != 'done')""", 
-                    (user_id, list_id))
-        candidates = [(r["id"], r["title"], r["meta"]) for r in cur.fetchall()]
-        if not candidates:
-            logging.info(f"No tasks found in list '{list_name}' for user {user_id}")
-            return 0, None
-        candidates.sort(key=lambda x: distance(x[1].lower(), q.lower()))
-        if distance(candidates[0][1].lower(), q.lower()) > len(q) // 2:
-            logging.info(f"No close match for pattern '{q}' in list '{list_name}' for user {user_id}")
-            return 0, None
-        chosen_id, chosen_title, meta = candidates[0]
-        try:
-            m = json.loads(meta) if meta else {}
-        except:
-            m = {}
-        m["deleted"] = True
-        cur.execute("UPDATE entities SET meta=? WHERE id=?", (json.dumps(m, ensure_ascii=False), chosen_id))
-        logging.info(f"Fuzzy deleted task '{chosen_title}' from list '{list_name}' for user {user_id}")
-        return 1, chosen_title
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in delete_task_fuzzy: {e}")
-        return 0, None
-
-def delete_task_by_index(conn, user_id, list_name: str, index: int):
-    try:
-        cur = conn.cursor()
-        cur.execute("""SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1""", (user_id, list_name))
-        row = cur.fetchone()
-        if not row:
-            logging.info(f"No list '{list_name}' found for user {user_id}")
-            return 0, None
-        list_id = row["id"]
-        cur.execute("""SELECT id, title, meta FROM entities WHERE user_id=? AND type='task' AND parent_id=? AND (meta IS NULL OR json_extract(meta, '$.deleted') IS NOT TRUE AND json_extract(meta, '$.status') != 'done') ORDER BY created_at ASC""", 
-                    (user_id, list_id))
-        tasks = cur.fetchall()
-        if not tasks or index < 1 or index > len(tasks):
-            logging.info(f"Invalid index {index} for list '{list_name}' for user {user_id}")
-            return 0, None
-        chosen = tasks[index - 1]
-        task_id, task_title, meta = chosen["id"], chosen["title"], chosen["meta"]
-        try:
-            m = json.loads(meta) if meta else {}
-        except:
-            m = {}
-        m["deleted"] = True
-        cur.execute("UPDATE entities SET meta=? WHERE id=?", (json.dumps(m, ensure_ascii=False), task_id))
-        logging.info(f"Deleted task '{task_title}' by index {index} from list '{list_name}' for user {user_id}")
-        return 1, task_title
-    except sqlite3.Error as e:
-        logging.error(f"SQLite error in delete_task_by_index: {e}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
         return 0, None
 
 def normalize_text(value: str) -> str:
@@ -2065,42 +4043,28 @@ def normalize_text(value: str) -> str:
     value = re.sub(r'\bsp[oO]2\b', 'SPO2', value, flags=re.IGNORECASE)
     return value
 
-<<<<<<< HEAD
-=======
-def update_entity(conn, user_id: int, entity_type: str, title: str, new_title: str = None, new_content: str = None, meta_update: dict = None):
-    cur = conn.cursor()
-    updates = []
-    params = []
-    if new_title:
-        updates.append("title = ?")
-        params.append(new_title)
-    if new_content:
-        updates.append("content = ?")
-        params.append(new_content)
-    if meta_update:
-        cur.execute("SELECT meta FROM entities WHERE user_id=? AND type=? AND title=?", (user_id, entity_type, title))
-        row = cur.fetchone()
-        if row:
-            meta = json.loads(row[0] or "{}")
-            meta.update(meta_update)
-            updates.append("meta = ?")
-            params.append(json.dumps(meta))
-    if not updates:
-        return None
-    sql = f"UPDATE entities SET {", ".join(updates)} WHERE user_id=? AND type=? AND title=?"
-    params.extend([user_id, entity_type, title])
-    cur.execute(sql, params)
-    conn.commit()
-    return cur.rowcount > 0
-
-def move_entity(conn, user_id: int, entity_type: str, title: str, new_parent_title: str):
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM entities WHERE user_id=? AND type='list' AND title=?", (user_id, new_parent_title))
-    new_parent = cur.fetchone()
-    if not new_parent:
-        return None
-    new_parent_id = new_parent[0]
-    cur.execute("UPDATE entities SET parent_id=? WHERE user_id=? AND type=? AND title=?", (new_parent_id, user_id, entity_type, title))
-    conn.commit()
-    return cur.rowcount > 0
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Aura database maintenance")
+    parser.add_argument("--init", action="store_true", help="create or migrate the schema")
+    parser.add_argument("--backup", nargs="?", const="", metavar="DIR", help="take an online backup")
+    parser.add_argument(
+        "--split", metavar="SOURCE", help="split a monolithic database into shards under DB_PATH"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
+    if args.split:
+        for shard, users in split_database(args.split).items():
+            print(f"{shard}: {users} users")
+    if args.init:
+        init_db()
+    if args.backup is not None:
+        results = []
+        for path in database_paths():
+            with pooled_connection(path=path) as backup_conn:
+                results.append(backup_database(backup_conn, args.backup or None))
+        close_pool()
+        if not all(result and result["ok"] for result in results):
+            sys.exit(1)
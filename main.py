@@ -1,11 +1,14 @@
-<<<<<<< HEAD
+import asyncio
 import json
 import logging
 import math
 import os
 import random
 import re
+import threading
 import unicodedata
+from contextlib import asynccontextmanager, closing
+from contextvars import ContextVar
 from pathlib import Path
 from typing import Any
 
@@ -37,39 +40,18 @@ from telegram.ext import (
 )
 
 from db import (
-    add_task,
-    create_list,
-    delete_list,
-    delete_task,
-    delete_task_by_index,
-    delete_task_fuzzy,
-    find_list,
-    fetch_list_by_task,
-    fetch_task,
-    get_all_lists,
-    get_all_tasks,
-    get_completed_tasks,
+    backfill_embeddings,
+    backup_database,
+    close_pool,
+    compact_entities,
+    database_paths,
     get_conn,
-    get_deleted_tasks,
-    get_entity_meta,
-    get_list_tasks,
-    get_list_meta,
-    get_user_profile,
     init_db,
-    mark_task_done,
-    mark_task_done_fuzzy,
-    move_entity,
+    log_query_profile,
     normalize_text,
-    rename_list,
-    restore_task,
-    restore_task_fuzzy,
-    search_tasks,
-    set_entity_meta,
-    update_task,
-    update_task_by_index,
-    update_user_profile,
     set_embedding_provider,
 )
+from storage import AsyncStorage, Storage, close_async_storage, get_async_storage, in_writer_call
 dotenv_path = Path(__file__).resolve().parent / ".env"
 if dotenv_path.exists():
     load_dotenv(dotenv_path)
@@ -127,38 +109,14 @@ if not emoji_logger.handlers:
     db_handler.setFormatter(logging.Formatter(LOG_FORMAT))
     emoji_logger.addHandler(db_handler)
     emoji_logger.propagate = False
-=======
-import os, json, re, logging
-from pathlib import Path
-from dotenv import load_dotenv
-from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import ApplicationBuilder, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-import speech_recognition as sr
-from pydub import AudioSegment
-from openai import OpenAI
-from datetime import datetime, timedelta
-from db import (
-    rename_list, normalize_text, init_db, get_conn, get_all_lists, get_list_tasks, add_task, delete_list,
-    mark_task_done, mark_task_done_fuzzy, delete_task, restore_task, find_list, fetch_task, fetch_list_by_task,
-    delete_task_fuzzy, delete_task_by_index, create_list, move_entity, get_all_tasks, update_user_profile,
-    get_user_profile, get_completed_tasks, search_tasks, update_task, update_task_by_index, restore_task_fuzzy
-)
-
-# ========= ENV =========
-dotenv_path = Path(__file__).resolve().parent / ".env"
-if dotenv_path.exists():
-    load_dotenv(dotenv_path)
-    print(f"[INFO] .env loaded from {dotenv_path}")
-else:
-    print(f"[WARNING] .env not found at {dotenv_path}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
 TEMP_DIR = os.getenv("TEMP_DIR", "/opt/aura-assistant/tmp")
+ARCHIVE_COMPACT_INTERVAL_S = int(os.getenv("ARCHIVE_COMPACT_INTERVAL_S", "21600"))
+DB_BACKUP_INTERVAL_S = int(os.getenv("DB_BACKUP_INTERVAL_S", "86400"))
 os.makedirs(TEMP_DIR, exist_ok=True)
-<<<<<<< HEAD
 if not TELEGRAM_TOKEN:
     raise RuntimeError("TELEGRAM_TOKEN не установлен")
 if not OPENAI_API_KEY:
@@ -169,6 +127,13 @@ logger.info("OpenAI client initialized for model %s", OPENAI_MODEL)
 
 _EMBEDDING_MODEL = "text-embedding-3-small"
 _EMBEDDING_CACHE: dict[str, list[float]] = {}
+_UNIT_OPEN: ContextVar[bool] = ContextVar("storage_unit_open", default=False)
+
+
+def _model_calls_blocked() -> bool:
+    """True while a storage write is running; model lookups then use caches only."""
+
+    return _UNIT_OPEN.get() or in_writer_call()
 
 
 def _normalize_embedding_text(text: str) -> str:
@@ -183,6 +148,9 @@ def _get_text_embedding(text: str) -> list[float] | None:
         return None
     if normalized in _EMBEDDING_CACHE:
         return _EMBEDDING_CACHE[normalized]
+    if _model_calls_blocked():
+        # The writer is busy until this returns; prepare_semantics() embeds beforehand.
+        return None
     try:
         response = client.embeddings.create(
             model=_EMBEDDING_MODEL,
@@ -203,7 +171,34 @@ def _get_text_embedding(text: str) -> list[float] | None:
     return embedding
 
 
-set_embedding_provider(_get_text_embedding)
+def _prefetch_embeddings(texts: list[str]) -> None:
+    missing: list[str] = []
+    for text in texts:
+        normalized = _normalize_embedding_text(text)
+        if normalized and normalized not in _EMBEDDING_CACHE and normalized not in missing:
+            missing.append(normalized)
+    if not missing:
+        return
+    try:
+        response = client.embeddings.create(
+            model=_EMBEDDING_MODEL,
+            input=missing,
+        )
+    except (
+        APIConnectionError,
+        APIError,
+        APITimeoutError,
+        AuthenticationError,
+        OpenAIError,
+        RateLimitError,
+    ) as exc:
+        logger.error("Failed to compute embeddings for %s: %s", missing, exc)
+        return
+    for normalized, item in zip(missing, response.data):
+        _EMBEDDING_CACHE[normalized] = item.embedding
+
+
+set_embedding_provider(_get_text_embedding, model=_EMBEDDING_MODEL)
 # ========= DIALOG CONTEXT (per-user) =========
 SESSION: dict[int, dict] = {} # { user_id: {"last_action": str, "last_list": str, "history": [str], "pending_delete": str, "pending_confirmation": dict} }
 SIGNIFICANT_ACTIONS = {"create", "add_task", "move_entity", "mark_done", "restore_task", "delete_task", "delete_list"}
@@ -233,6 +228,17 @@ if VISUAL_STYLE not in _VALID_VISUAL_STYLES:
 
 YES_ANSWERS = {"да", "yes"}
 NO_ANSWERS = {"нет", "no"}
+READ_ONLY_ACTIONS = frozenset(
+    {
+        "show_lists",
+        "show_tasks",
+        "show_all_tasks",
+        "show_completed_tasks",
+        "show_deleted_tasks",
+        "search_entity",
+        "say",
+    }
+)
 
 DEFAULT_LIST_EMOJI = "📘"
 DEFAULT_TASK_EMOJI = "📎"
@@ -381,6 +387,7 @@ def _get_style_config() -> dict:
 LIST_ICON = _get_style_config()["list_icon"]
 SECTION_ICON = _get_style_config()["section_icon"]
 ALL_LISTS_ICON = _get_style_config()["all_lists_icon"]
+CURRENT_LIST_LABEL = "Актуальный список"
 
 
 def get_action_icon(action: str) -> str:
@@ -634,10 +641,25 @@ def get_emoji_cached(
         if stored:
             _EMOJI_CACHE[cache_key] = stored
             return stored
-    if cache_key in _EMOJI_CACHE:
-        return _EMOJI_CACHE[cache_key]
-    decision = get_emoji_by_semantics(key_source, entity_type)
-    _EMOJI_CACHE[cache_key] = decision
+    decision = _emoji_decision(key_source, entity_type)
+    if decision is None:
+        fallback_emoji, _ = _fallback_emoji_for_entity(key_source, entity_type)
+        return EmojiDecision(fallback_emoji, 0.0, True)
+    return decision
+
+
+def _emoji_decision(title: str | None, entity_type: str) -> EmojiDecision | None:
+    """Cached decision for ``title``; a miss asks the model unless a storage write runs.
+
+    During a write the miss yields ``None`` so the writer is never held
+    across a model call; :func:`prepare_semantics` fills the cache first.
+    """
+
+    key_source = (title or "").strip()
+    cache_key = f"{entity_type}:{key_source.lower()}"
+    decision = _EMOJI_CACHE.get(cache_key)
+    if decision is None and not _model_calls_blocked():
+        decision = _EMOJI_CACHE[cache_key] = get_emoji_by_semantics(key_source, entity_type)
     return decision
 
 
@@ -655,36 +677,50 @@ def _emoji_suffix(
     return f" {emoji}" if emoji else ""
 
 
-def assign_list_emoji(conn, list_id: int, title: str) -> dict[str, Any]:
-    decision = get_emoji_by_semantics(title, "list")
-    meta = get_entity_meta(conn, list_id) or {}
+def assign_list_emoji(store: Storage, list_id: int, title: str) -> dict[str, Any]:
+    decision = _emoji_decision(title, "list")
+    meta = store.get_entity_meta(list_id) or {}
+    if decision is None:
+        return meta
     meta["emoji"] = _emoji_meta_payload(decision)
-    set_entity_meta(conn, list_id, meta)
-    cache_key = f"list:{(title or '').strip().lower()}"
-    _EMOJI_CACHE[cache_key] = decision
+    store.set_entity_meta(list_id, meta)
+    return meta
+
+
+def _with_task_emoji(title: str, meta: dict[str, Any]) -> dict[str, Any]:
+    decision = _emoji_decision(title, "task")
+    if decision is not None:
+        meta["emoji"] = _emoji_meta_payload(decision)
     return meta
 
 
-def assign_task_emoji(conn, task_id: int, title: str) -> dict[str, Any]:
-    decision = get_emoji_by_semantics(title, "task")
-    meta = get_entity_meta(conn, task_id) or {}
+def assign_task_emoji(store: Storage, task_id: int, title: str) -> dict[str, Any]:
+    decision = _emoji_decision(title, "task")
+    meta = store.get_entity_meta(task_id) or {}
+    if decision is None:
+        return meta
     meta["emoji"] = _emoji_meta_payload(decision)
-    set_entity_meta(conn, task_id, meta)
-    cache_key = f"task:{(title or '').strip().lower()}"
-    _EMOJI_CACHE[cache_key] = decision
+    store.set_entity_meta(task_id, meta)
     return meta
 
 
-def ensure_list_emoji(conn, user_id: int, list_name: str) -> dict[str, Any]:
-    meta = get_list_meta(conn, user_id, list_name)
+def ensure_list_emoji(store: Storage, user_id: int, list_name: str) -> dict[str, Any]:
+    meta = store.get_list_meta(user_id, list_name)
     if isinstance(meta, dict) and meta.get("emoji"):
         return meta
-    row = find_list(conn, user_id, list_name)
+    row = store.find_list(user_id, list_name)
     if row and row["id"]:
-        return assign_list_emoji(conn, row["id"], row["title"])
+        return assign_list_emoji(store, row["id"], row["title"])
     return meta if isinstance(meta, dict) else {}
 
 
+def ensure_snapshot_list_emoji(store: Storage, list_item: dict[str, Any]) -> dict[str, Any]:
+    meta = list_item.get("meta") or {}
+    if meta.get("emoji"):
+        return meta
+    return assign_list_emoji(store, list_item["id"], list_item["title"])
+
+
 def format_task_line(
     index: int,
     title: str,
@@ -713,36 +749,50 @@ def format_section_title(title: str, meta: dict[str, Any] | None = None) -> str:
 
 
 def format_list_output(
-    conn,
+    store: Storage,
     user_id: int,
     list_name: str,
     heading_label: str | None = None,
+    *,
+    list_meta: dict[str, Any] | None = None,
+    tasks: list[tuple[int, str, dict[str, Any], int]] | None = None,
 ) -> str:
-    list_meta = ensure_list_emoji(conn, user_id, list_name)
+    if list_meta is None:
+        list_meta = ensure_list_emoji(store, user_id, list_name)
     heading = heading_label or format_section_title(list_name, list_meta)
-    tasks = get_list_tasks(conn, user_id, list_name)
+    if tasks is None:
+        tasks = store.get_list_tasks(user_id, list_name)
     if tasks:
         lines: list[str] = []
         for idx, title, meta, task_id in tasks:
             task_meta = meta or {}
             if task_id and (not task_meta or "emoji" not in task_meta):
-                task_meta = assign_task_emoji(conn, task_id, title)
+                task_meta = assign_task_emoji(store, task_id, title)
             lines.append(format_task_line(idx, title, meta=task_meta))
     else:
         lines = ["_— пусто —_"]
     return f"{heading}\n" + "\n".join(lines)
 
 
-def show_all_lists(conn, user_id: int, heading_label: str | None = None) -> str:
-    lists = get_all_lists(conn, user_id)
-    if not lists:
+def show_all_lists(store: Storage, user_id: int, heading_label: str | None = None) -> str:
+    snapshot = store.get_user_snapshot(user_id)
+    if not snapshot:
         empty_message = f"{ALL_LISTS_ICON} Пока нет списков."
         return f"{heading_label}\n_— пусто —_" if heading_label else empty_message
     blocks = []
-    for name in lists:
-        list_meta = ensure_list_emoji(conn, user_id, name)
-        heading = format_section_title(name, list_meta)
-        blocks.append(format_list_output(conn, user_id, name, heading_label=heading))
+    for item in snapshot:
+        list_meta = ensure_snapshot_list_emoji(store, item)
+        heading = format_section_title(item["title"], list_meta)
+        blocks.append(
+            format_list_output(
+                store,
+                user_id,
+                item["title"],
+                heading_label=heading,
+                list_meta=list_meta,
+                tasks=item["tasks"],
+            )
+        )
     combined = "\n\n".join(blocks)
     if heading_label:
         return f"{heading_label}\n\n{combined}"
@@ -839,72 +889,20 @@ SEMANTIC_PROMPT = """
 - Если пользователь вводит усечённое слово, но намерение однозначно читается ("спис", "удал", "добав"), интерпретируй его по контексту без дополнительного уточнения.
 - Поиск задач (например, «найди задачи с договор») должен быть регистронезависимым и искать по частичному совпадению.
 - Команда «Покажи удалённые задачи» → action: show_deleted_tasks, entity_type: task.
-=======
-
-# ========= LOG =========
-logging.basicConfig(
-    filename="/opt/aura-assistant/aura.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
-
-client = OpenAI(api_key=OPENAI_API_KEY)
-
-# ========= DIALOG CONTEXT (per-user) =========
-SESSION: dict[int, dict] = {}  # { user_id: {"last_action": str, "last_list": str, "history": [str], "pending_delete": str} }
-
-def set_ctx(user_id: int, **kw):
-    sess = SESSION.get(user_id, {"history": [], "last_list": None, "last_action": None, "pending_delete": None})
-    sess.update({k:v for k,v in kw.items() if v is not None})
-    if "history" in kw and isinstance(kw["history"], list):
-        seen = set()
-        sess["history"] = [x for x in kw["history"][-10:] if not (x in seen or seen.add(x))]
-    SESSION[user_id] = sess
-    logging.info(f"Updated context for user {user_id}: {sess}")
-
-def get_ctx(user_id: int, key: str, default=None):
-    return SESSION.get(user_id, {"history": [], "last_list": None, "last_action": None, "pending_delete": None}).get(key, default)
-
-# ========= PROMPT (Semantic Core) =========
-SEMANTIC_PROMPT = """
-Ты — Aura, дружелюбный и остроумный ассистент, который понимает смысл человеческих фраз и управляет локальной Entity System (списки, задачи). Ты ведёшь себя как живой помощник: приветствуешь, поддерживаешь, шутишь к месту, переспрашиваешь, если нужно, и всегда действуешь осмысленно.
-
-Как ты думаешь:
-- Сначала подумай шаг за шагом: 1) Какое намерение? 2) Какой контекст (последний список, история)? 3) Какое действие выбрать?
-- Учитывай последние сообщения (контекст: {history}) и состояние базы (db_state: {db_state}).
-- Учитывай профиль пользователя (город, профессия): {user_profile}.
-- Если пользователь говорит «туда», «в него», «этот список» — это последний упомянутый список (db_state.last_list или история).
-- Приоритет точного имени списка над контекстом (например, «Домашние дела» важнее last_list).
-- Команда «Покажи список <название>» или «покажи <название>» → показать задачи (action: show_tasks, entity_type: task, list: <название>).
-- Если в запросе несколько задач (например, «добавь постирать ковер помыть машину»), используй ключ tasks для множественного добавления.
-- Если в запросе несколько задач для завершения (например, «лук молоко хлеб куплены»), используй ключ tasks для множественного mark_done.
-- Поиск задач (например, «найди задачи с договор») должен быть регистронезависимым и искать по частичному совпадению.
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
 - Удаление списка требует подтверждения («да»/«нет»), после «да» список удаляется, контекст очищается.
 - Восстановление задачи (например, «верни задачу») поддерживает fuzzy-поиск по частичному совпадению.
 - Изменение задачи (например, «измени четвёртый пункт») поддерживает указание по индексу (meta.by_index).
 - Перенос задачи (например, «перенеси задачу») поддерживает fuzzy-поиск по частичному совпадению (meta.fuzzy: true).
-<<<<<<< HEAD
 - Решение: create/add_task/show_lists/show_tasks/show_all_tasks/mark_done/delete_task/delete_list/move_entity/search_entity/rename_list/update_profile/restore_task/show_completed_tasks/show_deleted_tasks/update_task/unknown.
-=======
-- Решение: create/add_task/show_lists/show_tasks/show_all_tasks/mark_done/delete_task/delete_list/move_entity/search_entity/rename_list/update_profile/restore_task/show_completed_tasks/update_task/unknown.
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
 - Если социальная реплика (привет, благодарность, «как дела?») — action: say.
 - Если запрос неясен — action: clarify с вопросом.
 - Нормализуй вход (регистры, пробелы, ошибки речи), но сохраняй смысл.
 - Для удаления списка всегда используй clarify сначала: {{ "action": "clarify", "meta": {{ "question": "Уверен, что хочешь удалить список {pending_delete}? Скажи 'да' или 'нет'.", "pending": "{pending_delete}" }} }}
 - Если команда «да» и есть pending_delete в контексте, возвращай: {{ "action": "delete_list", "entity_type": "list", "list": "{pending_delete}" }}
 - Никогда не обрезай JSON. Всегда полный объект.
-<<<<<<< HEAD
 Формат ответа (строго JSON; без текста вне JSON):
 - Для действий над базой:
 {{ "action": "create|add_task|show_lists|show_tasks|show_all_tasks|mark_done|delete_task|delete_list|move_entity|search_entity|rename_list|update_profile|restore_task|show_completed_tasks|show_deleted_tasks|update_task|unknown",
-=======
-
-Формат ответа (строго JSON; без текста вне JSON):
-- Для действий над базой:
-{{ "action": "create|add_task|show_lists|show_tasks|show_all_tasks|mark_done|delete_task|delete_list|move_entity|search_entity|rename_list|update_profile|restore_task|show_completed_tasks|update_task|unknown",
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
   "entity_type": "list|task|user_profile",
   "list": "имя списка",
   "title": "имя задачи или заметки",
@@ -915,15 +913,10 @@ SEMANTIC_PROMPT = """
 {{ "action": "say", "text": "короткий дружелюбный ответ", "meta": {{ "tone": "friendly", "context_used": true }} }}
 - Для уточнения:
 {{ "action": "clarify", "meta": {{ "question": "вежливый уточняющий вопрос", "context_used": true }} }}
-<<<<<<< HEAD
-=======
-
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
 Правила поведения:
 - Смысл важнее слов: распознавай намерение без триггеров.
 - Контекст: «туда/там/в него» — последний список из истории или db_state.last_list.
 - Позиции: «первую/вторую» — meta.by_index (1…; -1 = последняя).
-<<<<<<< HEAD
 - Маркеры завершения («выполнено», «сделано», «куплено») — для каждой найденной задачи формируй отдельное действие mark_done (в массиве actions, если их несколько) и используй fuzzy-поиск.
 - Удаление списка требует подтверждения («да»/«нет»), после «да» список удаляется, контекст очищается.
 - Социальные реплики — action: say.
@@ -933,48 +926,27 @@ SEMANTIC_PROMPT = """
 - «Создай список Работа и список Домашние дела» → [{{ "action": "create", "entity_type": "list", "list": "Работа" }}, {{ "action": "create", "entity_type": "list", "list": "Домашние дела" }}]
 - «В список Домашние дела добавь постирать ковер, помыть машину, купить маленький нож» → {{ "action": "add_task", "entity_type": "task", "list": "Домашние дела", "tasks": ["Постирать ковер", "Помыть машину", "Купить маленький нож"] }}
 - «Лук, морковь куплены, машина помыта» → {{ "actions": [ {{ "action": "mark_done", "entity_type": "task", "list": "Домашние дела", "title": "Купить лук" }}, {{ "action": "mark_done", "entity_type": "task", "list": "Домашние дела", "title": "Купить морковь" }}, {{ "action": "mark_done", "entity_type": "task", "list": "Домашние дела", "title": "Помыть машину" }} ], "ui_text": "Отмечаю: лук, морковь и машина — выполнено." }}
-=======
-- Маркеры завершения («выполнено», «сделано», «куплено») — mark_done с fuzzy-поиском для каждой задачи в tasks.
-- Удаление списка требует подтверждения («да»/«нет»), после «да» список удаляется, контекст очищается.
-- Социальные реплики — action: say.
-- Только JSON.
-
-Примеры:
-- «Создай список Работа внеси задачи исправить договор сходить к нотариусу» → {{ "action": "create", "entity_type": "list", "list": "Работа", "tasks": ["Исправить договор", "Сходить к нотариусу"] }}
-- «В список Домашние дела добавь постирать ковер помыть машину купить маленький нож» → {{ "action": "add_task", "entity_type": "task", "list": "Домашние дела", "tasks": ["Постирать ковер", "Помыть машину", "Купить маленький нож"] }}
-- «Лук молоко хлеб куплены» → {{ "action": "mark_done", "entity_type": "task", "list": "Домашние дела", "tasks": ["Купить лук", "Купить молоко", "Купить хлеб"], "meta": {{ "fuzzy": true }} }}
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
 - «Переименуй список Покупки в Шопинг» → {{ "action": "rename_list", "entity_type": "list", "list": "Покупки", "title": "Шопинг" }}
 - «Из списка Работа пункт Сделать уборку в гараже Перенеси в Домашние дела» → {{ "action": "move_entity", "entity_type": "task", "title": "Сделать уборку в гараже", "list": "Работа", "to_list": "Домашние дела", "meta": {{ "fuzzy": true }} }}
 - «Сходить к нотариусу выполнен-конец» → {{ "action": "mark_done", "entity_type": "task", "list": "<последний список>", "title": "Сходить к нотариусу" }}
 - «Покажи Домашние дела» → {{ "action": "show_tasks", "entity_type": "task", "list": "Домашние дела" }}
-<<<<<<< HEAD
 - «Покажи Домашние дела» (списка ещё нет) → {{ "action": "clarify", "meta": {{ "question": "Списка *Домашние дела* нет. Создать?", "pending": "Домашние дела" }} }}
 - «Покажи все мои дела» → {{ "action": "show_all_tasks", "entity_type": "task" }}
 - «Найди задачи с договор» → {{ "action": "search_entity", "entity_type": "task", "meta": {{ "pattern": "договор" }} }}
 - «Покажи выполненные задачи» → {{ "action": "show_completed_tasks", "entity_type": "task" }}
 - «Покажи удалённые задачи» → {{ "action": "show_deleted_tasks", "entity_type": "task" }}
-=======
-- «Покажи все мои дела» → {{ "action": "show_all_tasks", "entity_type": "task" }}
-- «Найди задачи с договор» → {{ "action": "search_entity", "entity_type": "task", "meta": {{ "pattern": "договор" }} }}
-- «Покажи выполненные задачи» → {{ "action": "show_completed_tasks", "entity_type": "task" }}
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
 - «Я живу в Алматы, работаю в продажах» → {{ "action": "update_profile", "entity_type": "user_profile", "meta": {{ "city": "Алматы", "profession": "продажи" }} }}
 - «Восстанови задачу Позвонить клиенту в список Работа» → {{ "action": "restore_task", "entity_type": "task", "list": "Работа", "title": "Позвонить клиенту", "meta": {{ "fuzzy": true }} }}
+- «Верни удалённый список Шопинг» → {{ "action": "restore_task", "entity_type": "list", "list": "Шопинг" }}
 - «Удали список Шопинг» → {{ "action": "clarify", "meta": {{ "question": "Уверен, что хочешь удалить список Шопинг? Скажи 'да' или 'нет'.", "pending": "Шопинг" }} }}
 - «Да» (после удаления списка) → {{ "action": "delete_list", "entity_type": "list", "list": "{pending_delete}" }}
 - «Измени четвёртый пункт в списке Работа на Проверить баги» → {{ "action": "update_task", "entity_type": "task", "list": "Работа", "meta": {{ "by_index": 4, "new_title": "Проверить баги" }} }}
 """
-<<<<<<< HEAD
-=======
-
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
 # ========= Helpers =========
 def extract_json_blocks(s: str):
     try:
         data = json.loads(s)
         if isinstance(data, list):
-<<<<<<< HEAD
             logger.info(f"Extracted JSON list: {data}")
             return data
         if isinstance(data, dict):
@@ -982,15 +954,6 @@ def extract_json_blocks(s: str):
             return [data]
     except Exception:
         logger.exception("Failed to parse JSON directly: %s", s[:120])
-=======
-            logging.info(f"Extracted JSON list: {data[0]}")
-            return [data[0]]  # Take first JSON to avoid duplicates
-        if isinstance(data, dict):
-            logging.info(f"Extracted JSON dict: {data}")
-            return [data]
-    except Exception:
-        logging.warning(f"Failed to parse JSON directly: {s[:120]}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
     blocks = re.findall(r'\{[^{}]*\{[^{}]*\}[^{}]*\}|\{[^{}]+\}', s, re.DOTALL)
     if not blocks:
         blocks = re.findall(r'\{[^{}]+\}', s, re.DOTALL)
@@ -998,7 +961,6 @@ def extract_json_blocks(s: str):
     for b in blocks:
         try:
             parsed = json.loads(b)
-<<<<<<< HEAD
             logger.info(f"Extracted JSON block: {parsed}")
             out.append(parsed)
         except Exception:
@@ -1006,24 +968,12 @@ def extract_json_blocks(s: str):
     return out
 def wants_expand(text: str) -> bool:
     return bool(re.search(r'\b(разверну|подробн)\w*', (text or "").lower()))
-=======
-            logging.info(f"Extracted JSON block: {parsed}")
-            out.append(parsed)
-        except Exception:
-            logging.warning(f"Skip invalid JSON block: {b[:120]}")
-    return out[:1]  # Limit to one action to avoid duplicates
-
-def wants_expand(text: str) -> bool:
-    return bool(re.search(r'\b(разверну|подробн)\w*', (text or "").lower()))
-
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
 def text_mentions_list_and_name(text: str):
     m = re.search(r'(?:список|лист)\s+([^\n\r]+)$', (text or "").strip(), re.IGNORECASE)
     if m:
         name = m.group(1).strip(" .!?:;«»'\"").strip()
         return name
     return None
-<<<<<<< HEAD
 def extract_tasks_from_question(question: str) -> list[str]:
     if not question:
         return []
@@ -1076,6 +1026,8 @@ ACTION_SYNONYM_MAP: dict[str, tuple[str, str | None]] = {
     "restore_notes": ("restore_task", "task"),
     "restore_reminder": ("restore_task", "task"),
     "restore_reminders": ("restore_task", "task"),
+    "restore_list": ("restore_task", "list"),
+    "restore_lists": ("restore_task", "list"),
     "update_note": ("update_task", "task"),
     "update_reminder": ("update_task", "task"),
     "move_note": ("move_entity", "task"),
@@ -1493,16 +1445,12 @@ def parse_multi_list_creation(text: str) -> list[str]:
             seen.add(lowered)
             unique.append(item)
     return unique if len(unique) > 1 else []
-def build_semantic_state(conn, user_id: int, history: list[str] | None = None) -> tuple[dict, dict]:
-    lists = get_all_lists(conn, user_id)
-    list_tasks: dict[str, list[str]] = {}
-    for name in lists:
-        try:
-            tasks = get_list_tasks(conn, user_id, name)
-        except Exception:
-            logger.exception("Failed to fetch tasks for list %s while building semantic state", name)
-            tasks = []
-        list_tasks[name] = [title for _, title, _, _ in tasks[:10]]
+def build_semantic_state(store: Storage, user_id: int, history: list[str] | None = None) -> tuple[dict, dict]:
+    snapshot = store.get_user_snapshot(user_id)
+    list_tasks: dict[str, list[str]] = {
+        item["title"]: [title for _, title, _, _ in item["tasks"][:10]]
+        for item in snapshot
+    }
     last_list = get_ctx(user_id, "last_list")
     last_action = get_ctx(user_id, "last_action")
     pending_delete = get_ctx(user_id, "pending_delete")
@@ -1511,7 +1459,7 @@ def build_semantic_state(conn, user_id: int, history: list[str] | None = None) -
         "lists": list_tasks,
         "last_list": last_list,
         "pending_delete": pending_delete,
-        "total_lists": len(lists),
+        "total_lists": len(snapshot),
         "total_tasks": sum(len(items) for items in list_tasks.values()),
     }
     session_state: dict[str, Any] = {
@@ -1526,17 +1474,18 @@ def build_semantic_state(conn, user_id: int, history: list[str] | None = None) -
             "name": last_list,
             "tasks": list_tasks.get(last_list, []),
         }
-    recent_tasks = get_all_tasks(conn, user_id)
+    recent_tasks = [
+        {"list": item["title"], "title": title}
+        for item in snapshot
+        for _, title, _, _ in item["tasks"]
+    ]
     if recent_tasks:
-        session_state["recent_tasks"] = [
-            {"list": list_name, "title": title}
-            for list_name, title in recent_tasks[:10]
-        ]
+        session_state["recent_tasks"] = recent_tasks[:10]
     return db_state, session_state
 
 
 def process_task_additions(
-    conn,
+    store: Storage,
     user_id: int,
     list_name: str,
     tasks: list[str] | None,
@@ -1551,11 +1500,22 @@ def process_task_additions(
     }
     if not tasks:
         return results
-    for idx, raw_task in enumerate(tasks):
+    vectors = [_get_text_embedding(task) for task in tasks]
+    add_results = []
+    if force_first:
+        add_results = store.add_tasks(user_id, list_name, tasks[:1], force=True, vectors=vectors[:1])
+    add_results += store.add_tasks(
+        user_id,
+        list_name,
+        tasks[len(add_results):],
+        stop_on_duplicate=True,
+        vectors=vectors[len(add_results):],
+    )
+    emoji_updates: list[tuple[int, dict[str, Any]]] = []
+    for idx, (raw_task, add_result) in enumerate(zip(tasks, add_results)):
         if not raw_task:
             continue
         force = force_first and idx == 0
-        add_result = add_task(conn, user_id, list_name, raw_task, force=force)
         title_to_use = add_result.get("title") or raw_task
         if add_result.get("duplicate_detected"):
             similarity = add_result.get("similarity") or 0.0
@@ -1577,8 +1537,12 @@ def process_task_additions(
         if add_result.get("created") or add_result.get("restored"):
             task_id = add_result.get("id")
             emoji_meta: dict[str, Any] | None = None
-            if task_id:
-                emoji_meta = assign_task_emoji(conn, task_id, title_to_use)
+            if task_id and add_result.get("created"):
+                emoji_meta = _with_task_emoji(title_to_use, {})
+                if emoji_meta:
+                    emoji_updates.append((task_id, emoji_meta))
+            elif task_id:
+                emoji_meta = assign_task_emoji(store, task_id, title_to_use)
             results["added"].append({"title": title_to_use, "meta": emoji_meta or {}})
         elif add_result.get("duplicate_detected"):
             results["auto_used"].append(
@@ -1590,6 +1554,8 @@ def process_task_additions(
             )
         else:
             results["skipped"].append(raw_task)
+    if emoji_updates:
+        store.set_entities_meta(emoji_updates)
     return results
 
 
@@ -1649,7 +1615,7 @@ def build_list_duplicate_question(requested: str, existing: str) -> str:
     )
 async def perform_create_list(
     target: Any,
-    conn,
+    store: AsyncStorage,
     user_id: int,
     list_name: str,
     tasks: list[str] | None = None,
@@ -1658,7 +1624,7 @@ async def perform_create_list(
 ) -> bool:
     try:
         logger.info(f"Creating list: {list_name}")
-        result = create_list(conn, user_id, list_name, force=force)
+        result = await store.create_list(user_id, list_name, force=force)
         message_obj = getattr(target, "message", None)
         if message_obj is None:
             message_obj = target
@@ -1675,13 +1641,13 @@ async def perform_create_list(
                 message_parts = [
                     f"⚠️ Список “{existing_title}” уже существует. Использую его."
                 ]
-                task_results = process_task_additions(conn, user_id, existing_title, tasks)
+                task_results = await store.run(process_task_additions, user_id, existing_title, tasks)
                 message_parts.extend(compose_task_feedback(existing_title, task_results))
-                list_block = format_list_output(
-                    conn,
+                list_block = await store.run(
+                    format_list_output,
                     user_id,
                     existing_title,
-                    heading_label=format_section_title("Актуальный список"),
+                    heading_label=format_section_title(CURRENT_LIST_LABEL),
                 )
                 message_parts.append(list_block)
                 await message_obj.reply_text("\n\n".join(message_parts), parse_mode="Markdown")
@@ -1725,7 +1691,7 @@ async def perform_create_list(
         action_icon = get_action_icon("create")
         list_title = result.get("title") or list_name
         list_id = result.get("id")
-        list_meta = assign_list_emoji(conn, list_id, list_title) if list_id else {}
+        list_meta = await store.run(assign_list_emoji, list_id, list_title) if list_id else {}
         list_suffix = _emoji_suffix(list_title, entity_type="list", meta=list_meta)
         if VISUAL_STYLE in {"MINIMAL", "SOFT"}:
             header = f"{action_icon} Создан новый список {LIST_ICON} {list_title}{list_suffix} ✨"
@@ -1734,14 +1700,14 @@ async def perform_create_list(
         else:
             header = f"{action_icon} Создан новый список: {list_title}{list_suffix} ✨"
         list_name = list_title
-        task_results = process_task_additions(conn, user_id, list_name, tasks)
+        task_results = await store.run(process_task_additions, user_id, list_name, tasks)
         message_parts = [header]
         message_parts.extend(compose_task_feedback(list_name, task_results))
-        list_block = format_list_output(
-            conn,
+        list_block = await store.run(
+            format_list_output,
             user_id,
             list_name,
-            heading_label=format_section_title("Актуальный список"),
+            heading_label=format_section_title(CURRENT_LIST_LABEL),
         )
         message_parts.append(list_block)
         await message_obj.reply_text("\n\n".join(message_parts), parse_mode="Markdown")
@@ -1775,21 +1741,21 @@ async def perform_create_list(
             message_obj = target
         await message_obj.reply_text("⚠️ Не удалось создать список. Проверь логи.")
         return False
-def map_tasks_to_lists(conn, user_id: int, task_titles: list[str]) -> dict[str, str]:
+def map_tasks_to_lists(store: Storage, user_id: int, task_titles: list[str]) -> dict[str, str]:
     mapping: dict[str, str] = {}
     if not task_titles:
         return mapping
     lowered_targets = {title.lower(): title for title in task_titles}
-    for list_name in get_all_lists(conn, user_id):
-        items = [title.lower() for _, title, _, _ in get_list_tasks(conn, user_id, list_name)]
+    for item in store.get_user_snapshot(user_id):
+        items = {title.lower() for _, title, _, _ in item["tasks"]}
         for raw_lower, original in lowered_targets.items():
             if raw_lower in items and original not in mapping:
-                mapping[original] = list_name
+                mapping[original] = item["title"]
     return mapping
 async def handle_pending_confirmation(
     message,
     context: ContextTypes.DEFAULT_TYPE,
-    conn,
+    store: AsyncStorage,
     user_id: int,
     pending_confirmation: dict,
     response: str,
@@ -1830,19 +1796,19 @@ async def handle_pending_confirmation(
         if requested:
             tasks_to_process.append(requested)
         tasks_to_process.extend(remaining)
-        task_results = process_task_additions(
-            conn,
+        task_results = await store.run(
+            process_task_additions,
             user_id,
             list_name,
             tasks_to_process,
             force_first=True,
         )
         message_parts = compose_task_feedback(list_name, task_results)
-        list_block = format_list_output(
-            conn,
+        list_block = await store.run(
+            format_list_output,
             user_id,
             list_name,
-            heading_label=format_section_title("Актуальный список"),
+            heading_label=format_section_title(CURRENT_LIST_LABEL),
         )
         if message_parts:
             message_parts.append(list_block)
@@ -1886,7 +1852,7 @@ async def handle_pending_confirmation(
         set_ctx(user_id, pending_confirmation=None)
         handled = await perform_create_list(
             message,
-            conn,
+            store,
             user_id,
             list_to_create,
             tasks,
@@ -1907,7 +1873,7 @@ async def handle_pending_confirmation(
         base_list = pending_confirmation.get("list") or get_ctx(user_id, "last_list")
         task_to_list = {task: base_list for task in tasks if base_list}
         if not base_list:
-            task_to_list.update(map_tasks_to_lists(conn, user_id, tasks))
+            task_to_list.update(await store.run(map_tasks_to_lists, user_id, tasks, write=False))
         deleted_entries = []
         failed_entries = []
         for task in tasks:
@@ -1915,7 +1881,7 @@ async def handle_pending_confirmation(
             if not target_list:
                 failed_entries.append((None, task))
                 continue
-            deleted, matched = delete_task_fuzzy(conn, user_id, target_list, task)
+            deleted, matched = await store.delete_task_fuzzy(user_id, target_list, task)
             if deleted:
                 deleted_entries.append((target_list, matched or task))
             else:
@@ -1953,7 +1919,7 @@ async def handle_pending_confirmation(
             await message.reply_text("Ок, не создаю список.")
             set_ctx(user_id, pending_confirmation=None)
             return "cancel_create"
-        existing = find_list(conn, user_id, list_to_create)
+        existing = await store.find_list(user_id, list_to_create)
         if existing:
             await message.reply_text(
                 f"⚠️ Список *{list_to_create}* уже существует.",
@@ -1961,7 +1927,7 @@ async def handle_pending_confirmation(
             )
             set_ctx(user_id, pending_confirmation=None, last_list=list_to_create)
             return None
-        handled = await perform_create_list(message, conn, user_id, list_to_create)
+        handled = await perform_create_list(message, store, user_id, list_to_create)
         set_ctx(user_id, pending_confirmation=None)
         return "create" if handled else None
     if conf_type == "use_existing_list":
@@ -1975,14 +1941,14 @@ async def handle_pending_confirmation(
             set_ctx(user_id, pending_confirmation=None)
             return "cancel_use_existing_list"
         tasks = pending_confirmation.get("tasks") or []
-        task_results = process_task_additions(conn, user_id, existing_title, tasks)
+        task_results = await store.run(process_task_additions, user_id, existing_title, tasks)
         message_parts = [f"⚠️ Использую существующий список “{existing_title}”."]
         message_parts.extend(compose_task_feedback(existing_title, task_results))
-        list_block = format_list_output(
-            conn,
+        list_block = await store.run(
+            format_list_output,
             user_id,
             existing_title,
-            heading_label=format_section_title("Актуальный список"),
+            heading_label=format_section_title(CURRENT_LIST_LABEL),
         )
         message_parts.append(list_block)
         await message.reply_text("\n\n".join(message_parts), parse_mode="Markdown")
@@ -2025,19 +1991,19 @@ async def handle_pending_confirmation(
         if requested:
             tasks_to_process.append(requested)
         tasks_to_process.extend(remaining)
-        task_results = process_task_additions(
-            conn,
+        task_results = await store.run(
+            process_task_additions,
             user_id,
             list_name,
             tasks_to_process,
             force_first=True,
         )
         message_parts = compose_task_feedback(list_name, task_results)
-        list_block = format_list_output(
-            conn,
+        list_block = await store.run(
+            format_list_output,
             user_id,
             list_name,
-            heading_label=format_section_title("Актуальный список"),
+            heading_label=format_section_title(CURRENT_LIST_LABEL),
         )
         if message_parts:
             message_parts.append(list_block)
@@ -2072,27 +2038,132 @@ async def handle_pending_confirmation(
     )
     set_ctx(user_id, pending_confirmation=None)
     return None
-=======
-
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
 async def send_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [["Показать списки", "Создать список"], ["Добавить задачу", "Помощь"]]
     reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, selective=True)
     await update.message.reply_text("Выбери действие или напиши/скажи:", reply_markup=reply_markup)
-<<<<<<< HEAD
-async def expand_all_lists(update: Update, conn, user_id: int, context: ContextTypes.DEFAULT_TYPE):
-    lists = get_all_lists(conn, user_id)
+async def expand_all_lists(update: Update, store: AsyncStorage, user_id: int, context: ContextTypes.DEFAULT_TYPE):
+    lists = await store.get_all_lists(user_id)
     if not lists:
         await update.message.reply_text(
             f"{ALL_LISTS_ICON} Пока нет списков.",
             parse_mode="Markdown",
         )
         return
-    message = show_all_lists(conn, user_id)
+    message = await store.run(show_all_lists, user_id, write=False)
     await update.message.reply_text(message, parse_mode="Markdown")
     set_ctx(user_id, last_action="show_lists")
-async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, actions: list, user_id: int, original_text: str) -> list[str]:
-    conn = get_conn()
+def is_read_only_batch(actions: list, user_id: int) -> bool:
+    """True when ``actions`` only display data, so no write transaction is needed."""
+
+    if get_ctx(user_id, "pending_delete") or get_ctx(user_id, "pending_confirmation"):
+        return False
+    normalized = normalize_action_payloads(actions)
+    return bool(normalized) and all(obj.get("action") in READ_ONLY_ACTIONS for obj in normalized)
+
+
+def _semantic_targets(actions: list, user_id: int, original_text: str) -> list[tuple[str, str]]:
+    """``(title, entity_type)`` pairs that a batch may create or rename."""
+
+    targets: list[tuple[str, str]] = [(CURRENT_LIST_LABEL, "list")]
+    pending = get_ctx(user_id, "pending_confirmation")
+    if isinstance(pending, dict) and original_text.strip().lower() in YES_ANSWERS:
+        if pending.get("entity_type") == "list":
+            targets.append((pending.get("title"), "list"))
+            targets.extend((task, "task") for task in pending.get("tasks") or [])
+        else:
+            targets.append((pending.get("title") or pending.get("requested_title"), "task"))
+            targets.extend((task, "task") for task in pending.get("remaining_tasks") or [])
+    for obj in normalize_action_payloads(actions):
+        action = obj.get("action")
+        title = obj.get("title") or obj.get("task")
+        if action == "create":
+            targets.append((obj.get("list"), "list"))
+            targets.extend((task, "task") for task in obj.get("tasks") or [])
+        elif action == "create_multiple":
+            targets.extend((list_title, "list") for list_title in obj.get("lists") or [])
+        elif action == "add_task":
+            tasks = obj.get("tasks") or ([title] if title else [])
+            list_name = obj.get("list") or get_ctx(user_id, "last_list")
+            if not tasks and list_name:
+                tasks = extract_task_list_from_command(original_text, list_name)
+            targets.extend((task, "task") for task in tasks)
+        elif action == "rename_list":
+            targets.append((title, "list"))
+        elif action == "update_task":
+            targets.append(((obj.get("meta") or {}).get("new_title"), "task"))
+    return [(title.strip(), entity_type) for title, entity_type in targets if isinstance(title, str) and title.strip()]
+
+
+def prepare_semantics(targets: list[tuple[str, str]]) -> None:
+    """Compute title embeddings and emoji decisions ahead of a storage unit.
+
+    Inside the unit both are read from the caches filled here, so the write
+    transaction only runs SQL and never waits on the model.
+    """
+
+    _prefetch_embeddings([title for title, _ in targets])
+    for title, entity_type in targets:
+        _emoji_decision(title, entity_type)
+
+
+@asynccontextmanager
+async def storage_unit(store: AsyncStorage, actions: list, user_id: int, label: str, original_text: str = ""):
+    if is_read_only_batch(actions, user_id):
+        yield None
+        return
+    await asyncio.to_thread(prepare_semantics, _semantic_targets(actions, user_id, original_text))
+    async with store.transaction(label) as stats:
+        token = _UNIT_OPEN.set(True)
+        try:
+            yield stats
+        finally:
+            _UNIT_OPEN.reset(token)
+
+
+class _DeferredMessage:
+    def __init__(self, message: Any, outbox: list[tuple[tuple, dict]]) -> None:
+        self._message = message
+        self._outbox = outbox
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._message, name)
+
+    async def reply_text(self, *args: Any, **kwargs: Any) -> None:
+        self._outbox.append((args, kwargs))
+
+
+class DeferredReplies:
+    """Stand-in for ``update`` whose ``message.reply_text`` calls are queued.
+
+    Handlers run against it inside a storage unit so no Telegram round-trip
+    happens while the write transaction is open; :meth:`flush` sends the
+    replies once the unit has committed.  Replies queued by a unit that
+    raises are dropped along with its writes.
+    """
+
+    def __init__(self, update: Update) -> None:
+        self._update = update
+        self._outbox: list[tuple[tuple, dict]] = []
+        self.message = _DeferredMessage(update.message, self._outbox)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._update, name)
+
+    async def flush(self) -> None:
+        outbox, self._outbox[:] = list(self._outbox), []
+        for args, kwargs in outbox:
+            await self._update.message.reply_text(*args, **kwargs)
+
+
+async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, actions: list, user_id: int, original_text: str, store: AsyncStorage | None = None) -> list[str]:
+    if store is None:
+        store = get_async_storage().for_user(user_id)
+        replies = DeferredReplies(update)
+        async with storage_unit(store, actions, user_id, "route_actions", original_text):
+            executed = await route_actions(replies, context, actions, user_id, original_text, store=store)
+        await replies.flush()
+        return executed
     logger.info(f"Processing actions: {json.dumps(actions)}")
     normalized_actions = normalize_action_payloads(actions)
     normalized_actions = collapse_mark_done_actions(normalized_actions)
@@ -2103,38 +2174,10 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
     if original_text.lower() in ["да", "yes"] and pending_delete:
         try:
             logger.info(f"Deleting list: {pending_delete}")
-=======
-
-async def expand_all_lists(update: Update, conn, user_id: int, context: ContextTypes.DEFAULT_TYPE):
-    lists = get_all_lists(conn, user_id)
-    if not lists:
-        await update.message.reply_text("Пока нет списков 🕊")
-        return
-    txt = "🗂 Твои списки:\n"
-    for n in lists:
-        txt += f"📋 *{n}*:\n"
-        items = get_list_tasks(conn, user_id, n)
-        if items:
-            txt += "\n".join([f"{i}. {t}" for i, t in items])
-        else:
-            txt += "— пусто —"
-        txt += "\n"
-    await update.message.reply_text(txt, parse_mode="Markdown")
-    set_ctx(user_id, last_action="show_lists")
-
-async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, actions: list, user_id: int, original_text: str):
-    conn = get_conn()
-    logging.info(f"Processing actions: {json.dumps(actions)}")
-    pending_delete = get_ctx(user_id, "pending_delete")
-    if original_text.lower() in ["да", "yes"] and pending_delete:
-        try:
-            logging.info(f"Deleting list: {pending_delete}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
-            deleted = delete_list(conn, user_id, pending_delete)
+            deleted = await store.delete_list(user_id, pending_delete)
             if deleted:
                 await update.message.reply_text(f"🗑 Список *{pending_delete}* удалён.", parse_mode="Markdown")
                 set_ctx(user_id, pending_delete=None, last_list=None)
-<<<<<<< HEAD
                 logger.info(f"Confirmed delete_list: {pending_delete}")
                 executed_actions.append("delete_list")
             else:
@@ -2154,7 +2197,7 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
         handled = await handle_pending_confirmation(
             update.message,
             context,
-            conn,
+            store,
             user_id,
             pending_confirmation,
             normalized_reply,
@@ -2163,62 +2206,34 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
             executed_actions.append(handled)
         return executed_actions
     for obj in normalized_actions:
-=======
-                logging.info(f"Confirmed delete_list: {pending_delete}")
-            else:
-                await update.message.reply_text(f"⚠️ Список *{pending_delete}* не найден.")
-                set_ctx(user_id, pending_delete=None)
-            return
-        except Exception as e:
-            logging.exception(f"Delete error: {e}")
-            await update.message.reply_text("⚠️ Ошибка удаления.")
-            set_ctx(user_id, pending_delete=None)
-            return
-    elif original_text.lower() in ["нет", "no"] and pending_delete:
-        await update.message.reply_text("Удаление отменено.")
-        set_ctx(user_id, pending_delete=None)
-        return
-    for obj in actions:
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
         action = obj.get("action", "unknown")
         entity_type = obj.get("entity_type", "task")
         list_name = obj.get("list") or get_ctx(user_id, "last_list")
         title = obj.get("title") or obj.get("task")
         meta = obj.get("meta", {})
-<<<<<<< HEAD
         logger.info(f"Action: {action}, Entity: {entity_type}, List: {list_name}, Title: {title}")
-=======
-        logging.info(f"Action: {action}, Entity: {entity_type}, List: {list_name}, Title: {title}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
         if action not in ["delete_list", "clarify"] and get_ctx(user_id, "pending_delete"):
             set_ctx(user_id, pending_delete=None)
         if list_name == "<последний список>":
             list_name = get_ctx(user_id, "last_list")
-<<<<<<< HEAD
             logger.info(f"Resolved placeholder to last_list: {list_name}")
             if not list_name:
                 logger.warning("No last_list in context, asking for clarification")
-=======
-            logging.info(f"Resolved placeholder to last_list: {list_name}")
-            if not list_name:
-                logging.warning("No last_list in context, asking for clarification")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
                 await update.message.reply_text("🤔 Уточни, в какой список добавить задачу.")
                 await send_menu(update, context)
                 continue
         if action in ("unknown", None):
             if wants_expand(original_text) and get_ctx(user_id, "last_action") == "show_lists":
-                await expand_all_lists(update, conn, user_id, context)
+                await expand_all_lists(update, store, user_id, context)
                 continue
             name_from_text = text_mentions_list_and_name(original_text)
             if name_from_text:
                 list_name = name_from_text
                 action = "show_tasks"
                 entity_type = "task"
-<<<<<<< HEAD
                 logger.info(f"Fallback to show_tasks for list: {list_name}")
         if action == "create" and entity_type == "list" and obj.get("list"):
-            handled = await perform_create_list(update, conn, user_id, obj["list"], obj.get("tasks"))
+            handled = await perform_create_list(update, store, user_id, obj["list"], obj.get("tasks"))
             if handled:
                 executed_actions.append("create")
         elif action == "create_multiple" and entity_type == "list":
@@ -2227,7 +2242,7 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                 list_clean = (list_title or "").strip()
                 if not list_clean:
                     continue
-                handled = await perform_create_list(update, conn, user_id, list_clean)
+                handled = await perform_create_list(update, store, user_id, list_clean)
                 if handled:
                     created_any = True
             if created_any:
@@ -2238,13 +2253,13 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                 tasks = obj.get("tasks", []) or ([title] if title else [])
                 if not tasks:
                     tasks = extract_task_list_from_command(original_text, list_name)
-                task_results = process_task_additions(conn, user_id, list_name, tasks)
+                task_results = await store.run(process_task_additions, user_id, list_name, tasks)
                 message_parts = compose_task_feedback(list_name, task_results)
-                list_block = format_list_output(
-                    conn,
+                list_block = await store.run(
+                    format_list_output,
                     user_id,
                     list_name,
-                    heading_label=format_section_title("Актуальный список"),
+                    heading_label=format_section_title(CURRENT_LIST_LABEL),
                 )
                 if message_parts:
                     message_parts.append(list_block)
@@ -2287,14 +2302,14 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
         elif action == "show_lists":
             try:
                 logger.info("Showing all lists with tasks")
-                await expand_all_lists(update, conn, user_id, context)
+                await expand_all_lists(update, store, user_id, context)
             except Exception as e:
                 logger.exception(f"Show lists error: {e}")
                 await update.message.reply_text("⚠️ Не удалось получить списки. Проверь логи.")
         elif action == "show_tasks" and list_name:
             try:
                 logger.info(f"Showing tasks for list: {list_name}")
-                if not find_list(conn, user_id, list_name):
+                if not await store.find_list(user_id, list_name):
                     question = f"⚠️ Списка *{list_name}* нет. Создать?"
                     keyboard = [[
                         InlineKeyboardButton("Да", callback_data=f"create_list_yes:{list_name}"),
@@ -2312,12 +2327,13 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                         pending_delete=None,
                     )
                     continue
-                list_meta = ensure_list_emoji(conn, user_id, list_name)
-                message = format_list_output(
-                    conn,
+                list_meta = await store.run(ensure_list_emoji, user_id, list_name, write=False)
+                message = await store.run(
+                    format_list_output,
                     user_id,
                     list_name,
                     heading_label=format_section_title(list_name, list_meta),
+                    write=False,
                 )
                 await update.message.reply_text(message, parse_mode="Markdown")
                 set_ctx(user_id, last_action="show_tasks", last_list=list_name)
@@ -2327,22 +2343,9 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
         elif action == "show_all_tasks":
             try:
                 logger.info("Showing all tasks")
-                lists = get_all_lists(conn, user_id)
-                if not lists:
-                    await update.message.reply_text(
-                        f"{ALL_LISTS_ICON} Все задачи:\n_— пусто —_",
-                        parse_mode="Markdown",
-                    )
-                    set_ctx(user_id, last_action="show_all_tasks")
-                    continue
-                blocks = []
-                for n in lists:
-                    list_meta = ensure_list_emoji(conn, user_id, n)
-                    heading = format_section_title(n, list_meta)
-                    blocks.append(
-                        format_list_output(conn, user_id, n, heading_label=heading)
-                    )
-                message = f"{ALL_LISTS_ICON} Все задачи:\n\n" + "\n\n".join(blocks)
+                message = await store.run(
+                    show_all_lists, user_id, heading_label=f"{ALL_LISTS_ICON} Все задачи:", write=False
+                )
                 await update.message.reply_text(message, parse_mode="Markdown")
                 set_ctx(user_id, last_action="show_all_tasks")
             except Exception as e:
@@ -2351,7 +2354,7 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
         elif action == "show_completed_tasks":
             try:
                 logger.info("Showing completed tasks")
-                tasks = get_completed_tasks(conn, user_id, limit=15)
+                tasks = await store.get_completed_tasks(user_id, limit=15)
                 if tasks:
                     lines = []
                     for list_title, task_title in tasks:
@@ -2370,7 +2373,7 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
         elif action == "show_deleted_tasks":
             try:
                 logger.info("Showing deleted tasks")
-                tasks = get_deleted_tasks(conn, user_id, limit=15)
+                tasks = await store.get_deleted_tasks(user_id, limit=15)
                 if tasks:
                     lines = []
                     for list_title, task_title in tasks:
@@ -2389,7 +2392,7 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
         elif action == "search_entity" and meta.get("pattern"):
             try:
                 logger.info(f"Searching tasks with pattern: {meta['pattern']}")
-                tasks = search_tasks(conn, user_id, meta["pattern"])
+                tasks = await store.search_tasks(user_id, meta["pattern"])
                 if tasks:
                     grouped: dict[str, list[str]] = {}
                     for list_title, task_title in tasks:
@@ -2398,7 +2401,7 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                     blocks = []
                     for list_display, titles in grouped.items():
                         list_meta = (
-                            ensure_list_emoji(conn, user_id, list_display)
+                            await store.run(ensure_list_emoji, user_id, list_display, write=False)
                             if list_display and list_display != "Без списка"
                             else {}
                         )
@@ -2407,205 +2410,75 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                         for i, task_title in enumerate(titles, start=1):
                             task_meta: dict[str, Any] = {}
                             if list_display and list_display != "Без списка":
-                                task_row = fetch_task(conn, user_id, list_display, task_title)
+                                task_row = await store.fetch_task(user_id, list_display, task_title)
                                 if task_row and task_row["id"]:
-                                    task_meta = assign_task_emoji(
-                                        conn, task_row["id"], task_row["title"]
-                                    )
+                                    task_meta = json.loads(task_row["meta"] or "{}")
+                                    if "emoji" not in task_meta:
+                                        task_meta = await store.run(
+                                            assign_task_emoji,
+                                            task_row["id"],
+                                            task_row["title"],
+                                            write=False,
+                                        )
                             lines.append(
                                 format_task_line(i, task_title, meta=task_meta)
                             )
                         blocks.append(f"{heading}\n" + "\n".join(lines))
                     message = f"{ALL_LISTS_ICON} Найденные задачи:\n\n" + "\n\n".join(blocks)
                     await update.message.reply_text(message, parse_mode="Markdown")
-=======
-                logging.info(f"Fallback to show_tasks for list: {list_name}")
-        if action == "create" and entity_type == "list" and obj.get("list"):
-            try:
-                logging.info(f"Creating list: {obj['list']}")
-                create_list(conn, user_id, obj["list"])
-                if obj.get("tasks"):
-                    added_tasks = []
-                    for t in obj["tasks"]:
-                        task_id = add_task(conn, user_id, obj["list"], t)
-                        if task_id:
-                            added_tasks.append(t)
-                    if added_tasks:
-                        await update.message.reply_text(f"🆕 Создан список *{obj['list']}* с задачами: {', '.join(added_tasks)}", parse_mode="Markdown")
-                    else:
-                        await update.message.reply_text(f"🆕 Создан список *{obj['list']}*, но задачи уже существуют.", parse_mode="Markdown")
-                else:
-                    await update.message.reply_text(f"🆕 Создан список *{obj['list']}*", parse_mode="Markdown")
-                set_ctx(user_id, last_action="create_list", last_list=obj["list"])
-            except Exception as e:
-                logging.exception(f"Create list error: {e}")
-                await update.message.reply_text("⚠️ Не удалось создать список. Проверь логи.")
-        elif action == "add_task" and list_name:
-            try:
-                logging.info(f"Adding tasks to list: {list_name}")
-                added_tasks = []
-                if obj.get("tasks"):
-                    for t in obj["tasks"]:
-                        task_id = add_task(conn, user_id, list_name, t)
-                        if task_id:
-                            added_tasks.append(t)
-                    if added_tasks:
-                        await update.message.reply_text(f"✅ Добавлены задачи в *{list_name}*: {', '.join(added_tasks)}", parse_mode="Markdown")
-                    else:
-                        await update.message.reply_text(f"⚠️ Все указанные задачи уже есть в списке *{list_name}*.")
-                elif title:
-                    task_id = add_task(conn, user_id, list_name, title)
-                    if task_id:
-                        await update.message.reply_text(f"✅ Добавлено: *{title}* в список *{list_name}*", parse_mode="Markdown")
-                    else:
-                        await update.message.reply_text(f"⚠️ Задача *{title}* уже есть в списке *{list_name}*.")
-                set_ctx(user_id, last_action="add_task", last_list=list_name)
-            except Exception as e:
-                logging.exception(f"Add task error: {e}")
-                await update.message.reply_text("⚠️ Не удалось добавить задачу. Проверь логи.")
-        elif action == "show_lists":
-            try:
-                logging.info("Showing all lists with tasks")
-                lists = get_all_lists(conn, user_id)
-                if not lists:
-                    await update.message.reply_text("Пока нет списков 🕊")
-                    set_ctx(user_id, last_action="show_lists")
-                    continue
-                txt = "🗂 Твои списки:\n"
-                for n in lists:
-                    txt += f"📋 *{n}*:\n"
-                    items = get_list_tasks(conn, user_id, n)
-                    if items:
-                        txt += "\n".join([f"{i}. {t}" for i, t in items])
-                    else:
-                        txt += "— пусто —"
-                    txt += "\n"
-                await update.message.reply_text(txt, parse_mode="Markdown")
-                set_ctx(user_id, last_action="show_lists")
-            except Exception as e:
-                logging.exception(f"Show lists error: {e}")
-                await update.message.reply_text("⚠️ Не удалось получить списки. Проверь логи.")
-        elif action == "show_tasks" and list_name:
-            try:
-                logging.info(f"Showing tasks for list: {list_name}")
-                items = get_list_tasks(conn, user_id, list_name)
-                if items:
-                    txt = "\n".join([f"{i}. {t}" for i, t in items])
-                    await update.message.reply_text(f"📋 *{list_name}:*\n{txt}", parse_mode="Markdown")
-                else:
-                    await update.message.reply_text(f"Список *{list_name}* пуст.", parse_mode="Markdown")
-                set_ctx(user_id, last_action="show_tasks", last_list=list_name)
-            except Exception as e:
-                logging.exception(f"Show tasks error: {e}")
-                await update.message.reply_text("⚠️ Не удалось получить задачи. Проверь логи.")
-        elif action == "show_all_tasks":
-            try:
-                logging.info("Showing all tasks")
-                lists = get_all_lists(conn, user_id)
-                if not lists:
-                    await update.message.reply_text("Пока нет дел 🕊")
-                    set_ctx(user_id, last_action="show_all_tasks")
-                    continue
-                txt = "🗂 Все твои дела:\n"
-                for n in lists:
-                    txt += f"📋 *{n}*:\n"
-                    items = get_list_tasks(conn, user_id, n)
-                    if items:
-                        txt += "\n".join([f"{i}. {t}" for i, t in items])
-                    else:
-                        txt += "— пусто —"
-                    txt += "\n"
-                await update.message.reply_text(txt, parse_mode="Markdown")
-                set_ctx(user_id, last_action="show_all_tasks")
-            except Exception as e:
-                logging.exception(f"Show all tasks error: {e}")
-                await update.message.reply_text("⚠️ Не удалось получить дела. Проверь логи.")
-        elif action == "search_entity" and meta.get("pattern"):
-            try:
-                logging.info(f"Searching tasks with pattern: {meta['pattern']}")
-                tasks = search_tasks(conn, user_id, meta["pattern"])
-                if tasks:
-                    txt = "🗂 Найденные задачи:\n"
-                    for list_title, task_title in tasks:
-                        txt += f"📋 *{list_title}*: {task_title}\n"
-                    await update.message.reply_text(txt, parse_mode="Markdown")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
                 else:
                     await update.message.reply_text(f"Задачи с '{meta['pattern']}' не найдены.")
                 set_ctx(user_id, last_action="search_entity")
             except Exception as e:
-<<<<<<< HEAD
                 logger.exception(f"Search tasks error: {e}")
-=======
-                logging.exception(f"Search tasks error: {e}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
                 await update.message.reply_text("⚠️ Не удалось найти задачи. Проверь логи.")
         elif action == "delete_task":
             try:
                 ln = list_name or get_ctx(user_id, "last_list")
                 if not ln:
-<<<<<<< HEAD
                     logger.info("No list name provided for delete_task")
-=======
-                    logging.info("No list name provided for delete_task")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
                     await update.message.reply_text("🤔 Уточни, из какого списка удалить.")
                     await send_menu(update, context)
                     continue
                 if meta.get("by_index"):
-<<<<<<< HEAD
                     logger.info(f"Deleting task by index: {meta['by_index']} in list: {ln}")
-                    deleted, matched = delete_task_by_index(conn, user_id, ln, meta["by_index"])
+                    deleted, matched = await store.delete_task_by_index(user_id, ln, meta["by_index"])
                 else:
                     logger.info(f"Deleting task fuzzy: {title} in list: {ln}")
-                    deleted, matched = delete_task_fuzzy(conn, user_id, ln, title)
+                    deleted, matched = await store.delete_task_fuzzy(user_id, ln, title)
                 if deleted:
                     action_icon = get_action_icon("delete_task")
                     task_name = matched or title or "задача"
-                    list_meta = ensure_list_emoji(conn, user_id, ln)
+                    list_meta = await store.run(ensure_list_emoji, user_id, ln)
                     list_suffix = _emoji_suffix(ln, entity_type="list", meta=list_meta)
                     if VISUAL_STYLE == "VIBRANT":
                         header = f"{action_icon} Удалено из {ln}{list_suffix}:"
                     else:
                         header = f"{action_icon} Удалено из {LIST_ICON} {ln}{list_suffix}:"
                     details = format_task_bullet(action_icon, task_name)
-                    list_block = format_list_output(
-                        conn,
+                    list_block = await store.run(
+                        format_list_output,
                         user_id,
                         ln,
                         heading_label=format_section_title(ln, list_meta),
                     )
                     message = f"{header}\n{details}\n\n{list_block}"
                     await update.message.reply_text(message, parse_mode="Markdown")
-=======
-                    logging.info(f"Deleting task by index: {meta['by_index']} in list: {ln}")
-                    deleted, matched = delete_task_by_index(conn, user_id, ln, meta["by_index"])
-                else:
-                    logging.info(f"Deleting task fuzzy: {title} in list: {ln}")
-                    deleted, matched = delete_task_fuzzy(conn, user_id, ln, title)
-                if deleted:
-                    await update.message.reply_text(f"🗑 Удалено: *{matched}* из *{ln}*", parse_mode="Markdown")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
                 else:
                     await update.message.reply_text("⚠️ Задача не найдена или уже выполнена.")
                 set_ctx(user_id, last_action="delete_task", last_list=ln)
             except Exception as e:
-<<<<<<< HEAD
                 logger.exception(f"Delete task error: {e}")
-=======
-                logging.exception(f"Delete task error: {e}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
                 await update.message.reply_text("⚠️ Не удалось удалить задачу. Проверь логи.")
         elif action == "delete_list" and entity_type == "list" and list_name:
             try:
                 pending_delete = get_ctx(user_id, "pending_delete")
                 if pending_delete == list_name and original_text.lower() in ["да", "yes"]:
-<<<<<<< HEAD
                     logger.info(f"Deleting list: {list_name}")
-                    deleted = delete_list(conn, user_id, list_name)
+                    deleted = await store.delete_list(user_id, list_name)
                     if deleted:
-                        remaining = show_all_lists(
-                            conn,
+                        remaining = await store.run(
+                            show_all_lists,
                             user_id,
                             heading_label=f"{ALL_LISTS_ICON} Оставшиеся списки:",
                         )
@@ -2613,13 +2486,6 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                         await update.message.reply_text(message, parse_mode="Markdown")
                         set_ctx(user_id, last_action="delete_list", last_list=None, pending_delete=None)
                         executed_actions.append("delete_list")
-=======
-                    logging.info(f"Deleting list: {list_name}")
-                    deleted = delete_list(conn, user_id, list_name)
-                    if deleted:
-                        await update.message.reply_text(f"🗑 Список *{list_name}* удалён.", parse_mode="Markdown")
-                        set_ctx(user_id, last_action="delete_list", last_list=None, pending_delete=None)
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
                     else:
                         await update.message.reply_text(f"⚠️ Список *{list_name}* не найден.")
                         set_ctx(user_id, pending_delete=None)
@@ -2632,16 +2498,11 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                     await update.message.reply_text(f"🤔 Уверен, что хочешь удалить список *{list_name}*?", parse_mode="Markdown", reply_markup=reply_markup)
                     set_ctx(user_id, pending_delete=list_name)
             except Exception as e:
-<<<<<<< HEAD
                 logger.exception(f"Delete list error: {e}")
-=======
-                logging.exception(f"Delete list error: {e}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
                 await update.message.reply_text("⚠️ Не удалось удалить список. Проверь логи.")
                 set_ctx(user_id, pending_delete=None)
         elif action == "mark_done" and list_name:
             try:
-<<<<<<< HEAD
                 logger.info(f"Marking tasks done in list: {list_name}")
                 tasks_to_mark: list[str] = []
                 if obj.get("tasks"):
@@ -2652,25 +2513,25 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                         tasks_to_mark = multi
                     else:
                         tasks_to_mark = [title]
-                completed_tasks: list[str] = []
-                for task_phrase in tasks_to_mark:
-                    logger.info(f"Marking task done: {task_phrase} in list: {list_name}")
-                    deleted, matched = mark_task_done_fuzzy(conn, user_id, list_name, task_phrase)
-                    if deleted:
-                        completed_tasks.append(matched)
+                logger.info(f"Marking tasks done: {tasks_to_mark} in list: {list_name}")
+                completed_tasks = [
+                    matched
+                    for matched in await store.mark_tasks_done_bulk(user_id, list_name, tasks_to_mark)
+                    if matched
+                ]
                 if completed_tasks:
                     action_icon = get_action_icon("mark_done")
                     details = "\n".join(
                         format_task_bullet(action_icon, task) for task in completed_tasks
                     )
-                    list_meta = ensure_list_emoji(conn, user_id, list_name)
+                    list_meta = await store.run(ensure_list_emoji, user_id, list_name)
                     list_suffix = _emoji_suffix(list_name, entity_type="list", meta=list_meta)
                     if VISUAL_STYLE == "VIBRANT":
                         header = f"{action_icon} Готово в {list_name}{list_suffix}:"
                     else:
                         header = f"{action_icon} Готово в {LIST_ICON} {list_name}{list_suffix}:"
-                    list_block = format_list_output(
-                        conn,
+                    list_block = await store.run(
+                        format_list_output,
                         user_id,
                         list_name,
                         heading_label=format_section_title(list_name, list_meta),
@@ -2682,18 +2543,18 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                     await update.message.reply_text("⚠️ Не нашёл указанные задачи.")
                 elif title:
                     logger.info(f"Marking task done: {title} in list: {list_name}")
-                    deleted, matched = mark_task_done_fuzzy(conn, user_id, list_name, title)
+                    deleted, matched = await store.mark_task_done_fuzzy(user_id, list_name, title)
                     if deleted:
                         action_icon = get_action_icon("mark_done")
-                        list_meta = ensure_list_emoji(conn, user_id, list_name)
+                        list_meta = await store.run(ensure_list_emoji, user_id, list_name)
                         list_suffix = _emoji_suffix(list_name, entity_type="list", meta=list_meta)
                         if VISUAL_STYLE == "VIBRANT":
                             header = f"{action_icon} Готово в {list_name}{list_suffix}:"
                         else:
                             header = f"{action_icon} Готово в {LIST_ICON} {list_name}{list_suffix}:"
                         details = format_task_bullet(action_icon, matched)
-                        list_block = format_list_output(
-                            conn,
+                        list_block = await store.run(
+                            format_list_output,
                             user_id,
                             list_name,
                             heading_label=format_section_title(list_name, list_meta),
@@ -2701,41 +2562,21 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                         message = f"{header}\n{details}\n\n{list_block}"
                         await update.message.reply_text(message, parse_mode="Markdown")
                         executed_actions.append("mark_done")
-=======
-                logging.info(f"Marking tasks done in list: {list_name}")
-                if obj.get("tasks"):
-                    completed_tasks = []
-                    for t in obj["tasks"]:
-                        logging.info(f"Marking task done: {t} in list: {list_name}")
-                        deleted, matched = mark_task_done_fuzzy(conn, user_id, list_name, t)
-                        if deleted:
-                            completed_tasks.append(matched)
-                    if completed_tasks:
-                        await update.message.reply_text(f"✔️ Готово: {', '.join(completed_tasks)}.", parse_mode="Markdown")
-                    else:
-                        await update.message.reply_text("⚠️ Не нашёл указанные задачи.")
-                elif title:
-                    logging.info(f"Marking task done: {title} in list: {list_name}")
-                    deleted, matched = mark_task_done_fuzzy(conn, user_id, list_name, title)
-                    if deleted:
-                        await update.message.reply_text(f"✔️ Готово: *{matched}*.", parse_mode="Markdown")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
                     else:
                         await update.message.reply_text("⚠️ Не нашёл такую задачу.")
                 set_ctx(user_id, last_action="mark_done", last_list=list_name)
             except Exception as e:
-<<<<<<< HEAD
                 logger.exception(f"Mark done error: {e}")
                 await update.message.reply_text("⚠️ Не удалось отметить задачу. Проверь логи.")
         elif action == "rename_list" and entity_type == "list" and list_name and title:
             try:
                 logger.info(f"Renaming list: {list_name} to {title}")
-                list_row = find_list(conn, user_id, list_name)
-                renamed = rename_list(conn, user_id, list_name, title)
+                list_row = await store.find_list(user_id, list_name)
+                renamed = await store.rename_list(user_id, list_name, title)
                 if renamed:
                     new_meta = {}
                     if list_row and list_row["id"]:
-                        new_meta = assign_list_emoji(conn, list_row["id"], title)
+                        new_meta = await store.run(assign_list_emoji, list_row["id"], title)
                     icon = get_action_icon("rename_list")
                     suffix = _emoji_suffix(title, entity_type="list", meta=new_meta)
                     await update.message.reply_text(
@@ -2752,36 +2593,14 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
             try:
                 target_list_name = obj["to_list"]
                 logger.info(f"Moving {entity_type} '{title}' from {obj['list']} to {target_list_name}")
-                list_exists = find_list(conn, user_id, obj["list"])
-                to_list_exists = find_list(conn, user_id, target_list_name)
-=======
-                logging.exception(f"Mark done error: {e}")
-                await update.message.reply_text("⚠️ Не удалось отметить задачу. Проверь логи.")
-        elif action == "rename_list" and entity_type == "list" and list_name and title:
-            try:
-                logging.info(f"Renaming list: {list_name} to {title}")
-                renamed = rename_list(conn, user_id, list_name, title)
-                if renamed:
-                    await update.message.reply_text(f"🆕 Список *{list_name}* переименован в *{title}*.", parse_mode="Markdown")
-                    set_ctx(user_id, last_action="rename_list", last_list=title)
-                else:
-                    await update.message.reply_text(f"⚠️ Список *{list_name}* не найден или *{title}* уже существует.")
-            except Exception as e:
-                logging.exception(f"Rename list error: {e}")
-                await update.message.reply_text("⚠️ Не удалось переименовать список. Проверь логи.")
-        elif action == "move_entity" and entity_type and title and obj.get("list") and obj.get("to_list"):
-            try:
-                logging.info(f"Moving {entity_type} '{title}' from {obj['list']} to {obj['to_list']}")
-                list_exists = find_list(conn, user_id, obj["list"])
-                to_list_exists = find_list(conn, user_id, obj["to_list"])
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
+                list_exists = await store.find_list(user_id, obj["list"])
+                to_list_exists = await store.find_list(user_id, target_list_name)
                 if not list_exists:
                     await update.message.reply_text(f"⚠️ Список *{obj['list']}* не найден.")
                     continue
                 if not to_list_exists:
-<<<<<<< HEAD
                     logger.info(f"Creating target list '{target_list_name}' for user {user_id}")
-                    create_result = create_list(conn, user_id, target_list_name)
+                    create_result = await store.create_list(user_id, target_list_name)
                     if create_result.get("duplicate_detected"):
                         target_list_name = create_result.get("duplicate_title") or target_list_name
                         logger.info(
@@ -2790,22 +2609,14 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                         )
                 if meta.get("fuzzy"):
                     logger.info(f"Moving task fuzzy: {title} from {obj['list']} to {target_list_name}")
-=======
-                    logging.info(f"Creating target list '{obj['to_list']}' for user {user_id}")
-                    create_list(conn, user_id, obj["to_list"])
-                if meta.get("fuzzy"):
-                    logging.info(f"Moving task fuzzy: {title} from {obj['list']} to {obj['to_list']}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
-                    tasks = get_list_tasks(conn, user_id, obj["list"])
+                    tasks = await store.get_list_tasks(user_id, obj["list"])
                     matched = None
                     for _, task_title in tasks:
                         if title.lower() in task_title.lower():
                             matched = task_title
                             break
                     if matched:
-<<<<<<< HEAD
-                        updated = move_entity(
-                            conn,
+                        updated = await store.move_entity(
                             user_id,
                             entity_type,
                             matched,
@@ -2814,7 +2625,7 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                         )
                         if updated:
                             action_icon = get_action_icon("move_entity")
-                            target_list_meta = ensure_list_emoji(conn, user_id, target_list_name)
+                            target_list_meta = await store.run(ensure_list_emoji, user_id, target_list_name)
                             target_suffix = _emoji_suffix(
                                 target_list_name, entity_type="list", meta=target_list_meta
                             )
@@ -2824,13 +2635,13 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                                 else f"{LIST_ICON} {target_list_name}"
                             )
                             target_label = f"{target_label_base}{target_suffix}"
-                            task_row = fetch_task(conn, user_id, target_list_name, matched)
+                            task_row = await store.fetch_task(user_id, target_list_name, matched)
                             task_meta: dict[str, Any] = {}
                             task_display = matched
                             if task_row and task_row["id"]:
                                 task_display = task_row["title"]
-                                task_meta = assign_task_emoji(
-                                    conn, task_row["id"], task_row["title"]
+                                task_meta = await store.run(
+                                    assign_task_emoji, task_row["id"], task_row["title"]
                                 )
                             task_suffix = _emoji_suffix(
                                 task_display, entity_type="task", meta=task_meta
@@ -2838,8 +2649,8 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                             header = (
                                 f"{action_icon} Перемещено: {task_display}{task_suffix} → в {target_label}"
                             )
-                            list_block = format_list_output(
-                                conn,
+                            list_block = await store.run(
+                                format_list_output,
                                 user_id,
                                 target_list_name,
                                 heading_label=format_section_title(
@@ -2850,20 +2661,12 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                             await update.message.reply_text(message, parse_mode="Markdown")
                             set_ctx(user_id, last_action="move_entity", last_list=target_list_name)
                             executed_actions.append("move_entity")
-=======
-                        updated = move_entity(conn, user_id, entity_type, matched, obj["to_list"])
-                        if updated:
-                            await update.message.reply_text(f"🔄 Перемещено: *{matched}* в *{obj['to_list']}*.", parse_mode="Markdown")
-                            set_ctx(user_id, last_action="move_entity", last_list=obj["to_list"])
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
                         else:
                             await update.message.reply_text(f"⚠️ Не удалось переместить *{matched}*. Проверь, есть ли такая задача.")
                     else:
                         await update.message.reply_text(f"⚠️ Задача *{title}* не найдена в *{obj['list']}*.")
                 else:
-<<<<<<< HEAD
-                    updated = move_entity(
-                        conn,
+                    updated = await store.move_entity(
                         user_id,
                         entity_type,
                         title,
@@ -2872,7 +2675,7 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                     )
                     if updated:
                         action_icon = get_action_icon("move_entity")
-                        target_list_meta = ensure_list_emoji(conn, user_id, target_list_name)
+                        target_list_meta = await store.run(ensure_list_emoji, user_id, target_list_name)
                         target_suffix = _emoji_suffix(
                             target_list_name, entity_type="list", meta=target_list_meta
                         )
@@ -2882,13 +2685,13 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                             else f"{LIST_ICON} {target_list_name}"
                         )
                         target_label = f"{target_label_base}{target_suffix}"
-                        task_row = fetch_task(conn, user_id, target_list_name, title)
+                        task_row = await store.fetch_task(user_id, target_list_name, title)
                         task_meta: dict[str, Any] = {}
                         task_display = title
                         if task_row and task_row["id"]:
                             task_display = task_row["title"]
-                            task_meta = assign_task_emoji(
-                                conn, task_row["id"], task_row["title"]
+                            task_meta = await store.run(
+                                assign_task_emoji, task_row["id"], task_row["title"]
                             )
                         task_suffix = _emoji_suffix(
                             task_display, entity_type="task", meta=task_meta
@@ -2896,8 +2699,8 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                         header = (
                             f"{action_icon} Перемещено: {task_display}{task_suffix} → в {target_label}"
                         )
-                        list_block = format_list_output(
-                            conn,
+                        list_block = await store.run(
+                            format_list_output,
                             user_id,
                             target_list_name,
                             heading_label=format_section_title(
@@ -2918,23 +2721,23 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                 logger.info(f"Updating task in list: {list_name}")
                 if meta.get("by_index") and meta.get("new_title"):
                     logger.info(f"Updating task by index: {meta['by_index']} to '{meta['new_title']}' in list: {list_name}")
-                    updated, old_title = update_task_by_index(conn, user_id, list_name, meta["by_index"], meta["new_title"])
+                    updated, old_title = await store.update_task_by_index(user_id, list_name, meta["by_index"], meta["new_title"])
                     if updated:
                         action_icon = get_action_icon("update_task")
-                        list_meta = ensure_list_emoji(conn, user_id, list_name)
+                        list_meta = await store.run(ensure_list_emoji, user_id, list_name)
                         list_suffix = _emoji_suffix(list_name, entity_type="list", meta=list_meta)
-                        task_row = fetch_task(conn, user_id, list_name, meta["new_title"])
+                        task_row = await store.fetch_task(user_id, list_name, meta["new_title"])
                         task_meta: dict[str, Any] = {}
                         if task_row and task_row["id"]:
-                            task_meta = assign_task_emoji(conn, task_row["id"], task_row["title"])
+                            task_meta = await store.run(assign_task_emoji, task_row["id"], task_row["title"])
                         suffix = _emoji_suffix(meta["new_title"], entity_type="task", meta=task_meta)
                         if VISUAL_STYLE == "VIBRANT":
                             header = f"{action_icon} Обновлено в {list_name}{list_suffix}:"
                         else:
                             header = f"{action_icon} Обновлено в {LIST_ICON} {list_name}{list_suffix}:"
                         details = f"{action_icon} {old_title} → {meta['new_title']}{suffix}"
-                        list_block = format_list_output(
-                            conn,
+                        list_block = await store.run(
+                            format_list_output,
                             user_id,
                             list_name,
                             heading_label=format_section_title(list_name, list_meta),
@@ -2945,55 +2748,29 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                         await update.message.reply_text(f"⚠️ Не удалось изменить задачу по индексу {meta['by_index']} в списке *{list_name}*.")
                 elif title and meta.get("new_title"):
                     logger.info(f"Updating task: {title} to {meta['new_title']} in list: {list_name}")
-                    updated = update_task(conn, user_id, list_name, title, meta["new_title"])
+                    updated = await store.update_task(user_id, list_name, title, meta["new_title"])
                     if updated:
                         action_icon = get_action_icon("update_task")
-                        list_meta = ensure_list_emoji(conn, user_id, list_name)
+                        list_meta = await store.run(ensure_list_emoji, user_id, list_name)
                         list_suffix = _emoji_suffix(list_name, entity_type="list", meta=list_meta)
-                        task_row = fetch_task(conn, user_id, list_name, meta["new_title"])
+                        task_row = await store.fetch_task(user_id, list_name, meta["new_title"])
                         task_meta: dict[str, Any] = {}
                         if task_row and task_row["id"]:
-                            task_meta = assign_task_emoji(conn, task_row["id"], task_row["title"])
+                            task_meta = await store.run(assign_task_emoji, task_row["id"], task_row["title"])
                         suffix = _emoji_suffix(meta["new_title"], entity_type="task", meta=task_meta)
                         if VISUAL_STYLE == "VIBRANT":
                             header = f"{action_icon} Обновлено в {list_name}{list_suffix}:"
                         else:
                             header = f"{action_icon} Обновлено в {LIST_ICON} {list_name}{list_suffix}:"
                         details = f"{action_icon} {title} → {meta['new_title']}{suffix}"
-                        list_block = format_list_output(
-                            conn,
+                        list_block = await store.run(
+                            format_list_output,
                             user_id,
                             list_name,
                             heading_label=format_section_title(list_name, list_meta),
                         )
                         message = f"{header}\n{details}\n\n{list_block}"
                         await update.message.reply_text(message, parse_mode="Markdown")
-=======
-                    updated = move_entity(conn, user_id, entity_type, title, obj["to_list"])
-                    if updated:
-                        await update.message.reply_text(f"🔄 Перемещено: *{title}* в *{obj['to_list']}*.", parse_mode="Markdown")
-                        set_ctx(user_id, last_action="move_entity", last_list=obj["to_list"])
-                    else:
-                        await update.message.reply_text(f"⚠️ Не удалось переместить *{title}*. Проверь, есть ли такая задача.")
-            except Exception as e:
-                logging.exception(f"Move entity error: {e}")
-                await update.message.reply_text("⚠️ Не удалось переместить задачу. Проверь логи.")
-        elif action == "update_task" and entity_type == "task" and list_name:
-            try:
-                logging.info(f"Updating task in list: {list_name}")
-                if meta.get("by_index") and meta.get("new_title"):
-                    logging.info(f"Updating task by index: {meta['by_index']} to '{meta['new_title']}' in list: {list_name}")
-                    updated, old_title = update_task_by_index(conn, user_id, list_name, meta["by_index"], meta["new_title"])
-                    if updated:
-                        await update.message.reply_text(f"🔄 Задача *{old_title}* изменена на *{meta['new_title']}* в списке *{list_name}*.", parse_mode="Markdown")
-                    else:
-                        await update.message.reply_text(f"⚠️ Не удалось изменить задачу по индексу {meta['by_index']} в списке *{list_name}*.")
-                elif title and meta.get("new_title"):
-                    logging.info(f"Updating task: {title} to {meta['new_title']} in list: {list_name}")
-                    updated = update_task(conn, user_id, list_name, title, meta["new_title"])
-                    if updated:
-                        await update.message.reply_text(f"🔄 Задача *{title}* изменена на *{meta['new_title']}* в списке *{list_name}*.", parse_mode="Markdown")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
                     else:
                         await update.message.reply_text(f"⚠️ Не удалось изменить задачу *{title}* в списке *{list_name}*.")
                 else:
@@ -3002,38 +2779,55 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                     continue
                 set_ctx(user_id, last_action="update_task", last_list=list_name)
             except Exception as e:
-<<<<<<< HEAD
                 logger.exception(f"Update task error: {e}")
                 await update.message.reply_text("⚠️ Не удалось изменить задачу. Проверь логи.")
         elif action == "update_profile" and entity_type == "user_profile" and meta:
             try:
                 logger.info(f"Updating user profile for user {user_id}: {meta}")
-                update_user_profile(conn, user_id, meta.get("city"), meta.get("profession"))
+                await store.update_user_profile(user_id, meta.get("city"), meta.get("profession"))
                 await update.message.reply_text("🆙 Профиль обновлён!", parse_mode="Markdown")
             except Exception as e:
                 logger.exception(f"Update profile error: {e}")
                 await update.message.reply_text("⚠️ Не удалось обновить профиль. Проверь логи.")
+        elif action == "restore_task" and entity_type == "list" and (obj.get("list") or title):
+            target = obj.get("list") or title
+            try:
+                logger.info(f"Restoring list: {target}")
+                if await store.restore_list(user_id, target):
+                    list_meta = await store.run(ensure_list_emoji, user_id, target)
+                    list_suffix = _emoji_suffix(target, entity_type="list", meta=list_meta)
+                    await update.message.reply_text(
+                        f"{get_action_icon('restore_task')} Список {target}{list_suffix} восстановлен.",
+                        parse_mode="Markdown",
+                    )
+                    set_ctx(user_id, last_action="restore_task", last_list=target)
+                    executed_actions.append("restore_task")
+                else:
+                    await update.message.reply_text(f"⚠️ Удалённый список *{target}* не найден.")
+            except Exception as e:
+                logger.exception(f"Restore list error: {e}")
+                await update.message.reply_text("⚠️ Не удалось восстановить список. Проверь логи.")
         elif action == "restore_task" and entity_type == "task" and list_name and title:
             try:
                 logger.info(f"Restoring task: {title} in list: {list_name}")
                 if meta.get("fuzzy"):
-                    restored, matched, suggestion = restore_task_fuzzy(conn, user_id, list_name, title)
+                    restored, matched, suggestion = await store.restore_task_fuzzy(user_id, list_name, title)
                 else:
-                    restored, matched, suggestion = restore_task(conn, user_id, list_name, title)
+                    restored, matched, suggestion = await store.restore_task(user_id, list_name, title)
                 if restored:
                     resolved_title = matched or title
                     icon = get_action_icon("restore_task")
-                    task_row = fetch_task(conn, user_id, list_name, resolved_title)
+                    task_row = await store.fetch_task(user_id, list_name, resolved_title)
                     task_meta: dict[str, Any] = {}
                     if task_row and task_row["id"]:
                         resolved_title = task_row["title"]
-                        task_meta = assign_task_emoji(
-                            conn, task_row["id"], task_row["title"]
+                        task_meta = await store.run(
+                            assign_task_emoji, task_row["id"], task_row["title"]
                         )
                     task_suffix = _emoji_suffix(
                         resolved_title, entity_type="task", meta=task_meta
                     )
-                    list_meta = ensure_list_emoji(conn, user_id, list_name)
+                    list_meta = await store.run(ensure_list_emoji, user_id, list_name)
                     list_suffix = _emoji_suffix(
                         list_name, entity_type="list", meta=list_meta
                     )
@@ -3043,33 +2837,10 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
                     )
                 elif suggestion:
                     await update.message.reply_text(suggestion)
-=======
-                logging.exception(f"Update task error: {e}")
-                await update.message.reply_text("⚠️ Не удалось изменить задачу. Проверь логи.")
-        elif action == "update_profile" and entity_type == "user_profile" and meta:
-            try:
-                logging.info(f"Updating user profile for user {user_id}: {meta}")
-                update_user_profile(conn, user_id, meta.get("city"), meta.get("profession"))
-                await update.message.reply_text("🆙 Профиль обновлён!", parse_mode="Markdown")
-            except Exception as e:
-                logging.exception(f"Update profile error: {e}")
-                await update.message.reply_text("⚠️ Не удалось обновить профиль. Проверь логи.")
-        elif action == "restore_task" and entity_type == "task" and list_name and title:
-            try:
-                logging.info(f"Restoring task: {title} in list: {list_name}")
-                if meta.get("fuzzy"):
-                    restored, matched = restore_task_fuzzy(conn, user_id, list_name, title)
-                else:
-                    restored = restore_task(conn, user_id, list_name, title)
-                    matched = title if restored else None
-                if restored:
-                    await update.message.reply_text(f"🔄 Задача *{matched}* восстановлена в списке *{list_name}*.", parse_mode="Markdown")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
                 else:
                     await update.message.reply_text(f"⚠️ Не удалось восстановить *{title}*.")
                 set_ctx(user_id, last_action="restore_task", last_list=list_name)
             except Exception as e:
-<<<<<<< HEAD
                 logger.exception(f"Restore task error: {e}")
                 await update.message.reply_text("⚠️ Не удалось восстановить задачу. Проверь логи.")
         elif action == "say" and obj.get("text"):
@@ -3082,41 +2853,22 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
         elif action == "clarify" and meta.get("question"):
             try:
                 logger.info(f"Clarify: {meta['question']}")
-=======
-                logging.exception(f"Restore task error: {e}")
-                await update.message.reply_text("⚠️ Не удалось восстановить задачу. Проверь логи.")
-        elif action == "say" and obj.get("text"):
-            try:
-                logging.info(f"Say: {obj['text']}")
-                await update.message.reply_text(obj.get("text"))
-            except Exception as e:
-                logging.exception(f"Say error: {e}")
-                await update.message.reply_text("⚠️ Не удалось отправить сообщение. Проверь логи.")
-        elif action == "clarify" and meta.get("question"):
-            try:
-                logging.info(f"Clarify: {meta['question']}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
                 keyboard = [[InlineKeyboardButton("Да", callback_data=f"clarify_yes:{meta.get('pending')}"), InlineKeyboardButton("Нет", callback_data="clarify_no")]]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 await update.message.reply_text("🤔 " + meta.get("question"), parse_mode="Markdown", reply_markup=reply_markup)
                 set_ctx(user_id, pending_delete=meta.get("pending"))
                 await send_menu(update, context)
             except Exception as e:
-<<<<<<< HEAD
                 logger.exception(f"Clarify error: {e}")
-=======
-                logging.exception(f"Clarify error: {e}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
                 await update.message.reply_text("⚠️ Не удалось уточнить. Проверь логи.")
         else:
             name_from_text = text_mentions_list_and_name(original_text)
             if name_from_text:
-<<<<<<< HEAD
                 logger.info(f"Showing tasks for list from text: {name_from_text}")
-                items = get_list_tasks(conn, user_id, name_from_text)
+                items = await store.get_list_tasks(user_id, name_from_text)
                 if items:
-                    message = format_list_output(
-                        conn,
+                    message = await store.run(
+                        format_list_output,
                         user_id,
                         name_from_text,
                         heading_label=format_section_title(name_from_text),
@@ -3129,31 +2881,16 @@ async def route_actions(update: Update, context: ContextTypes.DEFAULT_TYPE, acti
             await update.message.reply_text("🤔 Не понял, что нужно сделать.")
             await send_menu(update, context)
         logger.info(f"User {user_id}: {original_text} -> Action: {action}")
-=======
-                logging.info(f"Showing tasks for list from text: {name_from_text}")
-                items = get_list_tasks(conn, user_id, name_from_text)
-                if items:
-                    txt = "\n".join([f"{i}. {t}" for i, t in items])
-                    await update.message.reply_text(f"📋 *{name_from_text}:*\n{txt}", parse_mode="Markdown")
-                    set_ctx(user_id, last_action="show_tasks", last_list=name_from_text)
-                    continue
-                await update.message.reply_text(f"Список *{name_from_text}* пуст или не существует.")
-            logging.info("Unknown command, no context match")
-            await update.message.reply_text("🤔 Не понял, что нужно сделать.")
-            await send_menu(update, context)
-        logging.info(f"User {user_id}: {original_text} -> Action: {action}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE, input_text: str | None = None):
     user_id = update.effective_user.id
     text = (input_text or update.message.text or "").strip()
-<<<<<<< HEAD
     logger.info("📩 Text from %s: %s", user_id, text)
     try:
-        conn = get_conn()
+        store = get_async_storage().for_user(user_id)
         history = get_ctx(user_id, "history", [])
-        db_state, session_state = build_semantic_state(conn, user_id, history)
-        user_profile = get_user_profile(conn, user_id)
+        db_state, session_state = await store.run(build_semantic_state, user_id, history, write=False)
+        user_profile = await store.get_user_profile(user_id)
         prompt_values = _PromptValues(
             history=json.dumps(history, ensure_ascii=False),
             db_state=json.dumps(db_state, ensure_ascii=False),
@@ -3205,68 +2942,25 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE, input_
         if not actions:
             if wants_expand(text) and get_ctx(user_id, "last_action") == "show_lists":
                 logger.info("No actions, but expanding lists due to context")
-                await expand_all_lists(update, conn, user_id, context)
+                await expand_all_lists(update, store, user_id, context)
                 return
             logger.warning("No valid JSON actions from OpenAI")
-=======
-    logging.info(f"📩 Text from {user_id}: {text}")
-    try:
-        conn = get_conn()
-        db_state = {
-            "lists": {n: [t for _, t in get_list_tasks(conn, user_id, n)] for n in get_all_lists(conn, user_id)},
-            "last_list": get_ctx(user_id, "last_list"),
-            "pending_delete": get_ctx(user_id, "pending_delete")
-        }
-        history = get_ctx(user_id, "history", [])
-        user_profile = get_user_profile(conn, user_id)
-        prompt = SEMANTIC_PROMPT.format(history=json.dumps(history, ensure_ascii=False),
-                                       db_state=json.dumps(db_state, ensure_ascii=False),
-                                       user_profile=json.dumps(user_profile, ensure_ascii=False),
-                                       pending_delete=get_ctx(user_id, "pending_delete", ""))
-        logging.info(f"Sending to OpenAI: {text}")
-        resp = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": text}
-            ],
-        )
-        raw = resp.choices[0].message.content.strip()
-        logging.info(f"🤖 RAW: {raw}")
-        try:
-            with open("/opt/aura-assistant/openai_raw.log", "a", encoding="utf-8") as f:
-                f.write(f"\n=== RAW ({user_id}) ===\n{text}\n{raw}\n")
-        except Exception:
-            logging.warning("Failed to write to openai_raw.log")
-        actions = extract_json_blocks(raw)
-        if not actions:
-            if wants_expand(text) and get_ctx(user_id, "last_action") == "show_lists":
-                logging.info("No actions, but expanding lists due to context")
-                await expand_all_lists(update, conn, user_id, context)
-                return
-            logging.warning("No valid JSON actions from OpenAI")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
             await update.message.reply_text("⚠️ Модель ответила не в JSON-формате.")
             await send_menu(update, context)
             return
-        await route_actions(update, context, actions, user_id, text)
+        replies = DeferredReplies(update)
+        async with storage_unit(store, actions, user_id, "handle_text", text):
+            await route_actions(replies, context, actions, user_id, text, store=store)
+        await replies.flush()
         set_ctx(user_id, history=history + [text])
     except Exception as e:
-<<<<<<< HEAD
         logger.exception(f"❌ handle_text error: {e}")
-=======
-        logging.exception(f"❌ handle_text error: {e}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
         await update.message.reply_text("Произошла ошибка при обработке. Проверь логи.")
         await send_menu(update, context)
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-<<<<<<< HEAD
     logger.info("🎙 Voice from %s", user_id)
-=======
-    logging.info(f"🎙 Voice from {user_id}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
     try:
         vf = await update.message.voice.get_file()
         ogg = os.path.join(TEMP_DIR, f"{user_id}_voice.ogg")
@@ -3278,7 +2972,6 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
             audio = r.record(src)
             text = r.recognize_google(audio, language="ru-RU")
             text = normalize_text(text)
-<<<<<<< HEAD
         logger.info("🗣 ASR transcript: %s", text)
         await update.message.reply_text(f"🗣 {text}")
         await handle_text(update, context, input_text=text)
@@ -3289,17 +2982,6 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
             logger.warning("Failed to clean up temp voice files %s and %s", ogg, wav, exc_info=True)
     except Exception as e:
         logger.exception(f"❌ voice error: {e}")
-=======
-        logging.info(f"🗣 ASR: {text}")
-        await update.message.reply_text(f"🗣 {text}")
-        await handle_text(update, context, input_text=text)
-        try:
-            os.remove(ogg); os.remove(wav)
-        except Exception:
-            pass
-    except Exception as e:
-        logging.exception(f"❌ voice error: {e}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
         await update.message.reply_text("⚠️ Не удалось обработать голос. Проверь логи.")
         await send_menu(update, context)
 
@@ -3308,15 +2990,13 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     user_id = query.from_user.id
     data = query.data
-<<<<<<< HEAD
     logger.info(f"Callback from {user_id}: {data}")
-=======
-    logging.info(f"Callback from {user_id}: {data}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
+    store = get_async_storage().for_user(user_id)
     try:
         if data.startswith("delete_list:"):
             list_name = data.split(":")[1]
-            deleted = delete_list(get_conn(), user_id, list_name)
+            async with store.transaction("handle_callback"):
+                deleted = await store.delete_list(user_id, list_name)
             if deleted:
                 await query.edit_message_text(f"🗑 Список *{list_name}* удалён.", parse_mode="Markdown")
                 set_ctx(user_id, last_action="delete_list", last_list=None, pending_delete=None)
@@ -3328,7 +3008,8 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             set_ctx(user_id, pending_delete=None)
         elif data.startswith("clarify_yes:"):
             list_name = data.split(":")[1]
-            deleted = delete_list(get_conn(), user_id, list_name)
+            async with store.transaction("handle_callback"):
+                deleted = await store.delete_list(user_id, list_name)
             if deleted:
                 await query.edit_message_text(f"🗑 Список *{list_name}* удалён.", parse_mode="Markdown")
                 set_ctx(user_id, last_action="delete_list", last_list=None, pending_delete=None)
@@ -3341,25 +3022,55 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await query.edit_message_text("⚠️ Неизвестная команда.")
     except Exception as e:
-<<<<<<< HEAD
         logger.exception(f"Callback error: {e}")
-=======
-        logging.exception(f"Callback error: {e}")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
         await query.edit_message_text("⚠️ Ошибка обработки. Проверь логи.")
 
+# The background loops visit every shard file, so they use short-lived
+# direct connections instead of the shard router's pools: a pass must not
+# evict the hot users' pools or re-run schema setup for idle shards.
+def run_compaction_loop(stop: threading.Event) -> None:
+    while True:
+        for path in database_paths():
+            try:
+                with closing(get_conn(path)) as conn:
+                    compact_entities(conn)
+                    backfill_embeddings(conn)
+            except Exception:
+                logger.exception("Archive compaction or embedding backfill failed for %s", path)
+        if stop.wait(ARCHIVE_COMPACT_INTERVAL_S):
+            return
+
+def run_backup_loop(stop: threading.Event) -> None:
+    while not stop.wait(DB_BACKUP_INTERVAL_S):
+        for path in database_paths():
+            try:
+                with closing(get_conn(path)) as conn:
+                    backup_database(conn)
+            except Exception:
+                logger.exception("Database backup failed for %s", path)
+
 def main():
     init_db()
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    app = ApplicationBuilder().token(TELEGRAM_TOKEN).concurrent_updates(True).build()
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     app.add_handler(MessageHandler(filters.VOICE, handle_voice))
     app.add_handler(CallbackQueryHandler(handle_callback))
-<<<<<<< HEAD
+    stop_background = threading.Event()
+    threading.Thread(
+        target=run_compaction_loop, args=(stop_background,), name="archive-compaction", daemon=True
+    ).start()
+    if DB_BACKUP_INTERVAL_S > 0:
+        threading.Thread(
+            target=run_backup_loop, args=(stop_background,), name="db-backup", daemon=True
+        ).start()
     logger.info("🚀 Aura v5.2 started.")
-=======
-    logging.info("🚀 Aura v5.2 started.")
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
-    app.run_polling()
+    try:
+        app.run_polling()
+    finally:
+        stop_background.set()
+        close_async_storage()
+        log_query_profile()
+        close_pool()
 
 if __name__ == "__main__":
     main()
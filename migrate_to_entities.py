@@ -1,18 +1,14 @@
-<<<<<<< HEAD
 from __future__ import annotations
 
+import argparse
 import json
 import os
 import sqlite3
 import sys
-from collections.abc import Iterable
+import time
 
 DB_PATH = os.getenv("DB_PATH", "/opt/aura-assistant/db.sqlite3")
-=======
-import sqlite3, json, os, sys
-
-DB_PATH = "/opt/aura-assistant/db.sqlite3"
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
+MIGRATION_CHUNK_SIZE = int(os.getenv("MIGRATION_CHUNK_SIZE", "5000"))
 
 DDL = """
 CREATE TABLE IF NOT EXISTS entities (
@@ -28,7 +24,18 @@ CREATE TABLE IF NOT EXISTS entities (
 );
 """
 
-<<<<<<< HEAD
+CHECKPOINT_DDL = """
+CREATE TABLE IF NOT EXISTS migration_checkpoints (
+  name TEXT PRIMARY KEY,
+  last_rowid INTEGER NOT NULL,
+  rows INTEGER NOT NULL,
+  updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+OPEN_TASK_META = json.dumps({"status": "open"}, ensure_ascii=False)
+
+
 def table_exists(conn: sqlite3.Connection, name: str) -> bool:
     cur = conn.execute(
         "SELECT 1 FROM sqlite_master WHERE type='table' AND name=? LIMIT 1",
@@ -47,141 +54,155 @@ def table_columns(conn: sqlite3.Connection, name: str) -> set[str]:
     return {row[1] for row in cur.fetchall()}
 
 
-def ensure_list_entity(conn: sqlite3.Connection, user_id: int, name: str) -> int | None:
-    conn.execute(
-        "INSERT OR IGNORE INTO entities (user_id, type, title) VALUES (?, 'list', ?)",
-        (user_id, name),
-    )
+def load_checkpoint(conn: sqlite3.Connection, name: str) -> tuple[int, int]:
     row = conn.execute(
-        "SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1",
-        (user_id, name),
+        "SELECT last_rowid, rows FROM migration_checkpoints WHERE name = ?", (name,)
     ).fetchone()
-    return row[0] if row else None
+    return (row[0], row[1]) if row else (0, 0)
 
 
-def migrate_lists_tasks(conn: sqlite3.Connection) -> None:
-    if not table_exists(conn, "lists") and not table_exists(conn, "tasks"):
+def save_checkpoint(conn: sqlite3.Connection, name: str, last_rowid: int, rows: int) -> None:
+    conn.execute(
+        """
+        INSERT INTO migration_checkpoints (name, last_rowid, rows) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET
+          last_rowid = excluded.last_rowid,
+          rows = excluded.rows,
+          updated_at = CURRENT_TIMESTAMP
+        """,
+        (name, last_rowid, rows),
+    )
+
+
+def load_list_ids(conn: sqlite3.Connection) -> dict[tuple[int, str], int]:
+    """Map ``(user_id, title)`` of every existing list entity to its id (oldest wins)."""
+
+    list_ids: dict[tuple[int, str], int] = {}
+    for user_id, title, list_id in conn.execute(
+        "SELECT user_id, title, id FROM entities WHERE type='list' ORDER BY id DESC"
+    ):
+        list_ids[(user_id, title)] = list_id
+    return list_ids
+
+
+def ensure_list_entities(
+    conn: sqlite3.Connection,
+    list_ids: dict[tuple[int, str], int],
+    keys: set[tuple[int, str]],
+) -> None:
+    """Create the list entities missing from ``list_ids`` and record their ids."""
+
+    missing = sorted(key for key in keys if key not in list_ids)
+    if not missing:
         return
+    for user_id, name in missing:
+        cur = conn.execute(
+            "INSERT INTO entities (user_id, type, title) VALUES (?, 'list', ?)",
+            (user_id, name),
+        )
+        list_ids[(user_id, name)] = cur.lastrowid
 
-    list_id_by_key: dict[tuple[int, str], int] = {}
 
-    if table_exists(conn, "lists"):
-        cols = table_columns(conn, "lists")
-        if {"user_id", "name"}.issubset(cols):
-            for user_id, name in conn.execute("SELECT DISTINCT user_id, name FROM lists"):
-                list_id = ensure_list_entity(conn, user_id, name)
-                if list_id is not None:
-                    list_id_by_key[(user_id, name)] = list_id
-
-    if table_exists(conn, "tasks"):
-        cols = table_columns(conn, "tasks")
-        if {"user_id", "list_name", "task"}.issubset(cols):
-            tasks: Iterable[tuple[int, str, str]] = conn.execute(
-                "SELECT user_id, list_name, task FROM tasks"
-            )
-            for user_id, list_name, task in tasks:
-                list_id = list_id_by_key.get((user_id, list_name))
-                if list_id is None:
-                    list_id = ensure_list_entity(conn, user_id, list_name)
-                    if list_id is not None:
-                        list_id_by_key[(user_id, list_name)] = list_id
-                if list_id is None:
-                    continue
-                conn.execute(
-                    """
-                    INSERT OR IGNORE INTO entities (user_id, type, title, parent_id, meta)
-                    VALUES (?, 'task', ?, ?, ?)
-                    """,
-                    (
-                        user_id,
-                        task,
-                        list_id,
-                        json.dumps({"status": "open"}, ensure_ascii=False),
-                    ),
-                )
-=======
-def table_exists(conn, name):
-    cur = conn.cursor()
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,))
-    return cur.fetchone() is not None
+def _report(label: str, rows: int, started: float) -> None:
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    print(f"{label}: {rows} rows, {rows / elapsed:.0f} rows/sec", flush=True)
+
 
-def migrate_lists_tasks(conn):
-    cur = conn.cursor()
+def migrate_lists_tasks(conn: sqlite3.Connection, chunk_size: int = MIGRATION_CHUNK_SIZE) -> None:
+    """Copy legacy ``lists``/``tasks`` rows into ``entities``.
+
+    Tasks are streamed in ``chunk_size`` batches by rowid; every batch is one
+    transaction that also advances the ``tasks`` checkpoint, so a rerun after
+    an interruption continues from the last committed batch.
+    """
 
-    # Если старых таблиц нет — просто выходим
     if not table_exists(conn, "lists") and not table_exists(conn, "tasks"):
         return
 
-    # Подгружаем ВСЕ списки (если таблица есть)
-    lists = []
+    conn.execute(CHECKPOINT_DDL)
+    list_ids = load_list_ids(conn)
+
     if table_exists(conn, "lists"):
-        cur.execute("PRAGMA table_info(lists)")
-        cols = [c[1] for c in cur.fetchall()]
-        # ожидаем минимум: user_id, name
-        if set(["user_id","name"]).issubset(set(cols)):
-            cur.execute("SELECT DISTINCT user_id, name FROM lists")
-            lists = cur.fetchall()
-
-    # Подготовим индекс имён списков -> id entity
-    list_id_by_key = {}  # (user_id, name) -> entity_id
-
-    # Создадим записи-списки в entities (idempotent)
-    for user_id, name in lists:
+        cols = table_columns(conn, "lists")
+        if {"user_id", "name"}.issubset(cols):
+            started = time.perf_counter()
+            keys = {
+                (user_id, name)
+                for user_id, name in conn.execute("SELECT DISTINCT user_id, name FROM lists")
+            }
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                ensure_list_entities(conn, list_ids, keys)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            _report("lists", len(keys), started)
+
+    if not table_exists(conn, "tasks"):
+        return
+    cols = table_columns(conn, "tasks")
+    if not {"user_id", "list_name", "task"}.issubset(cols):
+        return
+
+    last_rowid, done = load_checkpoint(conn, "tasks")
+    if done:
+        print(f"tasks: resuming after rowid {last_rowid} ({done} rows already migrated)")
+    started = time.perf_counter()
+    migrated = 0
+    while True:
+        chunk = conn.execute(
+            "SELECT rowid, user_id, list_name, task FROM tasks WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (last_rowid, chunk_size),
+        ).fetchall()
+        if not chunk:
+            break
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            cur.execute("""
-              INSERT OR IGNORE INTO entities (user_id, type, title)
-              VALUES (?, 'list', ?)
-            """, (user_id, name))
-            conn.commit()
-        except Exception:
-            pass
-        cur.execute("""
-          SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1
-        """, (user_id, name))
-        row = cur.fetchone()
-        if row:
-            list_id_by_key[(user_id, name)] = row[0]
-
-    # Теперь задачи
-    if table_exists(conn, "tasks"):
-        cur.execute("PRAGMA table_info(tasks)")
-        cols = [c[1] for c in cur.fetchall()]
-        # ожидаем минимум: user_id, list_name, task
-        if set(["user_id","list_name","task"]).issubset(set(cols)):
-            cur.execute("SELECT user_id, list_name, task FROM tasks")
-            for user_id, list_name, task in cur.fetchall():
-                # убедимся, что есть list entity
-                if (user_id, list_name) not in list_id_by_key:
-                    # создадим список, если вдруг не было
-                    cur.execute("""
-                      INSERT OR IGNORE INTO entities (user_id, type, title)
-                      VALUES (?, 'list', ?)
-                    """, (user_id, list_name))
-                    conn.commit()
-                    cur.execute("""
-                      SELECT id FROM entities WHERE user_id=? AND type='list' AND title=? LIMIT 1
-                    """, (user_id, list_name))
-                    r2 = cur.fetchone()
-                    if r2: list_id_by_key[(user_id, list_name)] = r2[0]
-
-                parent_id = list_id_by_key.get((user_id, list_name))
-                # добавим task
-                cur.execute("""
-                  INSERT OR IGNORE INTO entities (user_id, type, title, parent_id, meta)
-                  VALUES (?, 'task', ?, ?, ?)
-                """, (user_id, task, parent_id, json.dumps({"status": "open"})))
-            conn.commit()
->>>>>>> 874f674 (Первый коммит проекта Aura Assistant)
+            ensure_list_entities(
+                conn,
+                list_ids,
+                {(user_id, list_name) for _, user_id, list_name, _ in chunk if list_name is not None},
+            )
+            conn.executemany(
+                """
+                INSERT OR IGNORE INTO entities (user_id, type, title, parent_id, meta)
+                VALUES (?, 'task', ?, ?, ?)
+                """,
+                [
+                    (user_id, task, list_ids[(user_id, list_name)], OPEN_TASK_META)
+                    for _, user_id, list_name, task in chunk
+                    if list_name is not None
+                ],
+            )
+            last_rowid = chunk[-1][0]
+            migrated += len(chunk)
+            save_checkpoint(conn, "tasks", last_rowid, done + migrated)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        _report("tasks", migrated, started)
+    if not migrated:
+        print("tasks: nothing to migrate")
+
 
 def main():
+    parser = argparse.ArgumentParser(description="Migrate legacy lists/tasks tables into entities")
+    parser.add_argument("--chunk-size", type=int, default=MIGRATION_CHUNK_SIZE)
+    parser.add_argument("--restart", action="store_true", help="ignore saved checkpoints")
+    args = parser.parse_args()
     if not os.path.exists(DB_PATH):
         print(f"DB not found: {DB_PATH}", file=sys.stderr)
         sys.exit(1)
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
     try:
-        with conn:
-            conn.execute(DDL)
-            migrate_lists_tasks(conn)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(DDL)
+        if args.restart and table_exists(conn, "migration_checkpoints"):
+            conn.execute("DELETE FROM migration_checkpoints")
+        migrate_lists_tasks(conn, max(1, args.chunk_size))
         print("Migration to entities: OK")
     finally:
         conn.close()
@@ -0,0 +1,1055 @@
+from __future__ import annotations
+
+import asyncio
+import copy
+import logging
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from collections.abc import AsyncIterator, Callable, Iterable, Iterator, Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AbstractContextManager, asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Any, Protocol, TypeVar
+
+import db
+from db import CreationResult, ListSnapshot, UnitOfWorkStats
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+
+T = TypeVar("T")
+
+
+class Storage(Protocol):
+    """Entity operations used by the bot, independent of the storage engine.
+
+    Methods mirror the ``db`` functions of the same name without the leading
+    connection argument; rows returned by :meth:`find_list` and
+    :meth:`fetch_task` expose ``id``, ``title`` and ``meta`` (JSON text).
+    """
+
+    def transaction(self, label: str = "unit") -> AbstractContextManager[UnitOfWorkStats]: ...
+
+    def create_list(self, user_id: int, list_name: str, *, force: bool = False) -> CreationResult: ...
+
+    def add_tasks(
+        self,
+        user_id: int,
+        list_name: str,
+        titles: Sequence[str],
+        *,
+        force: bool = False,
+        stop_on_duplicate: bool = False,
+        vectors: Sequence[list[float] | None] | None = None,
+    ) -> list[CreationResult]: ...
+
+    def find_list(self, user_id: int, list_name: str) -> Mapping[str, Any] | None: ...
+
+    def fetch_task(self, user_id: int, list_name: str, task_title: str) -> Mapping[str, Any] | None: ...
+
+    def get_all_lists(self, user_id: int) -> list[str]: ...
+
+    def get_list_tasks(self, user_id: int, list_name: str) -> list[tuple[int, str, dict[str, Any], int]]: ...
+
+    def get_user_snapshot(self, user_id: int) -> list[ListSnapshot]: ...
+
+    def get_list_meta(self, user_id: int, list_name: str) -> dict[str, Any]: ...
+
+    def get_entity_meta(self, entity_id: int) -> dict[str, Any]: ...
+
+    def set_entity_meta(self, entity_id: int, meta: dict[str, Any] | None) -> None: ...
+
+    def set_entities_meta(self, updates: Iterable[tuple[int, dict[str, Any] | None]]) -> None: ...
+
+    def rename_list(self, user_id: int, old_name: str, new_name: str) -> int: ...
+
+    def delete_list(self, user_id: int, list_name: str) -> int: ...
+
+    def restore_list(self, user_id: int, list_name: str) -> int: ...
+
+    def move_entity(
+        self, user_id: int, entity_type: str, title: str, from_list: str, to_list: str
+    ) -> int: ...
+
+    def update_task(self, user_id: int, list_name: str, old_title: str, new_title: str) -> int: ...
+
+    def update_task_by_index(
+        self, user_id: int, list_name: str, index: int, new_title: str
+    ) -> tuple[int, str | None]: ...
+
+    def mark_task_done_fuzzy(self, user_id: int, list_name: str, pattern: str) -> tuple[int, str | None]: ...
+
+    def mark_tasks_done_bulk(self, user_id: int, list_name: str, patterns: Sequence[str]) -> list[str | None]: ...
+
+    def delete_task_fuzzy(self, user_id: int, list_name: str, pattern: str) -> tuple[int, str | None]: ...
+
+    def delete_task_by_index(self, user_id: int, list_name: str, index: int) -> tuple[int, str | None]: ...
+
+    def restore_task(
+        self, user_id: int, list_name: str, task_title: str
+    ) -> tuple[int, str | None, str | None]: ...
+
+    def restore_task_fuzzy(
+        self, user_id: int, list_name: str, pattern: str
+    ) -> tuple[int, str | None, str | None]: ...
+
+    def search_tasks(self, user_id: int, pattern: str, limit: int = 50) -> list[tuple[str, str]]: ...
+
+    def get_completed_tasks(self, user_id: int, limit: int = 15) -> list[tuple[str, str]]: ...
+
+    def get_deleted_tasks(self, user_id: int, limit: int = 15) -> list[tuple[str, str]]: ...
+
+    def get_user_profile(self, user_id: int) -> dict[str, Any]: ...
+
+    def update_user_profile(
+        self, user_id: int, city: str | None = None, profession: str | None = None
+    ) -> int: ...
+
+
+class SQLiteStorage:
+    """:class:`Storage` backed by one SQLite connection from the ``db`` pool."""
+
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+
+    def transaction(self, label: str = "unit") -> AbstractContextManager[UnitOfWorkStats]:
+        return db.unit_of_work(self.conn, label)
+
+    def create_list(self, user_id: int, list_name: str, *, force: bool = False) -> CreationResult:
+        return db.create_list(self.conn, user_id, list_name, force=force)
+
+    def add_tasks(
+        self,
+        user_id: int,
+        list_name: str,
+        titles: Sequence[str],
+        *,
+        force: bool = False,
+        stop_on_duplicate: bool = False,
+        vectors: Sequence[list[float] | None] | None = None,
+    ) -> list[CreationResult]:
+        return db.add_tasks(
+            self.conn,
+            user_id,
+            list_name,
+            titles,
+            force=force,
+            stop_on_duplicate=stop_on_duplicate,
+            vectors=vectors,
+        )
+
+    def find_list(self, user_id: int, list_name: str) -> Mapping[str, Any] | None:
+        return db.find_list(self.conn, user_id, list_name)
+
+    def fetch_task(self, user_id: int, list_name: str, task_title: str) -> Mapping[str, Any] | None:
+        return db.fetch_task(self.conn, user_id, list_name, task_title)
+
+    def get_all_lists(self, user_id: int) -> list[str]:
+        return db.get_all_lists(self.conn, user_id)
+
+    def get_list_tasks(self, user_id: int, list_name: str) -> list[tuple[int, str, dict[str, Any], int]]:
+        return db.get_list_tasks(self.conn, user_id, list_name)
+
+    def get_user_snapshot(self, user_id: int) -> list[ListSnapshot]:
+        return db.get_user_snapshot(self.conn, user_id)
+
+    def get_list_meta(self, user_id: int, list_name: str) -> dict[str, Any]:
+        return db.get_list_meta(self.conn, user_id, list_name)
+
+    def get_entity_meta(self, entity_id: int) -> dict[str, Any]:
+        return db.get_entity_meta(self.conn, entity_id)
+
+    def set_entity_meta(self, entity_id: int, meta: dict[str, Any] | None) -> None:
+        db.set_entity_meta(self.conn, entity_id, meta)
+
+    def set_entities_meta(self, updates: Iterable[tuple[int, dict[str, Any] | None]]) -> None:
+        db.set_entities_meta(self.conn, updates)
+
+    def rename_list(self, user_id: int, old_name: str, new_name: str) -> int:
+        return db.rename_list(self.conn, user_id, old_name, new_name)
+
+    def delete_list(self, user_id: int, list_name: str) -> int:
+        return db.delete_list(self.conn, user_id, list_name)
+
+    def restore_list(self, user_id: int, list_name: str) -> int:
+        return db.restore_list(self.conn, user_id, list_name)
+
+    def move_entity(
+        self, user_id: int, entity_type: str, title: str, from_list: str, to_list: str
+    ) -> int:
+        return db.move_entity(self.conn, user_id, entity_type, title, from_list, to_list)
+
+    def update_task(self, user_id: int, list_name: str, old_title: str, new_title: str) -> int:
+        return db.update_task(self.conn, user_id, list_name, old_title, new_title)
+
+    def update_task_by_index(
+        self, user_id: int, list_name: str, index: int, new_title: str
+    ) -> tuple[int, str | None]:
+        return db.update_task_by_index(self.conn, user_id, list_name, index, new_title)
+
+    def mark_task_done_fuzzy(self, user_id: int, list_name: str, pattern: str) -> tuple[int, str | None]:
+        return db.mark_task_done_fuzzy(self.conn, user_id, list_name, pattern)
+
+    def mark_tasks_done_bulk(self, user_id: int, list_name: str, patterns: Sequence[str]) -> list[str | None]:
+        return db.mark_tasks_done_bulk(self.conn, user_id, list_name, patterns)
+
+    def delete_task_fuzzy(self, user_id: int, list_name: str, pattern: str) -> tuple[int, str | None]:
+        return db.delete_task_fuzzy(self.conn, user_id, list_name, pattern)
+
+    def delete_task_by_index(self, user_id: int, list_name: str, index: int) -> tuple[int, str | None]:
+        return db.delete_task_by_index(self.conn, user_id, list_name, index)
+
+    def restore_task(
+        self, user_id: int, list_name: str, task_title: str
+    ) -> tuple[int, str | None, str | None]:
+        return db.restore_task(self.conn, user_id, list_name, task_title)
+
+    def restore_task_fuzzy(
+        self, user_id: int, list_name: str, pattern: str
+    ) -> tuple[int, str | None, str | None]:
+        return db.restore_task_fuzzy(self.conn, user_id, list_name, pattern)
+
+    def search_tasks(self, user_id: int, pattern: str, limit: int = 50) -> list[tuple[str, str]]:
+        return db.search_tasks(self.conn, user_id, pattern, limit)
+
+    def get_completed_tasks(self, user_id: int, limit: int = 15) -> list[tuple[str, str]]:
+        return db.get_completed_tasks(self.conn, user_id, limit)
+
+    def get_deleted_tasks(self, user_id: int, limit: int = 15) -> list[tuple[str, str]]:
+        return db.get_deleted_tasks(self.conn, user_id, limit)
+
+    def get_user_profile(self, user_id: int) -> dict[str, Any]:
+        return db.get_user_profile(self.conn, user_id)
+
+    def update_user_profile(
+        self, user_id: int, city: str | None = None, profession: str | None = None
+    ) -> int:
+        return db.update_user_profile(self.conn, user_id, city, profession)
+
+
+@dataclass
+class _MemoryEntity:
+    id: int
+    user_id: int
+    type: str
+    title: str
+    parent_id: int | None = None
+    meta: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def deleted(self) -> bool:
+        return self.meta.get("deleted") is True
+
+    @property
+    def done(self) -> bool:
+        return self.meta.get("done") is True or self.meta.get("status") == "done"
+
+    @property
+    def archived(self) -> bool:
+        return self.meta.get("archived") is True
+
+    @property
+    def active(self) -> bool:
+        return not self.deleted and not self.done
+
+    def row(self) -> dict[str, Any]:
+        return {"id": self.id, "title": self.title, "meta": db._dump_meta(self.meta)}
+
+
+class MemoryStorage:
+    """Dict-backed :class:`Storage` for benchmarks and tests; nothing touches disk.
+
+    Matching reuses the ``db`` scoring helpers, so fuzzy lookups pick the
+    same tasks as SQLite.  Duplicate detection uses token overlap only (no
+    embeddings), creation order stands in for ``created_at``/``position``,
+    and :meth:`transaction` rolls back by restoring a deep copy taken on entry.
+    """
+
+    def __init__(self) -> None:
+        self._entities: dict[int, _MemoryEntity] = {}
+        self._profiles: dict[int, dict[str, Any]] = {}
+        self._next_id = 1
+
+    # -- helpers -----------------------------------------------------------
+
+    def _insert(self, user_id: int, entity_type: str, title: str, parent_id: int | None = None) -> _MemoryEntity:
+        entity = _MemoryEntity(self._next_id, user_id, entity_type, title, parent_id)
+        self._entities[entity.id] = entity
+        self._next_id += 1
+        return entity
+
+    def _lists(self, user_id: int) -> list[_MemoryEntity]:
+        return [e for e in self._entities.values() if e.user_id == user_id and e.type == "list"]
+
+    def _get_list(self, user_id: int, list_name: str) -> _MemoryEntity | None:
+        lowered = (list_name or "").lower()
+        for entity in self._lists(user_id):
+            if not entity.deleted and entity.title.lower() == lowered:
+                return entity
+        return None
+
+    def _tasks(self, parent: _MemoryEntity) -> list[_MemoryEntity]:
+        return [
+            e
+            for e in self._entities.values()
+            if e.user_id == parent.user_id and e.type == "task" and e.parent_id == parent.id
+        ]
+
+    def _active_tasks(self, parent: _MemoryEntity) -> list[_MemoryEntity]:
+        return [e for e in self._tasks(parent) if e.active]
+
+    def _restorable_tasks(self, parent: _MemoryEntity) -> list[_MemoryEntity]:
+        return [e for e in self._tasks(parent) if e.deleted or e.done or e.archived]
+
+    def _task_by_title(self, parent: _MemoryEntity, title: str) -> _MemoryEntity | None:
+        lowered = (title or "").lower()
+        for entity in self._tasks(parent):
+            if not entity.deleted and entity.title.lower() == lowered:
+                return entity
+        return None
+
+    def _task_at_index(self, parent: _MemoryEntity, index: int) -> _MemoryEntity | None:
+        tasks = self._active_tasks(parent)
+        if index > 0 and index <= len(tasks):
+            return tasks[index - 1]
+        if index < 0 and -index <= len(tasks):
+            return tasks[index]
+        return None
+
+    @staticmethod
+    def _candidates(entities: Iterable[_MemoryEntity]) -> list[tuple[int, str, str]]:
+        return [(e.id, e.title, db._dump_meta(e.meta)) for e in entities]
+
+    @staticmethod
+    def _clean(pattern: str) -> str:
+        return re.sub(r"[^0-9a-zA-Zа-яА-ЯёЁ ]+", " ", pattern or "").strip()
+
+    def _semantic_duplicate(
+        self, title: str, others: Iterable[tuple[int, str]]
+    ) -> tuple[int, str, float] | None:
+        tokens = set(db._semantic_tokenize(title))
+        if not tokens:
+            return None
+        scored = []
+        for other_id, other_title in others:
+            other = set(db._semantic_tokenize(other_title))
+            if tokens & other:
+                scored.append((other_id, other_title, len(tokens & other) / len(tokens | other)))
+        return db._best_semantic_match(title, scored, 0.83)
+
+    @staticmethod
+    def _restore_meta(meta: dict[str, Any]) -> bool:
+        changed = False
+        if meta.pop("deleted", None):
+            changed = True
+        if meta.get("status") == "done":
+            meta.pop("status", None)
+            changed = True
+        if meta.pop("archived", None):
+            changed = True
+        if meta.pop("archived_from", None) is not None:
+            changed = True
+        if changed:
+            db._clear_history_stamps(meta)
+        return changed
+
+    def _restore(self, chosen_id: int | None) -> tuple[int, str | None, str | None]:
+        if chosen_id is None:
+            return 0, None, None
+        entity = self._entities[chosen_id]
+        if not self._restore_meta(entity.meta):
+            return 0, None, None
+        return 1, entity.title, None
+
+    def _missing_list_suggestion(self, user_id: int, list_name: str, task_title: str) -> str | None:
+        for entity in self._entities.values():
+            if (
+                entity.user_id == user_id
+                and entity.type == "task"
+                and entity.archived
+                and entity.title.lower() == (task_title or "").lower()
+                and (entity.meta.get("archived_from") or list_name).lower() == list_name.lower()
+            ):
+                return db._restore_suggestion(list_name, task_title)
+        return None
+
+    def _source_title(self, task: _MemoryEntity) -> tuple[bool, str | None]:
+        parent = self._entities.get(task.parent_id) if task.parent_id is not None else None
+        if parent is not None and parent.type != "list":
+            parent = None
+        if task.archived or parent is None or parent.deleted:
+            return True, task.meta.get("archived_from") or (parent.title if parent else None)
+        return False, parent.title
+
+    # -- Storage -----------------------------------------------------------
+
+    @contextmanager
+    def transaction(self, label: str = "unit") -> Iterator[UnitOfWorkStats]:
+        stats: UnitOfWorkStats = {
+            "label": label,
+            "statements": 0,
+            "commits": 0,
+            "rolled_back": False,
+            "elapsed_ms": 0.0,
+        }
+        snapshot = (copy.deepcopy(self._entities), copy.deepcopy(self._profiles), self._next_id)
+        try:
+            yield stats
+        except BaseException:
+            self._entities, self._profiles, self._next_id = snapshot
+            stats["rolled_back"] = True
+            raise
+
+    def create_list(self, user_id: int, list_name: str, *, force: bool = False) -> CreationResult:
+        cleaned = (list_name or "").strip()
+        if not cleaned:
+            return db._creation_result(title=list_name)
+        existing = self._get_list(user_id, cleaned)
+        if existing is not None:
+            return db._creation_result(
+                entity_id=existing.id,
+                title=existing.title,
+                duplicate_detected=True,
+                duplicate_id=existing.id,
+                duplicate_title=existing.title,
+                similarity=1.0,
+                auto_use=True,
+            )
+        if not force:
+            duplicate = self._semantic_duplicate(
+                cleaned, ((e.id, e.title) for e in self._lists(user_id) if not e.deleted)
+            )
+            if duplicate:
+                duplicate_id, duplicate_title, score = duplicate
+                return db._creation_result(
+                    entity_id=duplicate_id,
+                    title=duplicate_title,
+                    duplicate_detected=True,
+                    duplicate_id=duplicate_id,
+                    duplicate_title=duplicate_title,
+                    similarity=score,
+                    auto_use=score >= 0.85,
+                )
+        entity = self._insert(user_id, "list", cleaned)
+        return db._creation_result(entity_id=entity.id, title=cleaned, created=True)
+
+    def add_tasks(
+        self,
+        user_id: int,
+        list_name: str,
+        titles: Sequence[str],
+        *,
+        force: bool = False,
+        stop_on_duplicate: bool = False,
+        vectors: Sequence[list[float] | None] | None = None,
+    ) -> list[CreationResult]:
+        parent = self._get_list(user_id, list_name)
+        if parent is None:
+            return [db._creation_result(title=title, missing_parent=True) for title in titles]
+        existing: dict[str, _MemoryEntity] = {}
+        for task in self._tasks(parent):
+            existing.setdefault(task.title.strip().lower(), task)
+        results: list[CreationResult] = []
+        for title in titles:
+            cleaned = (title or "").strip()
+            key = cleaned.lower()
+            if not cleaned:
+                results.append(db._creation_result(title=title))
+                continue
+            match = existing.get(key)
+            if match is not None and not match.active:
+                match.meta.pop("deleted", None)
+                if match.meta.get("status") == "done":
+                    match.meta.pop("status", None)
+                db._clear_history_stamps(match.meta)
+                results.append(db._creation_result(entity_id=match.id, title=match.title, restored=True))
+                continue
+            duplicate = (match.id, match.title, 1.0) if match is not None else None
+            if duplicate is None and not force:
+                duplicate = self._semantic_duplicate(
+                    cleaned, ((e.id, e.title) for e in self._tasks(parent) if not e.deleted)
+                )
+            if duplicate is not None:
+                duplicate_id, duplicate_title, score = duplicate
+                results.append(
+                    db._creation_result(
+                        entity_id=duplicate_id,
+                        title=duplicate_title,
+                        duplicate_detected=True,
+                        duplicate_id=duplicate_id,
+                        duplicate_title=duplicate_title,
+                        similarity=score,
+                        auto_use=score >= 0.85,
+                    )
+                )
+                if stop_on_duplicate and not force:
+                    break
+                continue
+            entity = self._insert(user_id, "task", cleaned, parent.id)
+            existing[key] = entity
+            results.append(db._creation_result(entity_id=entity.id, title=cleaned, created=True))
+        return results
+
+    def find_list(self, user_id: int, list_name: str) -> Mapping[str, Any] | None:
+        lowered = (list_name or "").lower()
+        for entity in self._lists(user_id):
+            if entity.title.lower() == lowered:
+                return entity.row()
+        return None
+
+    def fetch_task(self, user_id: int, list_name: str, task_title: str) -> Mapping[str, Any] | None:
+        lowered = (list_name or "").lower()
+        for parent in self._lists(user_id):
+            if parent.title.lower() == lowered:
+                task = self._task_by_title(parent, task_title)
+                if task is not None:
+                    return task.row()
+        return None
+
+    def get_all_lists(self, user_id: int) -> list[str]:
+        return sorted(e.title for e in self._lists(user_id) if not e.deleted)
+
+    def get_list_tasks(self, user_id: int, list_name: str) -> list[tuple[int, str, dict[str, Any], int]]:
+        parent = self._get_list(user_id, list_name)
+        if parent is None:
+            return []
+        return [
+            (idx, task.title, dict(task.meta), task.id)
+            for idx, task in enumerate(self._active_tasks(parent), start=1)
+        ]
+
+    def get_user_snapshot(self, user_id: int) -> list[ListSnapshot]:
+        lists = sorted(
+            (e for e in self._lists(user_id) if not e.deleted), key=lambda e: (e.title, e.id)
+        )
+        return [
+            {
+                "id": entity.id,
+                "title": entity.title,
+                "meta": dict(entity.meta),
+                "tasks": [
+                    (idx, task.title, dict(task.meta), task.id)
+                    for idx, task in enumerate(self._active_tasks(entity), start=1)
+                ],
+            }
+            for entity in lists
+        ]
+
+    def get_list_meta(self, user_id: int, list_name: str) -> dict[str, Any]:
+        parent = self._get_list(user_id, list_name)
+        return dict(parent.meta) if parent else {}
+
+    def get_entity_meta(self, entity_id: int) -> dict[str, Any]:
+        entity = self._entities.get(entity_id)
+        return dict(entity.meta) if entity else {}
+
+    def set_entity_meta(self, entity_id: int, meta: dict[str, Any] | None) -> None:
+        entity = self._entities.get(entity_id)
+        if entity is not None:
+            entity.meta = dict(meta or {})
+
+    def set_entities_meta(self, updates: Iterable[tuple[int, dict[str, Any] | None]]) -> None:
+        for entity_id, meta in updates:
+            self.set_entity_meta(entity_id, meta)
+
+    def rename_list(self, user_id: int, old_name: str, new_name: str) -> int:
+        parent = self._get_list(user_id, old_name)
+        if parent is None or self._get_list(user_id, new_name) is not None:
+            return 0
+        parent.title = new_name
+        return 1
+
+    def delete_list(self, user_id: int, list_name: str) -> int:
+        parent = self._get_list(user_id, list_name)
+        if parent is None:
+            return 0
+        parent.meta["deleted"] = True
+        parent.meta["deleted_at"] = db._utc_timestamp()
+        for task in self._tasks(parent):
+            task.meta.pop("deleted", None)
+            task.meta.pop("deleted_at", None)
+            task.meta["archived"] = True
+            task.meta["archived_from"] = parent.title
+        return 1
+
+    def restore_list(self, user_id: int, list_name: str) -> int:
+        if self._get_list(user_id, list_name) is not None:
+            return 0
+        lowered = (list_name or "").lower()
+        deleted = [e for e in self._lists(user_id) if e.deleted and e.title.lower() == lowered]
+        if not deleted:
+            return 0
+        parent = max(deleted, key=lambda e: (e.meta.get("deleted_at") or "", e.id))
+        parent.meta.pop("deleted", None)
+        parent.meta.pop("deleted_at", None)
+        for task in self._tasks(parent):
+            source = task.meta.get("archived_from")
+            if task.archived and (source is None or source.lower() == parent.title.lower()):
+                task.meta.pop("archived", None)
+                task.meta.pop("archived_from", None)
+        return 1
+
+    def move_entity(
+        self, user_id: int, entity_type: str, title: str, from_list: str, to_list: str
+    ) -> int:
+        source = self._get_list(user_id, from_list)
+        target = self._get_list(user_id, to_list)
+        if source is None or target is None:
+            return 0
+        task = self._task_by_title(source, title)
+        if task is None:
+            return 0
+        task.parent_id = target.id
+        return 1
+
+    def update_task(self, user_id: int, list_name: str, old_title: str, new_title: str) -> int:
+        parent = self._get_list(user_id, list_name)
+        if parent is None:
+            return 0
+        task = self._task_by_title(parent, old_title)
+        if task is None or self._task_by_title(parent, new_title) is not None:
+            return 0
+        task.title = new_title
+        return 1
+
+    def update_task_by_index(
+        self, user_id: int, list_name: str, index: int, new_title: str
+    ) -> tuple[int, str | None]:
+        parent = self._get_list(user_id, list_name)
+        if parent is None:
+            return 0, None
+        task = self._task_at_index(parent, int(index))
+        if task is None or self._task_by_title(parent, new_title) is not None:
+            return 0, None
+        old_title, task.title = task.title, new_title
+        return 1, old_title
+
+    def mark_task_done_fuzzy(self, user_id: int, list_name: str, pattern: str) -> tuple[int, str | None]:
+        cleaned = self._clean(pattern)
+        parent = self._get_list(user_id, list_name)
+        if not cleaned or parent is None:
+            return 0, None
+        chosen = db._score_candidates(
+            db._tokenize(pattern), cleaned, self._candidates(self._active_tasks(parent))
+        )
+        if not chosen:
+            return 0, None
+        db._mark_done_meta(self._entities[chosen[0]].meta)
+        return 1, chosen[1]
+
+    def mark_tasks_done_bulk(self, user_id: int, list_name: str, patterns: Sequence[str]) -> list[str | None]:
+        matched: list[str | None] = [None] * len(patterns)
+        parent = self._get_list(user_id, list_name)
+        if parent is None:
+            return matched
+        chosen = db._assign_patterns(patterns, self._candidates(self._active_tasks(parent)))
+        for index, (task_id, task_title, _) in chosen.items():
+            db._mark_done_meta(self._entities[task_id].meta)
+            matched[index] = task_title
+        return matched
+
+    def delete_task_fuzzy(self, user_id: int, list_name: str, pattern: str) -> tuple[int, str | None]:
+        cleaned = self._clean(pattern)
+        parent = self._get_list(user_id, list_name)
+        if not cleaned or parent is None:
+            return 0, None
+        tasks = self._active_tasks(parent)
+        if not tasks:
+            return 0, None
+        target = min(tasks, key=lambda task: db.distance(task.title.lower(), cleaned.lower()))
+        if db.distance(target.title.lower(), cleaned.lower()) > len(cleaned) // 2:
+            return 0, None
+        db._mark_deleted_meta(target.meta)
+        return 1, target.title
+
+    def delete_task_by_index(self, user_id: int, list_name: str, index: int) -> tuple[int, str | None]:
+        parent = self._get_list(user_id, list_name)
+        task = self._task_at_index(parent, int(index)) if parent else None
+        if task is None:
+            return 0, None
+        db._mark_deleted_meta(task.meta)
+        return 1, task.title
+
+    def restore_task(
+        self, user_id: int, list_name: str, task_title: str
+    ) -> tuple[int, str | None, str | None]:
+        parent = self._get_list(user_id, list_name)
+        if parent is None:
+            return 0, None, self._missing_list_suggestion(user_id, list_name, task_title)
+        chosen = db._select_candidate(task_title, self._candidates(self._restorable_tasks(parent)))
+        return self._restore(chosen[0] if chosen else None)
+
+    def restore_task_fuzzy(
+        self, user_id: int, list_name: str, pattern: str
+    ) -> tuple[int, str | None, str | None]:
+        cleaned = self._clean(pattern)
+        if not cleaned:
+            return 0, None, None
+        parent = self._get_list(user_id, list_name)
+        if parent is None:
+            return 0, None, self._missing_list_suggestion(user_id, list_name, pattern)
+        chosen = db._score_candidates(
+            db._tokenize(pattern), cleaned, self._candidates(self._restorable_tasks(parent))
+        )
+        return self._restore(chosen[0] if chosen else None)
+
+    def search_tasks(self, user_id: int, pattern: str, limit: int = 50) -> list[tuple[str, str]]:
+        terms = self._clean(pattern).lower().replace("ё", "е").split()
+        if not terms:
+            return []
+        results: list[tuple[str, str]] = []
+        for parent in self._lists(user_id):
+            if parent.deleted:
+                continue
+            for task in self._active_tasks(parent):
+                words = re.split(r"[^0-9a-zа-я]+", task.title.lower().replace("ё", "е"))
+                if all(any(word.startswith(term) for word in words) for term in terms):
+                    results.append((parent.title, task.title))
+        return results[:limit]
+
+    def get_completed_tasks(self, user_id: int, limit: int = 15) -> list[tuple[str, str]]:
+        done = [
+            e
+            for e in self._entities.values()
+            if e.user_id == user_id and e.type == "task" and e.done and not e.deleted
+        ]
+        done.sort(key=lambda e: (e.meta.get("completed_at") or "", e.id), reverse=True)
+        tasks: list[tuple[str, str]] = []
+        for task in done[:limit]:
+            archived, source_title = self._source_title(task)
+            if archived:
+                display_title = f"Архив • {source_title}" if source_title else "Архив"
+            else:
+                display_title = source_title or "Архив"
+            tasks.append((display_title, task.title))
+        return tasks
+
+    def get_deleted_tasks(self, user_id: int, limit: int = 15) -> list[tuple[str, str]]:
+        deleted = [
+            e
+            for e in self._entities.values()
+            if e.user_id == user_id and e.type == "task" and e.deleted
+        ]
+        deleted.sort(key=lambda e: (e.meta.get("deleted_at") or "", e.id), reverse=True)
+        return [
+            (self._entities[e.parent_id].title if e.parent_id in self._entities else None, e.title)
+            for e in deleted[:limit]
+        ]
+
+    def get_user_profile(self, user_id: int) -> dict[str, Any]:
+        return dict(self._profiles.get(user_id, {}))
+
+    def update_user_profile(
+        self, user_id: int, city: str | None = None, profession: str | None = None
+    ) -> int:
+        self._profiles[user_id] = {"city": city, "profession": profession}
+        return 1
+
+
+_memory_storage: MemoryStorage | None = None
+
+
+def _memory_backend() -> MemoryStorage:
+    global _memory_storage
+    if _memory_storage is None:
+        _memory_storage = MemoryStorage()
+        logging.info("Using in-memory storage backend")
+    return _memory_storage
+
+
+@contextmanager
+def open_storage(user_id: int | None = None) -> Iterator[Storage]:
+    """Storage for one unit of bot work, chosen by ``STORAGE_BACKEND`` (sqlite|memory).
+
+    ``user_id`` selects the shard when the SQLite database is sharded.
+    """
+
+    if STORAGE_BACKEND == "memory":
+        yield _memory_backend()
+        return
+    with db.pooled_connection(user_id) as conn:
+        yield SQLiteStorage(conn)
+
+
+DB_READER_THREADS = int(os.getenv("DB_READER_THREADS", "2"))
+DB_WRITER_THREADS = int(os.getenv("DB_WRITER_THREADS", "4" if db.sharding_enabled() else "1"))
+
+_writer_call = threading.local()
+
+
+def in_writer_call() -> bool:
+    """True while the current thread runs an :class:`AsyncStorage` write.
+
+    A write keeps its writer, and any open transaction, busy until it
+    returns; helpers that would call a slow external service check this and
+    stick to cached results.
+    """
+
+    return getattr(_writer_call, "active", False)
+
+_READ_OPS = (
+    "find_list",
+    "fetch_task",
+    "get_all_lists",
+    "get_list_tasks",
+    "get_user_snapshot",
+    "get_list_meta",
+    "get_entity_meta",
+    "search_tasks",
+    "get_completed_tasks",
+    "get_deleted_tasks",
+    "get_user_profile",
+)
+_WRITE_OPS = (
+    "create_list",
+    "add_tasks",
+    "set_entity_meta",
+    "set_entities_meta",
+    "rename_list",
+    "delete_list",
+    "restore_list",
+    "move_entity",
+    "update_task",
+    "update_task_by_index",
+    "mark_task_done_fuzzy",
+    "mark_tasks_done_bulk",
+    "delete_task_fuzzy",
+    "delete_task_by_index",
+    "restore_task",
+    "restore_task_fuzzy",
+    "update_user_profile",
+)
+
+
+class _DeferredMetaStorage:
+    """Read-only view of a storage that queues meta writes instead of running them.
+
+    Rendering helpers backfill missing emoji through ``set_entity_meta``; on a
+    read-only connection those writes are collected and applied afterwards on
+    the writer.
+    """
+
+    def __init__(self, store: Storage) -> None:
+        self._store = store
+        self.meta_updates: dict[int, dict[str, Any] | None] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._store, name)
+
+    def get_entity_meta(self, entity_id: int) -> dict[str, Any]:
+        if entity_id in self.meta_updates:
+            return dict(self.meta_updates[entity_id] or {})
+        return self._store.get_entity_meta(entity_id)
+
+    def set_entity_meta(self, entity_id: int, meta: dict[str, Any] | None) -> None:
+        self.meta_updates[entity_id] = meta
+
+    def set_entities_meta(self, updates: Iterable[tuple[int, dict[str, Any] | None]]) -> None:
+        self.meta_updates.update(updates)
+
+
+class AsyncStorage:
+    """Awaitable :class:`Storage` for the async handlers.
+
+    Writes run on dedicated writer threads, reads on a small reader pool, so
+    the event loop never waits on SQLite.  Each call checks a connection out
+    of its database's pool (reads use the read-only pool, with meta writes
+    from rendering helpers deferred to the writer); a :meth:`transaction`
+    holds one on its writer
+    thread until it ends, and every call of the current task inside it
+    (reads included) goes there so it sees its own uncommitted changes.
+    Writes to one database always use the same writer thread and never
+    interleave with a transaction on it; writes to other databases (other
+    shards) do not wait for it, even when they share the writer thread.
+    :meth:`for_user` binds the user whose shard is used when the database
+    is sharded.  The memory backend is not thread safe and runs everything
+    on one writer.
+    """
+
+    def __init__(
+        self,
+        *,
+        readers: int = DB_READER_THREADS,
+        writers: int = DB_WRITER_THREADS,
+        backend: str | None = None,
+    ) -> None:
+        self.backend = backend or STORAGE_BACKEND
+        self.user_id: int | None = None
+        memory = self.backend == "memory"
+        self._writers = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"db-writer-{index}")
+            for index in range(1 if memory else max(1, writers))
+        ]
+        self._readers = (
+            ThreadPoolExecutor(max_workers=max(1, readers), thread_name_prefix="db-reader")
+            if not memory and readers > 0
+            else self._writers[0]
+        )
+        self._local = threading.local()
+        self._unit: ContextVar[str | None] = ContextVar(f"storage_unit_{id(self)}", default=None)
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    def for_user(self, user_id: int) -> AsyncStorage:
+        """View sharing this storage's threads, routed to ``user_id``'s database."""
+
+        view = copy.copy(self)
+        view.user_id = user_id
+        return view
+
+    def _path(self) -> str:
+        return "memory" if self.backend == "memory" else db.database_path(self.user_id)
+
+    def _writer_index(self, path: str) -> int:
+        return zlib.crc32(path.encode("utf-8")) % len(self._writers)
+
+    def _lock(self, path: str) -> asyncio.Lock:
+        lock = self._locks.get(path)
+        if lock is None:
+            lock = self._locks[path] = asyncio.Lock()
+        return lock
+
+    def _units(self) -> dict[str, tuple]:
+        units = getattr(self._local, "units", None)
+        if units is None:
+            units = self._local.units = {}
+        return units
+
+    def _call(self, path: str, fn: Callable[..., T], args: tuple, kwargs: dict) -> T:
+        _writer_call.active = True
+        try:
+            if self.backend == "memory":
+                return fn(_memory_backend(), *args, **kwargs)
+            unit = self._units().get(path)
+            if unit is not None:
+                return fn(unit[1], *args, **kwargs)
+            with db.pooled_connection(path=path) as conn:
+                return fn(SQLiteStorage(conn), *args, **kwargs)
+        finally:
+            _writer_call.active = False
+
+    def _read(
+        self, path: str, fn: Callable[..., T], args: tuple, kwargs: dict
+    ) -> tuple[T, dict[int, dict[str, Any] | None]]:
+        if self.backend == "memory":
+            return fn(_memory_backend(), *args, **kwargs), {}
+        with db.read_connection(path=path) as conn:
+            store = _DeferredMetaStorage(SQLiteStorage(conn))
+            return fn(store, *args, **kwargs), store.meta_updates
+
+    async def run(self, fn: Callable[..., T], *args: Any, write: bool = True, **kwargs: Any) -> T:
+        """Call ``fn(store, *args, **kwargs)`` with a sync storage on a worker thread.
+
+        Helpers that only read may pass ``write=False`` to use the reader pool.
+        """
+
+        path = self._path()
+        index = self._writer_index(path)
+        loop = asyncio.get_running_loop()
+        call = partial(self._call, path, fn, args, kwargs)
+        unit_path = self._unit.get()
+        if unit_path is not None:
+            if unit_path != path:
+                raise RuntimeError("Storage calls inside a transaction must use its database")
+            return await loop.run_in_executor(self._writers[index], call)
+        if not write:
+            result, meta_updates = await loop.run_in_executor(
+                self._readers, partial(self._read, path, fn, args, kwargs)
+            )
+            if meta_updates:
+                await self.set_entities_meta(list(meta_updates.items()))
+            return result
+        async with self._lock(path):
+            return await loop.run_in_executor(self._writers[index], call)
+
+    def _begin(self, path: str, label: str) -> UnitOfWorkStats:
+        if self.backend == "memory":
+            pool, conn, store = None, None, _memory_backend()
+        else:
+            pool = db.get_pool(path=path)
+            conn = pool.acquire()
+            store = SQLiteStorage(conn)
+        manager = store.transaction(label)
+        try:
+            stats = manager.__enter__()
+        except BaseException:
+            if pool is not None:
+                pool.release(conn)
+            raise
+        self._units()[path] = (pool, store, conn, manager)
+        return stats
+
+    def _end(self, path: str, exc: BaseException | None) -> None:
+        pool, _, conn, manager = self._units().pop(path)
+        try:
+            if exc is None:
+                manager.__exit__(None, None, None)
+            else:
+                manager.__exit__(type(exc), exc, exc.__traceback__)
+        finally:
+            if pool is not None:
+                pool.release(conn)
+
+    @asynccontextmanager
+    async def transaction(self, label: str = "unit") -> AsyncIterator[UnitOfWorkStats]:
+        """Async counterpart of :meth:`Storage.transaction`; units never interleave."""
+
+        if self._unit.get() is not None:
+            raise RuntimeError("Nested storage transactions are not supported")
+        path = self._path()
+        index = self._writer_index(path)
+        writer = self._writers[index]
+        async with self._lock(path):
+            loop = asyncio.get_running_loop()
+            stats = await loop.run_in_executor(writer, self._begin, path, label)
+            token = self._unit.set(path)
+            try:
+                yield stats
+            except BaseException as exc:
+                self._unit.reset(token)
+                await loop.run_in_executor(writer, self._end, path, exc)
+                raise
+            self._unit.reset(token)
+            await loop.run_in_executor(writer, self._end, path, None)
+
+    def close(self) -> None:
+        if self._readers not in self._writers:
+            self._readers.shutdown(wait=True)
+        for writer in self._writers:
+            writer.shutdown(wait=True)
+
+
+def _async_op(name: str, write: bool) -> Callable[..., Any]:
+    async def op(self: AsyncStorage, *args: Any, **kwargs: Any) -> Any:
+        return await self.run(lambda store: getattr(store, name)(*args, **kwargs), write=write)
+
+    op.__name__ = op.__qualname__ = name
+    op.__doc__ = f"Awaitable :meth:`Storage.{name}`."
+    return op
+
+
+for _name in _READ_OPS:
+    setattr(AsyncStorage, _name, _async_op(_name, write=False))
+for _name in _WRITE_OPS:
+    setattr(AsyncStorage, _name, _async_op(_name, write=True))
+del _name
+
+
+_async_storage: AsyncStorage | None = None
+
+
+def get_async_storage() -> AsyncStorage:
+    global _async_storage
+    if _async_storage is None:
+        _async_storage = AsyncStorage()
+    return _async_storage
+
+
+def close_async_storage() -> None:
+    global _async_storage
+    if _async_storage is not None:
+        _async_storage.close()
+        _async_storage = None
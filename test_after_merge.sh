@@ -34,14 +34,18 @@ else
   echo "ℹ️ Старых процессов не найдено."
 fi
 
-# 4️⃣ Очищаем базу и логи
-echo "🧹 Очищаю базу и логи..."
-rm -f "$DB_FILE" "$LOG_MAIN" "$LOG_CODEX" "$LOG_DB"
-
-# 5️⃣ Активируем виртуальное окружение
+# 4️⃣ Активируем виртуальное окружение
 echo "🧬 Активирую виртуальное окружение..."
 source "$VENV_DIR/bin/activate"
 
+# 5️⃣ Сохраняем резервную копию, затем очищаем базу и логи
+if [ -f "$DB_FILE" ]; then
+  echo "💾 Делаю резервную копию базы..."
+  python3 db.py --backup || { echo "⚠️ Резервная копия не создана, база не удалена."; exit 1; }
+fi
+echo "🧹 Очищаю базу и логи..."
+rm -f "$DB_FILE" "$DB_FILE-wal" "$DB_FILE-shm" "$LOG_MAIN" "$LOG_CODEX" "$LOG_DB"
+
 # 6️⃣ Инициализируем новую базу
 echo "🪄 Создаю новую базу данных..."
 python3 db.py --init
@@ -0,0 +1,675 @@
+import os
+import sqlite3
+import sys
+import types
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+def _levenshtein(a: str, b: str) -> int:
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(
+                min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b))
+            )
+        previous = current
+    return previous[-1]
+
+
+lev_stub = types.ModuleType("Levenshtein")
+lev_stub.distance = _levenshtein
+sys.modules.setdefault("Levenshtein", lev_stub)
+
+import db  # noqa: E402
+
+
+@pytest.fixture
+def conn(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "db.sqlite3"))
+    db.init_db()
+    with db.pooled_connection() as connection:
+        yield connection
+    db.close_pool()
+
+
+def test_pooled_connection_uses_wal_and_reuses_connections(conn):
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+    assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == db.DB_BUSY_TIMEOUT_MS
+    before = db.pool_stats()
+    for _ in range(3):
+        with db.pooled_connection() as other:
+            other.execute("SELECT 1")
+    after = db.pool_stats()
+    assert after["checkouts"] == before["checkouts"] + 3
+    assert after["opened"] == before["opened"] + 1
+    assert after["in_use"] == 1
+
+
+def test_pool_rolls_back_unfinished_transaction(conn):
+    with db.pooled_connection() as other:
+        other.execute("BEGIN")
+        other.execute("INSERT INTO entities (user_id, type, title) VALUES (1, 'list', 'Покупки')")
+    assert conn.execute("SELECT COUNT(*) FROM entities").fetchone()[0] == 0
+
+
+def test_init_db_adds_state_columns_to_legacy_table(tmp_path, monkeypatch):
+    path = tmp_path / "legacy.sqlite3"
+    monkeypatch.setattr(db, "DB_PATH", str(path))
+    legacy = db.sqlite3.connect(path)
+    legacy.execute(db.ENTITIES_DDL)
+    legacy.execute(
+        "INSERT INTO entities (user_id, type, title, meta) VALUES (1, 'list', 'Старый', ?)",
+        ('{"deleted": true}',),
+    )
+    legacy.executemany(
+        "INSERT INTO entities (user_id, type, title, parent_id, meta) VALUES (1, 'task', ?, 1, ?)",
+        [("Первая", None), ("Удалённая", '{"deleted": true}'), ("Вторая", "{}")],
+    )
+    legacy.commit()
+    legacy.close()
+    db.init_db()
+    db.init_db()
+    with db.pooled_connection() as conn:
+        row = conn.execute("SELECT is_deleted, is_archived, status FROM entities").fetchone()
+        assert tuple(row) == (1, 0, "open")
+        fts_rows = conn.execute(
+            "SELECT rowid FROM entities_fts WHERE entities_fts MATCH 'старый'"
+        ).fetchall()
+        assert len(fts_rows) == 1
+        positions = conn.execute(
+            "SELECT title, position FROM entities WHERE type = 'task' ORDER BY id"
+        ).fetchall()
+        assert [tuple(row) for row in positions] == [("Первая", 1), ("Удалённая", None), ("Вторая", 2)]
+        assert conn.execute("SELECT COUNT(*) FROM entity_closure").fetchone()[0] == 7
+        assert conn.execute("SELECT COUNT(*) FROM entity_props").fetchone()[0] == 0
+        plan = " ".join(
+            r[-1]
+            for r in conn.execute(
+                "EXPLAIN QUERY PLAN SELECT id FROM entities "
+                "WHERE user_id = 1 AND type = 'task' AND parent_id = 2 "
+                "AND is_deleted = 0 AND status != 'done'"
+            )
+        )
+    db.close_pool()
+    assert "idx_entities_parent_state" in plan
+
+
+def test_task_state_queries_follow_meta_flags(conn):
+    db.create_list(conn, 1, "Покупки")
+    for title in ("Хлеб", "Молоко", "Сыр"):
+        db.add_task(conn, 1, "Покупки", title, force=True)
+    assert db.mark_task_done(conn, 1, "Покупки", "Хлеб") == 1
+    assert db.delete_task(conn, 1, "Покупки", "Сыр") == 1
+    assert [title for _, title, _, _ in db.get_list_tasks(conn, 1, "Покупки")] == ["Молоко"]
+    assert db.get_completed_tasks(conn, 1) == [("Покупки", "Хлеб")]
+    assert db.get_deleted_tasks(conn, 1) == [("Покупки", "Сыр")]
+    assert db.search_tasks(conn, 1, "Молоко") == [("Покупки", "Молоко")]
+
+
+def test_user_snapshot_returns_lists_with_active_tasks(conn):
+    db.create_list(conn, 1, "Покупки")
+    db.create_list(conn, 1, "Дом", force=True)
+    db.create_list(conn, 2, "Чужой", force=True)
+    for title in ("Хлеб", "Молоко", "Сыр"):
+        db.add_task(conn, 1, "Покупки", title, force=True)
+    db.mark_task_done(conn, 1, "Покупки", "Молоко")
+    snapshot = db.get_user_snapshot(conn, 1)
+    assert [item["title"] for item in snapshot] == ["Дом", "Покупки"]
+    assert snapshot[0]["tasks"] == []
+    assert snapshot[1]["tasks"] == db.get_list_tasks(conn, 1, "Покупки")
+    assert [title for _, title, _, _ in snapshot[1]["tasks"]] == ["Хлеб", "Сыр"]
+
+
+def test_search_tasks_uses_fulltext_index_with_cyrillic_case_folding(conn):
+    db.create_list(conn, 1, "Покупки")
+    for title in ("Молоко козье", "Ёлочные игрушки", "Хлеб", "Молоко"):
+        db.add_task(conn, 1, "Покупки", title, force=True)
+    assert db.search_tasks(conn, 1, "МОЛОК") == [
+        ("Покупки", "Молоко"),
+        ("Покупки", "Молоко козье"),
+    ]
+    assert db.search_tasks(conn, 1, "елочн") == [("Покупки", "Ёлочные игрушки")]
+    conn.execute("UPDATE entities SET title = 'Батон' WHERE title = 'Хлеб'")
+    assert db.search_tasks(conn, 1, "хлеб") == []
+    assert db.search_tasks(conn, 1, "батон") == [("Покупки", "Батон")]
+    assert db.search_tasks(conn, 2, "батон") == []
+
+
+def test_fuzzy_operations_use_trigram_shortlist(conn, monkeypatch):
+    db.create_list(conn, 1, "Покупки")
+    titles = [f"Пункт номер {idx}" for idx in range(40)] + ["Молоко", "Морковь", "Ёршик"]
+    for title in titles:
+        db.add_task(conn, 1, "Покупки", title, force=True)
+    scored: list[int] = []
+    original = db._score_candidates
+
+    def spy(pattern_tokens, cleaned, candidates):
+        candidates = list(candidates)
+        scored.append(len(candidates))
+        return original(pattern_tokens, cleaned, candidates)
+
+    monkeypatch.setattr(db, "_score_candidates", spy)
+    assert db.mark_task_done_fuzzy(conn, 1, "Покупки", "МОЛОКО куплено") == (1, "Молоко")
+    assert scored[-1] < 10
+    assert db.delete_task_fuzzy(conn, 1, "Покупки", "моркови") == (1, "Морковь")
+    assert db.restore_task_fuzzy(conn, 1, "Покупки", "морковь") == (1, "Морковь", None)
+    assert scored[-1] < 10
+    assert db.mark_task_done_fuzzy(conn, 1, "Покупки", "ёршик") == (1, "Ёршик")
+
+
+def test_duplicate_detection_reuses_stored_embeddings(conn, monkeypatch):
+    calls: list[str] = []
+    vectors = {
+        "Покупки": [1.0, 0.0, 0.0],
+        "Дом": [0.0, 1.0, 0.0],
+        "Закупки": [0.99, 0.05, 0.0],
+        "Хлеб": [0.0, 0.0, 1.0],
+        "Батон": [0.7, 0.7, 0.1],
+    }
+
+    def provider(text):
+        calls.append(text)
+        return vectors.get(text)
+
+    monkeypatch.setattr(db, "_embedding_provider", None)
+    db.set_embedding_provider(provider, model="test-model")
+    assert db.create_list(conn, 1, "Покупки")["created"]
+    assert db.create_list(conn, 1, "Дом")["created"]
+    assert calls == ["Покупки", "Дом"]
+    stored = conn.execute(
+        "SELECT model, dim, length(vector) FROM entity_embeddings ORDER BY entity_id"
+    ).fetchall()
+    assert [tuple(row) for row in stored] == [("test-model", 3, 12), ("test-model", 3, 12)]
+
+    result = db.create_list(conn, 1, "Закупки")
+    assert result["duplicate_detected"] and result["duplicate_title"] == "Покупки"
+    assert calls == ["Покупки", "Дом", "Закупки"]
+
+    db.add_task(conn, 1, "Покупки", "Хлеб", force=True)
+    assert db.add_task(conn, 1, "Покупки", "Батон")["created"]
+    assert calls[-1] == "Батон"
+    conn.execute("UPDATE entities SET title = 'Дача' WHERE title = 'Дом'")
+    assert conn.execute("SELECT COUNT(*) FROM entity_embeddings").fetchone()[0] == 2
+
+    assert db.backfill_embeddings(conn) == 1
+    assert calls[-1] == "Хлеб"
+    assert db.backfill_embeddings(conn) == 0
+
+
+def test_add_tasks_uses_precomputed_vectors(conn, monkeypatch):
+    calls: list[str] = []
+
+    def provider(text):
+        calls.append(text)
+        return [0.0, 0.0, 1.0]
+
+    monkeypatch.setattr(db, "_embedding_provider", None)
+    db.create_list(conn, 1, "Покупки", force=True)
+    db.set_embedding_provider(provider, model="test-model")
+    db.add_task(conn, 1, "Покупки", "Хлеб", force=True)
+    results = db.add_tasks(
+        conn, 1, "Покупки", ["Батон", "Молоко"], vectors=[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
+    )
+    assert [r["created"] for r in results] == [True, True]
+    assert calls == []
+    assert conn.execute("SELECT COUNT(*) FROM entity_embeddings").fetchone()[0] == 2
+
+
+def test_token_index_limits_legacy_duplicate_scan(conn, monkeypatch):
+    monkeypatch.setattr(db, "_embedding_provider", None)
+    db.create_list(conn, 1, "Платежи")
+    db.add_task(conn, 1, "Платежи", "Оплатить свет")
+    db.add_task(conn, 1, "Платежи", "Позвонить маме")
+    candidates = db._token_overlap_candidates(conn, 1, {"платит", "газ"}, "task", None)
+    assert [(title, round(score, 2)) for _, title, score in candidates] == [("Оплатить свет", 0.33)]
+    result = db.add_task(conn, 1, "Платежи", "Заплатить за электричество")
+    assert result["duplicate_detected"] and result["duplicate_title"] == "Оплатить свет"
+    db.update_task(conn, 1, "Платежи", "Оплатить свет", "Купить хлеб")
+    assert db.add_task(conn, 1, "Платежи", "Заплатить за электричество")["created"]
+
+
+def test_add_tasks_dedupes_batch_in_one_transaction(conn, monkeypatch):
+    monkeypatch.setattr(db, "_embedding_provider", None)
+    db.create_list(conn, 1, "Покупки")
+    db.add_task(conn, 1, "Покупки", "Хлеб")
+    db.delete_task(conn, 1, "Покупки", "Хлеб")
+    db.add_task(conn, 1, "Покупки", "Сыр")
+    statements: list[str] = []
+    conn.set_trace_callback(statements.append)
+    results = db.add_tasks(
+        conn, 1, "Покупки", ["Молоко", "хлеб", "Яйца", "молоко", "Сыр", "Оплатить свет"]
+    )
+    conn.set_trace_callback(None)
+    assert [
+        (r["title"], r["created"], r["restored"], r["duplicate_detected"]) for r in results
+    ] == [
+        ("Молоко", True, False, False),
+        ("Хлеб", False, True, False),
+        ("Яйца", True, False, False),
+        ("Молоко", False, False, True),
+        ("Сыр", False, False, True),
+        ("Оплатить свет", True, False, False),
+    ]
+    assert results[3]["duplicate_id"] == results[0]["id"]
+    assert sum(1 for sql in statements if sql.startswith(("RELEASE", "COMMIT"))) == 1
+    assert sum(1 for sql in statements if sql.startswith("SELECT") and "entity_tokens" in sql) == 1
+    assert [title for _, title, _, _ in db.get_list_tasks(conn, 1, "Покупки")] == [
+        "Хлеб",
+        "Сыр",
+        "Молоко",
+        "Яйца",
+        "Оплатить свет",
+    ]
+    stopped = db.add_tasks(
+        conn, 1, "Покупки", ["Кефир", "Заплатить за электричество", "Чай"], stop_on_duplicate=True
+    )
+    assert [r["title"] for r in stopped] == ["Кефир", "Оплатить свет"]
+    assert db.add_tasks(conn, 1, "Нет такого", ["Чай"])[0]["missing_parent"]
+
+
+def test_mark_tasks_done_bulk_assigns_each_task_once(conn):
+    db.create_list(conn, 1, "Дела")
+    for title in ("Купить лук", "Купить морковь", "Помыть машину", "Лук"):
+        db.add_task(conn, 1, "Дела", title, force=True)
+    statements: list[str] = []
+    conn.set_trace_callback(statements.append)
+    matched = db.mark_tasks_done_bulk(conn, 1, "Дела", ["лук", "лук", "морковь куплена", "самолёт"])
+    conn.set_trace_callback(None)
+    assert matched == ["Лук", "Купить лук", "Купить морковь", None]
+    assert sum(1 for sql in statements if sql.startswith("RELEASE")) == 1
+    assert [title for _, title, _, _ in db.get_list_tasks(conn, 1, "Дела")] == ["Помыть машину"]
+    completed = conn.execute(
+        "SELECT json_extract(meta, '$.completed_at') FROM entities WHERE status = 'done'"
+    ).fetchall()
+    assert len(completed) == 3 and all(row[0] for row in completed)
+    assert db.mark_tasks_done_bulk(conn, 1, "Нет такого", ["лук"]) == [None]
+
+
+def test_delete_list_archives_children_in_one_transaction(conn):
+    db.create_list(conn, 1, "Ремонт")
+    db.add_tasks(conn, 1, "Ремонт", [f"Задача {idx}" for idx in range(20)], force=True)
+    db.delete_task(conn, 1, "Ремонт", "Задача 0")
+    statements: list[str] = []
+    conn.set_trace_callback(statements.append)
+    assert db.delete_list(conn, 1, "Ремонт") == 1
+    conn.set_trace_callback(None)
+    assert len({sql for sql in statements if sql.lstrip().startswith("UPDATE")}) == 2
+    assert sum(1 for sql in statements if sql.startswith("RELEASE")) == 1
+    states = conn.execute(
+        "SELECT DISTINCT is_deleted, is_archived, json_extract(meta, '$.archived_from') "
+        "FROM entities WHERE type = 'task'"
+    ).fetchall()
+    assert [tuple(row) for row in states] == [(0, 1, "Ремонт")]
+    assert db.get_list_tasks(conn, 1, "Ремонт") == []
+
+    assert db.restore_list(conn, 1, "Ремонт") == 1
+    assert len(db.get_list_tasks(conn, 1, "Ремонт")) == 20
+    assert db.restore_list(conn, 1, "Ремонт") == 0
+
+    assert db.delete_list(conn, 1, "ремонт") == 1
+    db.create_list(conn, 1, "Ремонт", force=True)
+    db.add_tasks(conn, 1, "Ремонт", ["Новая задача"], force=True)
+    live_id = db._get_list_id(conn, 1, "Ремонт")
+    assert db.delete_list(conn, 1, "РЕМОНТ") == 1
+    assert db._get_list_id(conn, 1, "Ремонт") is None
+    assert db.restore_list(conn, 1, "ремонт") == 1
+    assert db._get_list_id(conn, 1, "Ремонт") == live_id
+    assert [t[1] for t in db.get_list_tasks(conn, 1, "Ремонт")] == ["Новая задача"]
+
+
+def test_entity_closure_follows_nested_subtrees(conn):
+    db.create_list(conn, 1, "Дом")
+    db.create_list(conn, 1, "Дача")
+    db.add_tasks(conn, 1, "Дом", ["Покрасить стены", "Вынести мусор"], force=True)
+    task_id = db.fetch_task(conn, 1, "Дом", "Покрасить стены")["id"]
+    sub_id = conn.execute(
+        "INSERT INTO entities (user_id, type, title, parent_id) VALUES (1, 'task', 'Купить краску', ?)",
+        (task_id,),
+    ).lastrowid
+    conn.execute(
+        "INSERT INTO entities (user_id, type, title, parent_id) VALUES (1, 'note', 'Белая матовая', ?)",
+        (sub_id,),
+    )
+    home_id = db._get_list_id(conn, 1, "Дом")
+    assert db.count_descendants(conn, 1, home_id) == 4
+    assert [row["depth"] for row in db.get_descendants(conn, 1, home_id)] == [1, 1, 2, 3]
+    plan = " ".join(
+        r[-1]
+        for r in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT descendant FROM entity_closure WHERE ancestor = ? AND depth > 0",
+            (home_id,),
+        )
+    )
+    assert "USING PRIMARY KEY" in plan
+
+    assert db.move_entity(conn, 1, "task", "Покрасить стены", "Дом", "Дача") == 1
+    dacha_id = db._get_list_id(conn, 1, "Дача")
+    assert db.count_descendants(conn, 1, home_id) == 1
+    assert [row["title"] for row in db.get_descendants(conn, 1, dacha_id, max_depth=2)] == [
+        "Покрасить стены",
+        "Купить краску",
+    ]
+
+    assert db.delete_list(conn, 1, "Дача") == 1
+    archived = conn.execute(
+        "SELECT COUNT(*) FROM entities WHERE is_archived = 1 AND json_extract(meta, '$.archived_from') = 'Дача'"
+    ).fetchone()[0]
+    assert archived == 3
+    assert db.restore_list(conn, 1, "Дача") == 1
+    assert db.count_descendants(conn, 1, dacha_id) == 3
+
+    conn.execute("DELETE FROM entities WHERE id = ?", (sub_id,))
+    assert conn.execute(
+        "SELECT COUNT(*) FROM entity_closure WHERE ancestor = ? OR descendant = ?", (sub_id, sub_id)
+    ).fetchone()[0] == 0
+
+
+def test_entity_props_index_meta_attributes(conn):
+    db.create_list(conn, 1, "Работа")
+    db.add_tasks(conn, 1, "Работа", ["Отчёт", "Созвон", "Презентация"], force=True)
+    ids = {title: db.fetch_task(conn, 1, "Работа", title)["id"] for title in ("Отчёт", "Созвон", "Презентация")}
+    db.set_entity_meta(conn, ids["Отчёт"], {"tags": ["срочно", "квартал"], "priority": 2, "due": "2025-10-16T09:00:00"})
+    db.set_entities_meta(
+        conn,
+        [
+            (ids["Созвон"], {"tags": ["срочно"], "priority": 1, "due": "2025-10-16 18:30:00"}),
+            (ids["Презентация"], {"priority": 3, "due": "2025-10-17"}),
+        ],
+    )
+
+    tagged = db.find_entities_by_prop(conn, 1, "tags", "срочно")
+    assert [row["title"] for row in tagged] == ["Отчёт", "Созвон"]
+    due = db.find_entities_by_prop(conn, 1, "due", start="2025-10-16", end="2025-10-17", entity_type="task")
+    assert [row["title"] for row in due] == ["Отчёт", "Созвон"]
+    assert [row["title"] for row in db.find_entities_by_prop(conn, 1, "priority", start=2)] == ["Отчёт", "Презентация"]
+    assert db.find_entities_by_prop(conn, 2, "tags", "срочно") == []
+    plan = " ".join(
+        r[-1]
+        for r in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT entity_id FROM entity_props "
+            "WHERE user_id = 1 AND key = 'due' AND value_time >= '2025-10-16' AND value_time < '2025-10-17'"
+        )
+    )
+    assert "idx_entity_props_time" in plan
+
+    conn.execute("CREATE TEMP TABLE props_deletes (n INTEGER)")
+    conn.execute(
+        "CREATE TEMP TRIGGER count_props_deletes AFTER DELETE ON main.entity_props BEGIN "
+        "INSERT INTO props_deletes VALUES (1); END"
+    )
+    db.mark_task_done_fuzzy(conn, 1, "Работа", "Созвон")
+    db.delete_task(conn, 1, "Работа", "Презентация")
+    assert conn.execute("SELECT COUNT(*) FROM props_deletes").fetchone()[0] == 0
+    conn.execute("DROP TABLE temp.props_deletes")
+    conn.execute("DROP TRIGGER temp.count_props_deletes")
+    assert db.find_entities_by_prop(conn, 1, "status", "done") == []
+    assert conn.execute("SELECT COUNT(*) FROM entity_props WHERE entity_id = ?", (ids["Созвон"],)).fetchone()[0] == 3
+    db.set_entity_meta(conn, ids["Отчёт"], {"tags": ["квартал"]})
+    assert [row["title"] for row in db.find_entities_by_prop(conn, 1, "tags", "срочно")] == ["Созвон"]
+    conn.execute("DELETE FROM entities WHERE id = ?", (ids["Отчёт"],))
+    assert conn.execute("SELECT COUNT(*) FROM entity_props WHERE entity_id = ?", (ids["Отчёт"],)).fetchone()[0] == 0
+
+
+def test_unit_of_work_commits_once_and_rolls_back_on_error(conn):
+    with db.unit_of_work(conn, "create") as stats:
+        db.create_list(conn, 1, "Поездка", force=True)
+        db.add_tasks(conn, 1, "Поездка", ["Билеты", "Отель", "Паспорт"], force=True)
+        db.set_entity_meta(conn, 1, {"emoji": "✈️"})
+    assert stats["commits"] == 1 and not stats["rolled_back"]
+    assert stats["statements"] > 3
+    assert not conn.in_transaction
+
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work(conn, "failing") as failed:
+            db.mark_tasks_done_bulk(conn, 1, "Поездка", ["Билеты"])
+            raise RuntimeError("boom")
+    assert failed["rolled_back"] and failed["commits"] == 0
+    assert len(db.get_list_tasks(conn, 1, "Поездка")) == 3
+
+
+def test_task_positions_follow_state_changes(conn):
+    db.create_list(conn, 1, "Дела")
+    db.create_list(conn, 1, "Архив", force=True)
+    db.add_tasks(conn, 1, "Дела", ["А", "Б", "В", "Г", "Д"], force=True)
+
+    def positions(list_name):
+        return [
+            tuple(row)
+            for row in conn.execute(
+                "SELECT t.title, t.position FROM entities t JOIN entities l ON l.id = t.parent_id "
+                "WHERE l.title = ? AND t.position IS NOT NULL ORDER BY t.position",
+                (list_name,),
+            )
+        ]
+
+    db.mark_task_done(conn, 1, "Дела", "Б")
+    db.delete_task(conn, 1, "Дела", "Г")
+    assert positions("Дела") == [("А", 1), ("В", 2), ("Д", 3)]
+    assert db.restore_task(conn, 1, "Дела", "Б")[0] == 1
+    assert positions("Дела") == [("А", 1), ("Б", 2), ("В", 3), ("Д", 4)]
+    assert db.move_entity(conn, 1, "task", "А", "Дела", "Архив") == 1
+    assert positions("Дела") == [("Б", 1), ("В", 2), ("Д", 3)]
+    assert positions("Архив") == [("А", 1)]
+
+    assert db.update_task_by_index(conn, 1, "Дела", 2, "Вэ") == (1, "В")
+    assert db.delete_task_by_index(conn, 1, "Дела", -1) == (1, "Д")
+    assert db.delete_task_by_index(conn, 1, "Дела", 5) == (0, None)
+    assert [title for _, title, _, _ in db.get_list_tasks(conn, 1, "Дела")] == ["Б", "Вэ"]
+    plan = " ".join(
+        row[-1]
+        for row in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM entities WHERE parent_id = 1 AND position = 4"
+        )
+    )
+    assert "idx_entities_parent_position" in plan
+
+
+def test_history_views_order_by_indexed_timestamps(conn, monkeypatch):
+    stamps = iter(f"2030-01-01 00:00:{second:02d}" for second in range(60))
+    monkeypatch.setattr(db, "_utc_timestamp", lambda: next(stamps))
+    db.create_list(conn, 1, "Дела")
+    db.add_tasks(conn, 1, "Дела", ["А", "Б", "В", "Г"], force=True)
+    db.mark_task_done(conn, 1, "Дела", "В")
+    db.mark_tasks_done_bulk(conn, 1, "Дела", ["А"])
+    db.delete_task(conn, 1, "Дела", "Г")
+    db.delete_task_by_index(conn, 1, "Дела", 1)
+    assert db.get_completed_tasks(conn, 1) == [("Дела", "А"), ("Дела", "В")]
+    assert db.get_deleted_tasks(conn, 1) == [("Дела", "Б"), ("Дела", "Г")]
+    db.restore_task(conn, 1, "Дела", "А")
+    row = conn.execute("SELECT completed_at, meta FROM entities WHERE title = 'А'").fetchone()
+    assert row["completed_at"] is None and "completed_at" not in (row["meta"] or "")
+    for sql in (
+        "SELECT id FROM entities WHERE user_id = 1 AND type = 'task' AND is_deleted = 0 "
+        "AND status = 'done' ORDER BY completed_at DESC LIMIT 15",
+        "SELECT id FROM entities WHERE user_id = 1 AND type = 'task' AND is_deleted = 1 "
+        "ORDER BY deleted_at DESC LIMIT 15",
+    ):
+        plan = " ".join(row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}"))
+        assert "TEMP B-TREE" not in plan
+
+
+def test_compaction_moves_old_history_to_archive(conn, monkeypatch):
+    db.create_list(conn, 1, "Дела")
+    db.add_tasks(conn, 1, "Дела", ["Старое молоко", "Старый хлеб", "Новое", "Открытое"], force=True)
+    monkeypatch.setattr(db, "_utc_timestamp", lambda: "2000-01-01 00:00:00")
+    db.mark_task_done(conn, 1, "Дела", "Старое молоко")
+    db.delete_task(conn, 1, "Дела", "Старый хлеб")
+    monkeypatch.undo()
+    db.mark_task_done(conn, 1, "Дела", "Новое")
+
+    assert db.compact_entities(conn, older_than_days=30) == 2
+    assert db.compact_entities(conn, older_than_days=30) == 0
+    live = {row["title"] for row in conn.execute("SELECT title FROM entities WHERE type = 'task'")}
+    assert live == {"Новое", "Открытое"}
+    assert [row["op"] for row in conn.execute(
+        "SELECT op FROM entity_changes WHERE op IN ('archive', 'delete')"
+    )] == ["archive", "archive"]
+    conn.execute("UPDATE entity_changes SET changed_at = datetime('now', '-40 days')")
+    db.compact_entities(conn, older_than_days=30, change_log_days=60)
+    assert conn.execute("SELECT COUNT(*) FROM entity_changes").fetchone()[0] > 0
+    db.compact_entities(conn, older_than_days=30, change_log_days=35)
+    assert conn.execute("SELECT COUNT(*) FROM entity_changes").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM entities_fts WHERE entities_fts MATCH 'молоко'").fetchone()[0] == 0
+    assert db.get_completed_tasks(conn, 1) == [("Дела", "Новое"), ("Дела", "Старое молоко")]
+    assert db.get_deleted_tasks(conn, 1) == [("Дела", "Старый хлеб")]
+
+    assert db.restore_task_fuzzy(conn, 1, "Дела", "молоко") == (1, "Старое молоко", None)
+    assert db.restore_task(conn, 1, "Дела", "Старый хлеб")[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM entities_archive").fetchone()[0] == 0
+    assert [title for _, title, _, _ in db.get_list_tasks(conn, 1, "Дела")] == [
+        "Старое молоко",
+        "Старый хлеб",
+        "Открытое",
+    ]
+    assert db.search_tasks(conn, 1, "молоко") == [("Дела", "Старое молоко")]
+
+
+def test_compaction_keeps_tasks_with_live_descendants(conn, monkeypatch):
+    db.create_list(conn, 1, "Проект")
+    db.add_tasks(conn, 1, "Проект", ["Этап 1", "Этап 2"], force=True)
+    stages = [db.fetch_task(conn, 1, "Проект", title)["id"] for title in ("Этап 1", "Этап 2")]
+    subtasks = [
+        conn.execute(
+            "INSERT INTO entities (user_id, type, title, parent_id) VALUES (1, 'task', ?, ?)",
+            (f"Подзадача {index}", stage_id),
+        ).lastrowid
+        for index, stage_id in enumerate(stages, 1)
+    ]
+    for entity_id in (*stages, subtasks[1]):
+        conn.execute(db._MARK_DONE_SQL, ("2000-01-01 00:00:00", entity_id))
+
+    assert db.compact_entities(conn, older_than_days=30) == 2
+    live = {row["title"] for row in conn.execute("SELECT title FROM entities WHERE type = 'task'")}
+    assert live == {"Этап 1", "Подзадача 1"}
+    archived = {row["id"] for row in conn.execute("SELECT id FROM entities_archive")}
+    assert archived == {stages[1], subtasks[1]}
+    assert conn.execute(
+        "SELECT COUNT(*) FROM entity_closure WHERE descendant IN (?, ?)", (stages[1], subtasks[1])
+    ).fetchone()[0] == 0
+
+
+def test_entity_changes_track_per_user_versions(conn):
+    assert db.get_user_version(conn, 1) == 0
+    db.create_list(conn, 1, "Дела", force=True)
+    db.create_list(conn, 2, "Чужие", force=True)
+    db.add_tasks(conn, 1, "Дела", ["А", "Б"], force=True)
+    version = db.get_user_version(conn, 1)
+    assert version == 3 and db.get_user_version(conn, 2) == 1
+
+    db.mark_task_done(conn, 1, "Дела", "А")
+    db.update_task(conn, 1, "Дела", "Б", "Бэ")
+    changes = db.get_changes_since(conn, 1, version)
+    assert [(c["version"], c["op"], c["fields"]) for c in changes] == [
+        (4, "update", ["meta"]),
+        (5, "update", ["title"]),
+    ]
+    assert db.get_changes_since(conn, 1, db.get_user_version(conn, 1)) == []
+    assert db.get_changes_since(conn, 1, 99) is None
+    conn.execute("DELETE FROM entity_changes WHERE user_id = 1 AND version <= 4")
+    assert db.get_changes_since(conn, 1, 2) is None
+
+
+def test_query_profiler_groups_shapes_and_explains_slow_queries(conn, monkeypatch):
+    assert not isinstance(conn, db.ProfiledConnection)
+    monkeypatch.setattr(db, "DB_PROFILE", True)
+    db.reset_query_profile()
+    monkeypatch.setattr(db._profiler, "slow_ms", 0.0)
+    profiled = db.get_conn()
+    assert isinstance(profiled, db.ProfiledConnection)
+    db.create_list(profiled, 1, "Дом")
+    for name in ("Дом", "дом", "Дача"):
+        profiled.execute("SELECT id FROM entities WHERE user_id = 1 AND title = ?", (name,)).fetchall()
+    iterated = profiled.execute("SELECT id FROM entities")
+    assert len(list(iterated)) == 1
+    iterated.close()
+    profiled.close()
+    profile = {item["shape"]: item for item in db.query_profile(limit=None)}
+    item = profile["SELECT id FROM entities WHERE user_id = ? AND title = ?"]
+    assert item["calls"] == 3
+    assert item["rows"] == 1
+    assert sum(item["histogram"].values()) == 3
+    assert item["call_sites"][0][0].startswith("test_query_profiler_groups_shapes_and_explains_slow_queries")
+    assert item["plan"] and "entities" in item["plan"]
+
+
+def test_backup_database_verifies_and_rotates(conn, tmp_path):
+    db.create_list(conn, 1, "Дом")
+    db.add_tasks(conn, 1, "Дом", ["Полить цветы"])
+    dest = tmp_path / "backups"
+    dest.mkdir()
+    for stamp in ("20250101-000000", "20250102-000000", "20250103-000000"):
+        (dest / f"db.{stamp}.sqlite3").write_bytes(b"")
+    result = db.backup_database(conn, str(dest), keep=2, pages_per_step=1, step_sleep_ms=0)
+    assert result and result["ok"] and result["pages"] > 1
+    assert sorted(p.name for p in dest.iterdir()) == [
+        "db.20250103-000000.sqlite3",
+        os.path.basename(result["path"]),
+    ]
+    copy = sqlite3.connect(result["path"])
+    try:
+        assert copy.execute("PRAGMA journal_mode").fetchone()[0] == "delete"
+        assert copy.execute("SELECT title FROM entities WHERE type = 'task'").fetchall() == [("Полить цветы",)]
+    finally:
+        copy.close()
+
+
+def test_meta_flags_update_in_place_and_decoding_is_memoized(conn):
+    db.create_list(conn, 1, "Дом")
+    db.add_tasks(conn, 1, "Дом", ["Полить цветы", "Вынести мусор"])
+    task_id, other_id = (task[3] for task in db.get_list_tasks(conn, 1, "Дом"))
+    db.set_entities_meta(conn, [(task_id, {"emoji": {"char": "🌿"}}), (other_id, {"emoji": {"char": "🗑"}})])
+    assert db.mark_task_done_fuzzy(conn, 1, "Дом", "полить")[0] == 1
+    meta = db.get_entity_meta(conn, task_id)
+    assert meta["emoji"] == {"char": "🌿"} and meta["status"] == "done" and meta["completed_at"]
+
+    db._decode_entity_meta.cache_clear()
+    for _ in range(3):
+        tasks = db.get_list_tasks(conn, 1, "Дом")
+        tasks[0][2]["scratch"] = True
+    info = db._decode_entity_meta.cache_info()
+    assert (info.hits, info.misses) == (2, 1)
+    assert "scratch" not in db.get_list_tasks(conn, 1, "Дом")[0][2]
+
+
+def test_sharding_routes_users_to_files_and_splits_monolith(conn, tmp_path, monkeypatch):
+    db.create_list(conn, 1, "Дом")
+    db.add_tasks(conn, 1, "Дом", ["Полить цветы", "Вынести мусор"])
+    db.mark_task_done_fuzzy(conn, 1, "Дом", "мусор")
+    db.create_list(conn, 2, "Работа")
+    db.add_tasks(conn, 2, "Работа", ["Отчёт"])
+    monolith = db.DB_PATH
+    version = db.get_user_version(conn, 1)
+
+    shards = tmp_path / "shards"
+    monkeypatch.setattr(db, "DB_PATH", str(shards))
+    monkeypatch.setattr(db, "DB_SHARDING", True)
+    monkeypatch.setattr(db, "_router", db.ShardRouter(capacity=1))
+    assert db.split_database(monolith) == {
+        str(shards / "user_1.sqlite3"): 1,
+        str(shards / "user_2.sqlite3"): 1,
+    }
+    db.split_database(monolith)
+    assert db.database_paths() == [str(shards / "user_1.sqlite3"), str(shards / "user_2.sqlite3")]
+
+    with db.pooled_connection(1) as shard:
+        assert [t[1] for t in db.get_list_tasks(shard, 1, "Дом")] == ["Полить цветы"]
+        assert db.get_all_lists(shard, 2) == []
+        assert db.get_user_version(shard, 1) == version
+        assert db.search_tasks(shard, 1, "цвет")
+    first_pool = db.get_pool(1)
+    with db.pooled_connection(2) as shard:
+        assert db.get_all_lists(shard, 2) == ["Работа"]
+    assert db._router.open_paths() == [str(shards / "user_2.sqlite3")]
+    assert first_pool.stats()["idle"] == 0
+    second_pool = db.get_pool(2)
+    with db.read_connection(2) as shard:
+        assert db.get_all_lists(shard, 2) == ["Работа"]
+    assert db.get_pool(2) is second_pool
+    with db.pooled_connection(3) as shard:
+        db.create_list(shard, 3, "Новый")
+    assert (shards / "user_3.sqlite3").exists()
@@ -0,0 +1,55 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import migrate_to_entities as migrate  # noqa: E402
+
+
+def _legacy_db() -> sqlite3.Connection:
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    conn.execute(migrate.DDL)
+    conn.execute("CREATE TABLE lists (user_id INTEGER, name TEXT)")
+    conn.execute("CREATE TABLE tasks (user_id INTEGER, list_name TEXT, task TEXT)")
+    conn.executemany("INSERT INTO lists VALUES (?, ?)", [(1, "Дом"), (1, "Дом"), (2, "Работа")])
+    conn.executemany(
+        "INSERT INTO tasks VALUES (?, ?, ?)",
+        [(1, "Дом", f"Задача {i}") for i in range(5)] + [(2, "Отпуск", "Билеты")],
+    )
+    return conn
+
+
+def test_migration_resumes_from_checkpoint(monkeypatch, capsys):
+    conn = _legacy_db()
+    save = migrate.save_checkpoint
+    calls = []
+
+    def flaky_save(*args):
+        calls.append(args)
+        if len(calls) == 2:
+            raise RuntimeError("interrupted")
+        save(*args)
+
+    monkeypatch.setattr(migrate, "save_checkpoint", flaky_save)
+    with pytest.raises(RuntimeError):
+        migrate.migrate_lists_tasks(conn, chunk_size=2)
+    assert migrate.load_checkpoint(conn, "tasks") == (2, 2)
+    assert conn.execute("SELECT COUNT(*) FROM entities WHERE type = 'task'").fetchone()[0] == 2
+
+    monkeypatch.setattr(migrate, "save_checkpoint", save)
+    migrate.migrate_lists_tasks(conn, chunk_size=2)
+    migrate.migrate_lists_tasks(conn, chunk_size=2)
+    assert migrate.load_checkpoint(conn, "tasks") == (6, 6)
+    lists = conn.execute(
+        "SELECT user_id, title FROM entities WHERE type = 'list' ORDER BY id"
+    ).fetchall()
+    assert lists == [(1, "Дом"), (2, "Работа"), (2, "Отпуск")]
+    tasks = conn.execute(
+        "SELECT t.title, l.title FROM entities t JOIN entities l ON l.id = t.parent_id"
+        " WHERE t.type = 'task' ORDER BY t.id"
+    ).fetchall()
+    assert tasks == [(f"Задача {i}", "Дом") for i in range(5)] + [("Билеты", "Отпуск")]
+    assert "resuming after rowid 2" in capsys.readouterr().out
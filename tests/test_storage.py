@@ -0,0 +1,175 @@
+import asyncio
+import os
+import sqlite3
+import sys
+import threading
+
+import pytest
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from test_db import conn  # noqa: E402,F401  (fixture; also installs the Levenshtein stub)
+
+import db  # noqa: E402
+import storage  # noqa: E402
+
+
+def _exercise(store: storage.Storage) -> list:
+    out = []
+    out.append(store.create_list(1, "Покупки")["created"])
+    out.append(store.create_list(1, "Дом", force=True)["created"])
+    out.append(
+        [
+            (r["title"], r["created"], r["duplicate_detected"])
+            for r in store.add_tasks(1, "Покупки", ["Молоко", "Хлеб", "Сыр", "молоко", "Кефир"])
+        ]
+    )
+    out.append(store.mark_tasks_done_bulk(1, "Покупки", ["молоко", "сыра"]))
+    out.append(store.delete_task_fuzzy(1, "Покупки", "хлеб"))
+    out.append(store.restore_task_fuzzy(1, "Покупки", "хлеб"))
+    out.append(store.update_task_by_index(1, "Покупки", -1, "Ряженка"))
+    out.append(store.delete_task_by_index(1, "Покупки", 1))
+    out.append(store.move_entity(1, "task", "Ряженка", "Покупки", "Дом"))
+    out.append(store.rename_list(1, "Дом", "Дача"))
+    out.append([(item["title"], [t[:2] for t in item["tasks"]]) for item in store.get_user_snapshot(1)])
+    out.append(sorted(store.get_completed_tasks(1)))
+    out.append(store.get_deleted_tasks(1))
+    out.append(store.search_tasks(1, "ряж"))
+    out.append(store.delete_list(1, "Дача"))
+    out.append(store.restore_task(1, "Дача", "Ряженка"))
+    out.append(store.get_all_lists(1))
+    out.append(store.create_list(1, "Дача", force=True)["created"])
+    out.append(store.add_tasks(1, "Дача", ["Полить грядки"])[0]["created"])
+    out.append(store.delete_list(1, "дача"))
+    out.append(store.restore_list(1, "ДАЧА"))
+    out.append(store.restore_list(1, "Дача"))
+    out.append([(item["title"], [t[:2] for t in item["tasks"]]) for item in store.get_user_snapshot(1)])
+    out.append(store.update_user_profile(1, city="Казань"))
+    out.append(store.get_user_profile(1))
+    return out
+
+
+def test_memory_storage_matches_sqlite_storage(conn, monkeypatch):
+    monkeypatch.setattr(db, "_embedding_provider", None)
+    with storage.SQLiteStorage(conn).transaction("test") as stats:
+        expected = _exercise(storage.SQLiteStorage(conn))
+    assert stats["commits"] == 1
+    assert _exercise(storage.MemoryStorage()) == expected
+
+
+def test_memory_transaction_rolls_back_partial_writes():
+    store = storage.MemoryStorage()
+    store.create_list(1, "Покупки")
+    store.add_tasks(1, "Покупки", ["Молоко"])
+    with pytest.raises(RuntimeError):
+        with store.transaction("test") as stats:
+            store.add_tasks(1, "Покупки", ["Хлеб"])
+            store.mark_task_done_fuzzy(1, "Покупки", "молоко")
+            raise RuntimeError("boom")
+    assert stats["rolled_back"]
+    assert [t[1] for t in store.get_list_tasks(1, "Покупки")] == ["Молоко"]
+    assert store.add_tasks(1, "Покупки", ["Хлеб"])[0]["id"] == 3
+
+
+def test_open_storage_selects_backend(conn, monkeypatch):
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", "memory")
+    monkeypatch.setattr(storage, "_memory_storage", None)
+    with storage.open_storage() as first, storage.open_storage() as second:
+        assert isinstance(first, storage.MemoryStorage) and first is second
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", "sqlite")
+    with storage.open_storage() as store:
+        assert isinstance(store, storage.SQLiteStorage)
+    with pytest.raises(RuntimeError):
+        with storage.MemoryStorage().transaction() as stats:
+            raise RuntimeError("boom")
+    assert stats["rolled_back"]
+
+
+def test_async_storage_routes_reads_and_writes(conn):
+    store = storage.AsyncStorage(readers=2, backend="sqlite")
+
+    def thread_name(_store):
+        return threading.current_thread().name
+
+    async def scenario():
+        await store.create_list(1, "Покупки")
+        outside = await store.run(thread_name, write=False)
+        async with store.transaction("test") as stats:
+            await store.add_tasks(1, "Покупки", ["Молоко"])
+            inside = await store.run(thread_name, write=False)
+            seen = [t[1] for t in await store.get_list_tasks(1, "Покупки")]
+        assert stats["statements"] > 0
+        with pytest.raises(RuntimeError):
+            async with store.transaction("test"):
+                await store.add_tasks(1, "Покупки", ["Хлеб"])
+                raise RuntimeError("boom")
+        after = [t[1] for t in await store.get_list_tasks(1, "Покупки")]
+        return outside, inside, seen, after
+
+    try:
+        outside, inside, seen, after = asyncio.run(scenario())
+    finally:
+        store.close()
+    assert outside.startswith("db-reader")
+    assert inside.startswith("db-writer")
+    assert seen == ["Молоко"]
+    assert after == ["Молоко"]
+    assert db.pool_stats()["in_use"] == 1
+
+
+def test_async_reads_use_read_only_connections_and_defer_meta_writes(conn):
+    store = storage.AsyncStorage(readers=1, backend="sqlite")
+    list_id = db.create_list(conn, 1, "Покупки")["id"]
+
+    def render(sync_store):
+        sync_store.set_entity_meta(list_id, {"emoji": "🛒"})
+        query_only = sync_store.conn.execute("PRAGMA query_only").fetchone()[0]
+        return query_only, sync_store.get_entity_meta(list_id)
+
+    try:
+        query_only, meta = asyncio.run(store.run(render, write=False))
+    finally:
+        store.close()
+    assert query_only == 1
+    assert meta == {"emoji": "🛒"}
+    assert db.get_entity_meta(conn, list_id) == {"emoji": "🛒"}
+    with db.read_connection() as ro, pytest.raises(sqlite3.OperationalError):
+        ro.execute("DELETE FROM entities")
+
+
+def test_slow_transaction_does_not_block_other_users_writes(conn, tmp_path, monkeypatch):
+    (tmp_path / "shards").mkdir()
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "shards"))
+    monkeypatch.setattr(db, "DB_SHARDING", True)
+    monkeypatch.setattr(db, "_router", db.ShardRouter())
+    monkeypatch.setattr(db, "_embedding_provider", None)
+    store = storage.AsyncStorage(readers=1, writers=1, backend="sqlite")
+    first, second = store.for_user(1), store.for_user(2)
+
+    async def scenario():
+        entered, release = asyncio.Event(), asyncio.Event()
+
+        async def slow_unit():
+            async with first.transaction("slow"):
+                await first.create_list(1, "Дом")
+                flags = (await first.run(lambda _store: storage.in_writer_call()), storage.in_writer_call())
+                entered.set()
+                await release.wait()
+            return flags
+
+        slow = asyncio.create_task(slow_unit())
+        await entered.wait()
+        created = await asyncio.wait_for(second.create_list(2, "Работа"), timeout=5)
+        pending = not slow.done()
+        release.set()
+        return created, pending, await slow, await second.get_all_lists(2), await first.get_all_lists(1)
+
+    try:
+        created, pending, flags, second_lists, first_lists = asyncio.run(scenario())
+    finally:
+        store.close()
+        db.close_pool()
+    assert created["created"] and pending
+    assert flags == (True, False)
+    assert second_lists == ["Работа"]
+    assert first_lists == ["Дом"]